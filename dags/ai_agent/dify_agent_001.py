@@ -15,6 +15,8 @@ from airflow.exceptions import AirflowException
 
 # 自定义库导入
 from utils.wechat_channl import send_wx_msg
+from utils.room_buffer import RoomBuffer
+from utils.variable_cache import get_variable
 
 
 DAG_ID = "dify_agent_001"
@@ -139,15 +141,12 @@ def get_dify_agent_session(agent, room_id, sender):
         return conversation_id
     
 
-def should_pre_stop(current_message):
+def should_pre_stop(superseded):
     """
     检查是否需要提前停止流程
+    :param superseded: RoomBuffer.watch_superseded 的返回值
     """
-    # 缓存的消息
-    room_id = current_message.get('roomid')
-    sender = current_message.get('sender')
-    room_sender_msg_list = Variable.get(f'{room_id}_{sender}_msg_list', default_var=[], deserialize_json=True)
-    if current_message['id'] != room_sender_msg_list[-1]['id']:
+    if superseded.is_set():
         print(f"[PRE_STOP] 检测到提前停止信号，停止流程执行")
         raise AirflowException("检测到提前停止信号，停止流程执行")
     else:
@@ -168,62 +167,56 @@ def chat_with_dify_agent(**context):
     source_ip = current_message_data.get('source_ip', '')  # 获取源IP, 用于发送消息
     is_group = current_message_data.get('is_group', False)  # 是否群聊
 
-    # 检查是否需要提前停止
-    should_pre_stop(current_message_data)
-
-    # 创建Dify的AI助手
-    dify_agent = DifyAgent(api_key=Variable.get("DIFY_API_KEY"), base_url=Variable.get("DIFY_BASE_URL"))
-
-    # 获取会话ID
-    conversation_id = get_dify_agent_session(dify_agent, room_id, sender)
-
-    # 遍历近期的消息是否已回复，没有回复，则合并到这次提问
-    room_sender_msg_list = Variable.get(f'{room_id}_{sender}_msg_list', default_var=[], deserialize_json=True)
-    up_for_reply_msg_list = []
-    up_for_reply_msg_id_list = []
-    for msg in room_sender_msg_list[-10:]:
-        if not msg.get('is_reply'):
-            up_for_reply_msg_list.append(msg)
-            up_for_reply_msg_id_list.append(msg['id'])
-        else:
-            pass
-
-    # 整合最近未被回复的消息列表
-    recent_message_content_list = [f"\n\n{msg.get('content', '')}" for msg in up_for_reply_msg_list]
-    question = "\n".join(recent_message_content_list) 
-    print("="*50)
-    print(f"question: {question}")
-    print("="*50)
-
-    # 检查是否需要提前停止
-    should_pre_stop(current_message_data)
-
-    # 获取AI回复
-    response_data = dify_agent.create_chat_message(
-        query=question,
-        user_id=f"{room_id}_{sender}",
-        conversation_id=conversation_id
-    )
-    response = response_data.get("answer", "")
+    # 订阅房间+发送者的最新消息, 有新消息到达时立即标记, 检查时不需要访问Redis
+    room_sender_buffer = RoomBuffer(f'{room_id}_{sender}')
+    with room_sender_buffer.watch_superseded(msg_id) as superseded:
+        # 检查是否需要提前停止
+        should_pre_stop(superseded)
+
+        # 创建Dify的AI助手
+        dify_agent = DifyAgent(api_key=get_variable("DIFY_API_KEY"), base_url=get_variable("DIFY_BASE_URL"))
+
+        # 获取会话ID
+        conversation_id = get_dify_agent_session(dify_agent, room_id, sender)
+
+        # 遍历近期的消息是否已回复，没有回复，则合并到这次提问
+        up_for_reply_msg_list = room_sender_buffer.unreplied(10)
+        up_for_reply_msg_id_list = [msg['id'] for msg in up_for_reply_msg_list]
+
+        # 整合最近未被回复的消息列表
+        recent_message_content_list = [f"\n\n{msg.get('content', '')}" for msg in up_for_reply_msg_list]
+        question = "\n".join(recent_message_content_list) 
+        print("="*50)
+        print(f"question: {question}")
+        print("="*50)
+
+        # 检查是否需要提前停止
+        should_pre_stop(superseded)
+
+        # 获取AI回复
+        response_data = dify_agent.create_chat_message(
+            query=question,
+            user_id=f"{room_id}_{sender}",
+            conversation_id=conversation_id
+        )
+        response = response_data.get("answer", "")
     
-    # 打印AI回复
-    print("="*50)
-    print(f"response: {response}")
-    print("="*50)
-
-    # 检查是否需要提前停止
-    should_pre_stop(current_message_data)
-    # 发送消息, 可能需要分段发送
-    for response_part in re.split(r'\\n\\n|\n\n', response):
-        response_part = response_part.replace('\\n', '\n')
-        send_wx_msg(wcf_ip=source_ip, message=response_part, receiver=room_id)
-
-    # 记录消息已被成功回复
-    for msg in room_sender_msg_list:
-        if msg['id'] in up_for_reply_msg_id_list:
-            msg['is_reply'] = True
+        # 打印AI回复
+        print("="*50)
+        print(f"response: {response}")
+        print("="*50)
+
+        # 检查是否需要提前停止
+        should_pre_stop(superseded)
+        # 发送消息, 可能需要分段发送
+        for response_part in re.split(r'\\n\\n|\n\n', response):
+            response_part = response_part.replace('\\n', '\n')
+            send_wx_msg(wcf_ip=source_ip, message=response_part, receiver=room_id)
+
+        # 记录消息已被成功回复
+        room_sender_buffer.mark_replied(up_for_reply_msg_id_list)
+        for msg in up_for_reply_msg_list:
             print(f"[WATCHER] 消息已回复: {room_id} {sender} {msg['id']} {msg['content']}")
-    Variable.set(f'{room_id}_{sender}_msg_list', room_sender_msg_list, serialize_json=True)
 
 
 # 创建DAG
@@ -9,12 +9,13 @@ from datetime import datetime, timedelta
 # 第三方库导入
 import requests
 from airflow import DAG
-from airflow.models import Variable
 from airflow.operators.python import PythonOperator
 from airflow.exceptions import AirflowException
 from smbclient import register_session, open_file
 
 # 自定义库导入
+from utils.deferrable_operators import WaitRemoteFileOperator
+from utils.variable_cache import get_variable
 from utils.wechat_channl import save_wx_file
 
 
@@ -37,8 +38,8 @@ def download_file_from_windows_server(remote_file_name: str, local_file_name: st
     os.makedirs(temp_dir, exist_ok=True)
     
     # 从Airflow变量获取配置
-    windows_smb_dir = Variable.get("WINDOWS_SMB_DIR")
-    windows_server_password = Variable.get("WINDOWS_SERVER_PASSWORD")
+    windows_smb_dir = get_variable("WINDOWS_SMB_DIR")
+    windows_server_password = get_variable("WINDOWS_SERVER_PASSWORD")
 
     # 解析UNC路径
     unc_parts = windows_smb_dir.strip("\\").split("\\")
@@ -94,9 +95,9 @@ def download_file_from_windows_server(remote_file_name: str, local_file_name: st
 
     return local_path  # 返回完整的本地文件路径
 
-def process_ai_video(**context):
+def save_video_to_wx_client(**context):
     """
-    处理视频
+    保存视频到微信客户端侧
     """
     # 当前消息
     current_message_data = context.get('dag_run').conf["current_message"]
@@ -114,13 +115,23 @@ def process_ai_video(**context):
     video_file_path = save_wx_file(wcf_ip=source_ip, id=msg_id, save_file_path=save_dir)
     print(f"video_file_path: {video_file_path}")
 
-    # 等待3秒
-    time.sleep(3)
+    # 远程文件名, 由 wait_remote_file 任务等待文件写完
+    return {"file_path": video_file_path, "remote_file_name": os.path.basename(video_file_path)}
+
+
+def process_ai_video(**context):
+    """
+    处理视频
+    """
+    # 当前消息
+    current_message_data = context.get('dag_run').conf["current_message"]
+    msg_id = current_message_data.get('id', '')  # 消息ID
+    saved_file = context['task_instance'].xcom_pull(task_ids='save_wx_file')
 
-    # 下载视频到本地临时目录
-    remote_file_name = os.path.basename(video_file_path)  # 使用os.path.basename获取文件名
+    # 下载视频到本地临时目录, 文件已由 wait_remote_file 任务确认写完
     local_file_name = f"{msg_id}.mp4"
-    local_file_path = download_file_from_windows_server(remote_file_name=remote_file_name, local_file_name=local_file_name)
+    local_file_path = download_file_from_windows_server(remote_file_name=saved_file["remote_file_name"],
+                                                        local_file_name=local_file_name)
     print(f"视频已下载到本地: {local_file_path}")
 
     # 处理视频
@@ -147,6 +158,20 @@ dag = DAG(
 )
 
 
+save_wx_file_task = PythonOperator(
+    task_id='save_wx_file',
+    python_callable=save_video_to_wx_client,
+    provide_context=True,
+    dag=dag,
+)
+
+# 等待视频文件在Windows服务器上写完, 等待期间不占用worker
+wait_remote_file_task = WaitRemoteFileOperator(
+    task_id='wait_remote_file',
+    remote_file_name="{{ ti.xcom_pull(task_ids='save_wx_file')['remote_file_name'] }}",
+    dag=dag,
+)
+
 process_ai_video_task = PythonOperator(
     task_id='process_ai_video',
     python_callable=process_ai_video,
@@ -154,4 +179,4 @@ process_ai_video_task = PythonOperator(
     dag=dag,
 )
 
-process_ai_video_task
+save_wx_file_task >> wait_remote_file_task >> process_ai_video_task
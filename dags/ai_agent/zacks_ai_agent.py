@@ -38,16 +38,17 @@ from airflow.exceptions import AirflowException, AirflowSkipException
 
 # 自定义库导入
 from utils.wechat_channl import send_wx_msg
+from utils.room_buffer import RoomBuffer
+from utils.variable_cache import get_variable
 from utils.llm_channl import get_llm_response
 
 
 def get_sender_history_chat_msg(sender: str, room_id: str, max_count: int = 10, exclude_msg_ids: list = []) -> str:
     """
     获取发送者的历史对话消息
-    todo: 使用redis缓存，提高效率使用redis缓存，提高效率
     """
     print(f"[HISTORY] 获取历史对话消息: {sender} - {room_id}")
-    room_history = Variable.get(f'{room_id}_history', default_var=[], deserialize_json=True)
+    room_history = RoomBuffer(f'{room_id}_history').recent()
     
     # 按时间戳排序，从旧到新
     room_history.sort(key=lambda x: x.get('ts', 0))
@@ -297,7 +298,7 @@ def send_wx_message_and_update_history(**context):
     """
     回复微信消息
     """
-    model_name = Variable.get("model_name", default_var="gpt-4o-mini")
+    model_name = get_variable("model_name", default_var="gpt-4o-mini")
 
     # 获取消息数据
     message_data = context.get('dag_run').conf
@@ -312,9 +313,6 @@ def send_wx_message_and_update_history(**context):
     # 消息发送前，确认当前任务还是运行中，才发送消息
     dagrun_state = context.get('dag_run').get_state()  # 获取实时状态
     if dagrun_state == DagRunState.RUNNING:
-        # 聊天的历史消息
-        room_history = Variable.get(f'{room_id}_history', default_var=[], deserialize_json=True)
-    
         send_wx_msg(wcf_ip=source_ip, message=raw_llm_response, receiver=room_id)
         
         # 缓存聊天的历史消息    
@@ -327,8 +325,7 @@ def send_wx_message_and_update_history(**context):
             'ts': datetime.now().timestamp(),
             'is_ai_msg': True
         }
-        room_history.append(simple_message_data)
-        Variable.set(f'{room_id}_history', room_history, serialize_json=True)
+        RoomBuffer(f'{room_id}_history').append(simple_message_data)
     else:
         print(f"[CHAT] 当前任务状态: {dagrun_state}, 不发送消息")
 
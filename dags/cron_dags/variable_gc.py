@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Airflow Variable 清理DAG
+
+功能：
+1. 按key的正则规则清理长期未更新的Variable, 如每次运行产生的 {run_id}_pre_stop,
+   改用Redis之前遗留的 {room_id}_history、{room_id}_{sender}_msg_list 等
+2. 按规则输出Variable的数量和大小报告
+
+特点：
+1. 每天执行一次, 最大并发运行数为1
+2. Variable表没有修改时间, 最后修改时间取自:
+   - set_variable 写入时记录的时间(utils.variable_cache.UPDATED_AT_KEY)
+   - 本DAG每次运行时比较Variable值的指纹, 值发生变化时记为当前时间
+   首次发现的Variable从发现时开始计算保留时间
+3. 手动触发时可传 {"dry_run": true}, 只输出报告不删除
+"""
+
+# 标准库导入
+import re
+import time
+import hashlib
+from datetime import datetime, timedelta
+
+# Airflow相关导入
+from airflow import DAG
+from airflow.models import Variable
+from airflow.operators.python import PythonOperator
+from airflow.utils.session import create_session
+
+# 自定义库导入
+from utils.redis import get_redis_client
+from utils.variable_cache import UPDATED_AT_KEY, invalidate_deleted_variables
+
+
+DAG_ID = "airflow_variable_gc"
+
+# Variable值指纹的hash(key -> sha1)
+FINGERPRINT_KEY = "variable_gc:fingerprints"
+
+# 每批删除的Variable数量
+DELETE_BATCH_SIZE = 500
+
+# 清理规则: (规则名, key正则, 保留时间, 值条件)
+# 值条件为None时只按时间清理; 否则只清理值满足条件的Variable
+RETENTION_RULES = [
+    ("run_pre_stop", r".+_pre_stop$", timedelta(days=1), None),
+    ("room_history", r".+_history$", timedelta(days=7), None),
+    ("room_msg_list", r".+_msg_list$", timedelta(days=7), None),
+    # 已重新开启AI的房间禁用标记(值为false), 仍为true的标记是有效配置, 不清理
+    ("room_disable_ai_off", r".+_disable_ai$", timedelta(days=1), lambda value: not value),
+]
+
+_COMPILED_RULES = [(name, re.compile(pattern), retention, condition)
+                   for name, pattern, retention, condition in RETENTION_RULES]
+
+
+def match_rule(key):
+    """
+    返回key匹配的第一条规则, 不匹配时返回None
+    """
+    for rule in _COMPILED_RULES:
+        if rule[1].match(key):
+            return rule
+    return None
+
+
+def load_variables():
+    """
+    读取所有Variable的key和原始值(不解密)
+    :return: {key: 原始值}
+    """
+    with create_session() as session:
+        return {key: val or '' for key, val in session.query(Variable.key, Variable._val)}
+
+
+def refresh_updated_at(redis_client, variables, now):
+    """
+    比较值的指纹, 更新匹配规则的Variable的最后修改时间
+    :return: {key: 最后修改时间戳}
+    """
+    keys = [key for key in variables if match_rule(key)]
+    if not keys:
+        return {}
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hmget(FINGERPRINT_KEY, keys)
+    pipe.hmget(UPDATED_AT_KEY, keys)
+    fingerprints, updated_ats = pipe.execute()
+
+    new_fingerprints = {}
+    new_updated_ats = {}
+    result = {}
+    for key, old_fingerprint, updated_at in zip(keys, fingerprints, updated_ats):
+        fingerprint = hashlib.sha1(variables[key].encode('utf-8')).hexdigest()
+        updated_at = float(updated_at) if updated_at else None
+        if fingerprint != old_fingerprint:
+            new_fingerprints[key] = fingerprint
+            # 上次运行后值发生了变化(未经过 set_variable 写入)
+            if old_fingerprint is not None:
+                updated_at = now
+        if updated_at is None:
+            # 首次发现且没有写入记录
+            updated_at = now
+        if updated_at == now:
+            new_updated_ats[key] = now
+        result[key] = updated_at
+
+    pipe = redis_client.pipeline(transaction=False)
+    if new_fingerprints:
+        pipe.hset(FINGERPRINT_KEY, mapping=new_fingerprints)
+    if new_updated_ats:
+        pipe.hset(UPDATED_AT_KEY, mapping=new_updated_ats)
+    pipe.execute()
+    return result
+
+
+def delete_variables(redis_client, keys):
+    """
+    分批删除Variable
+    """
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        with create_session() as session:
+            session.query(Variable).filter(Variable.key.in_(batch)).delete(synchronize_session=False)
+        redis_client.hdel(FINGERPRINT_KEY, *batch)
+        invalidate_deleted_variables(batch)
+        print(f"[VARIABLE_GC] 已删除 {start + len(batch)}/{len(keys)}")
+
+
+def collect_garbage_variables(**context):
+    """
+    清理过期的Variable并输出报告
+    """
+    dag_run = context.get('dag_run')
+    conf = (dag_run.conf if dag_run else None) or {}
+    dry_run = bool(conf.get('dry_run', context['params'].get('dry_run', False)))
+    print(f"[VARIABLE_GC] dry_run: {dry_run}")
+
+    redis_client = get_redis_client()
+    now = time.time()
+    variables = load_variables()
+    updated_ats = refresh_updated_at(redis_client, variables, now)
+
+    # 按规则统计: 数量, 大小, 待清理数量, 待清理大小
+    report = {name: [0, 0, 0, 0] for name, _, _, _ in RETENTION_RULES}
+    report["(未匹配规则)"] = [0, 0, 0, 0]
+    stale_keys = []
+    for key, val in variables.items():
+        rule = match_rule(key)
+        name = rule[0] if rule else "(未匹配规则)"
+        size = len(key) + len(val)
+        report[name][0] += 1
+        report[name][1] += size
+        if not rule:
+            continue
+
+        _, _, retention, condition = rule
+        if now - updated_ats[key] <= retention.total_seconds():
+            continue
+        if condition is not None:
+            try:
+                value = Variable.get(key, deserialize_json=True)
+            except (KeyError, ValueError):
+                value = Variable.get(key, default_var=None)
+            if not condition(value):
+                continue
+        report[name][2] += 1
+        report[name][3] += size
+        stale_keys.append(key)
+
+    print(f"[VARIABLE_GC] Variable总数: {len(variables)}, "
+          f"总大小: {sum(len(key) + len(val) for key, val in variables.items()) / 1024:.1f}KB")
+    print(f"{'规则':<24}{'数量':>10}{'大小(KB)':>12}{'待清理':>10}{'待清理(KB)':>12}")
+    for name, (count, size, stale_count, stale_size) in report.items():
+        print(f"{name:<24}{count:>10}{size / 1024:>12.1f}{stale_count:>10}{stale_size / 1024:>12.1f}")
+
+    # 清除已不存在的Variable的指纹
+    gone_keys = set(redis_client.hkeys(FINGERPRINT_KEY)) - set(variables)
+    if gone_keys and not dry_run:
+        redis_client.hdel(FINGERPRINT_KEY, *gone_keys)
+
+    if dry_run:
+        print(f"[VARIABLE_GC] dry_run模式, 不删除, 待清理: {len(stale_keys)}, 示例: {stale_keys[:20]}")
+        return
+    delete_variables(redis_client, stale_keys)
+    print(f"[VARIABLE_GC] 清理完成, 删除: {len(stale_keys)}")
+
+
+# 创建DAG
+dag = DAG(
+    dag_id=DAG_ID,
+    default_args={'owner': 'claude89757'},
+    start_date=datetime(2024, 1, 1),
+    schedule_interval=timedelta(days=1),
+    max_active_runs=1,
+    dagrun_timeout=timedelta(minutes=30),
+    catchup=False,
+    params={'dry_run': False},
+    tags=['通用工具'],
+    description='清理过期的Airflow Variable',
+)
+
+variable_gc_task = PythonOperator(
+    task_id='collect_garbage_variables',
+    python_callable=collect_garbage_variables,
+    provide_context=True,
+    dag=dag
+)
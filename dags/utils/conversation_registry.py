@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dify会话ID登记表
+
+房间/用户到Dify会话ID的映射保存在Redis hash中, 替代整体读写的JSON Variable
+({wx_user_name}_conversation_infos、wechat_mp_conversation_infos):
+- 按房间/用户单独读写, 并发的DAG Run修改不同的映射时不会互相覆盖
+- 同时维护会话ID到房间/用户的反向hash, 删除会话时无需遍历
+- 可选的过期时间: 超过指定时间未使用的映射视为不存在, 由调用方创建新会话
+- 首次使用时从旧的Variable迁移一次, 已在Redis中的映射不会被旧值覆盖
+"""
+
+import time
+
+from utils.redis import get_redis_client, RedisLock
+from utils.variable_cache import get_variable
+
+
+# 迁移锁的过期时间(秒)
+MIGRATION_LOCK_SECONDS = 60
+
+
+class ConversationRegistry:
+    """一组房间/用户到Dify会话ID的映射"""
+
+    # 写入映射, 同时更新反向映射并移除旧会话ID的反向映射
+    _SET_SCRIPT = """
+    local old = redis.call('hget', KEYS[1], ARGV[1])
+    if old and old ~= ARGV[2] then
+        redis.call('hdel', KEYS[2], old)
+    end
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('hset', KEYS[2], ARGV[2], ARGV[1])
+    redis.call('zadd', KEYS[3], ARGV[3], ARGV[1])
+    return old
+    """
+
+    # 删除映射及反向映射; ARGV[1]为 field 或 conversation_id, ARGV[2] 指明类型
+    _DELETE_SCRIPT = """
+    local field, conversation_id
+    if ARGV[2] == 'field' then
+        field = ARGV[1]
+        conversation_id = redis.call('hget', KEYS[1], field)
+    else
+        conversation_id = ARGV[1]
+        field = redis.call('hget', KEYS[2], conversation_id)
+    end
+    if field then
+        redis.call('hdel', KEYS[1], field)
+        redis.call('zrem', KEYS[3], field)
+    end
+    if conversation_id then
+        redis.call('hdel', KEYS[2], conversation_id)
+    end
+    return {field or false, conversation_id or false}
+    """
+
+    # 已完成迁移的登记表(进程内), 避免每次查询Redis
+    _migrated = set()
+
+    def __init__(self, namespace, legacy_variable=None, ttl_seconds=None, redis_client=None):
+        """
+        :param namespace: 登记表名称, 如微信账号名
+        :param legacy_variable: 需要迁移的旧Variable名称, 值为 {房间/用户: 会话ID}
+        :param ttl_seconds: 映射的过期时间(秒), 按最后一次使用计算; None表示不过期
+        """
+        self.redis = redis_client or get_redis_client()
+        self.namespace = namespace
+        self.legacy_variable = legacy_variable
+        self.ttl_seconds = ttl_seconds
+        self.key = f"dify_conversations:{namespace}"
+        self.reverse_key = f"{self.key}:by_conversation"
+        self.used_key = f"{self.key}:last_used"
+        self.migrated_key = f"{self.key}:migrated"
+        self._set_script = self.redis.register_script(self._SET_SCRIPT)
+        self._delete_script = self.redis.register_script(self._DELETE_SCRIPT)
+
+    def get(self, field):
+        """
+        查询房间/用户的会话ID
+        :return: 会话ID, 不存在或已过期时返回空字符串
+        """
+        self._ensure_migrated()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self.key, field)
+        pipe.zscore(self.used_key, field)
+        conversation_id, last_used = pipe.execute()
+        if not conversation_id:
+            return ""
+
+        if self.ttl_seconds:
+            now = time.time()
+            if last_used is not None and now - last_used > self.ttl_seconds:
+                print(f"[CONVERSATION] {self.namespace} {field} 的会话 {conversation_id} 已过期")
+                self.delete(field)
+                return ""
+            self.redis.zadd(self.used_key, {field: now})
+        return conversation_id
+
+    def set(self, field, conversation_id):
+        """
+        保存房间/用户的会话ID
+        """
+        self._ensure_migrated()
+        self._set_script(keys=[self.key, self.reverse_key, self.used_key], args=[field, conversation_id, time.time()])
+
+    def delete(self, field):
+        """
+        删除房间/用户的会话映射
+        :return: 被删除的会话ID, 不存在时返回None
+        """
+        self._ensure_migrated()
+        _, conversation_id = self._delete_script(keys=[self.key, self.reverse_key, self.used_key],
+                                                 args=[field, "field"])
+        return conversation_id
+
+    def delete_conversation(self, conversation_id):
+        """
+        按会话ID删除映射
+        :return: 会话对应的房间/用户, 不存在时返回None
+        """
+        self._ensure_migrated()
+        field, _ = self._delete_script(keys=[self.key, self.reverse_key, self.used_key],
+                                       args=[conversation_id, "conversation"])
+        return field
+
+    def _ensure_migrated(self):
+        """
+        从旧Variable迁移一次; 多个任务同时首次使用时只有一个执行迁移
+        """
+        if not self.legacy_variable or self.key in self._migrated:
+            return
+        if self.redis.exists(self.migrated_key):
+            self._migrated.add(self.key)
+            return
+
+        with RedisLock(f"{self.key}:migrate", expire_seconds=MIGRATION_LOCK_SECONDS, redis_client=self.redis).lock(
+                timeout=MIGRATION_LOCK_SECONDS):
+            if not self.redis.exists(self.migrated_key):
+                legacy_infos = get_variable(self.legacy_variable, default_var={}, deserialize_json=True, ttl=0) or {}
+                # 不覆盖迁移前已写入Redis的新映射
+                existing_fields = set(self.redis.hkeys(self.key))
+                legacy_infos = {field: conversation_id for field, conversation_id in legacy_infos.items()
+                                if conversation_id and field not in existing_fields}
+                now = time.time()
+                pipe = self.redis.pipeline(transaction=True)
+                if legacy_infos:
+                    pipe.hset(self.key, mapping=legacy_infos)
+                    pipe.hset(self.reverse_key, mapping={conversation_id: field
+                                                         for field, conversation_id in legacy_infos.items()})
+                    pipe.zadd(self.used_key, {field: now for field in legacy_infos})
+                pipe.set(self.migrated_key, now)
+                pipe.execute()
+                print(f"[CONVERSATION] 从 {self.legacy_variable} 迁移会话映射, 数量: {len(legacy_infos)}")
+        self._migrated.add(self.key)
+
+
+def get_room_conversation_registry(wx_user_name):
+    """
+    个人微信账号的 房间ID -> 会话ID 登记表
+    """
+    return ConversationRegistry(wx_user_name, legacy_variable=f"{wx_user_name}_conversation_infos")
+
+
+def get_mp_conversation_registry():
+    """
+    微信公众号的 用户OpenID -> 会话ID 登记表
+    """
+    return ConversationRegistry("wechat_mp", legacy_variable="wechat_mp_conversation_infos")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+可延迟(deferrable)的Airflow算子
+
+等待Dify回复、等待远程文件写完时, 任务转为deferred状态并释放worker,
+等待由triggerer中的 utils.triggers 完成, 事件到达后才重新占用worker执行后续处理
+"""
+
+from airflow.exceptions import AirflowException
+from airflow.models import BaseOperator
+
+from utils.triggers import DifyChatTrigger, RemoteFileReadyTrigger
+from utils.variable_cache import get_variable
+
+
+def parse_smb_dir(windows_smb_dir):
+    """
+    解析UNC路径, 如 \\\\10_1_12_10\\Users\\Administrator\\Downloads
+    :return: (server_name, share_name, server_path)
+    """
+    unc_parts = windows_smb_dir.strip("\\").split("\\")
+    if len(unc_parts) < 3:
+        raise ValueError(f"无效的SMB路径格式: {windows_smb_dir}。正确格式示例: \\\\server\\share\\path")
+    # 将服务器名称中的下划线替换为点号
+    return unc_parts[0].replace("_", "."), unc_parts[1], "/".join(unc_parts[2:])
+
+
+class DifyChatOperator(BaseOperator):
+    """
+    通过Dify的流式接口生成回复, 等待期间不占用worker
+
+    指定 cancel_buffer_key 和 cancel_msg_id 时, 房间有更新的消息则中断生成并停止流程
+    返回(XCom): {"answer": 完整回复, "metadata": message_end中的元数据}
+    """
+
+    template_fields = ("query", "user_id", "conversation_id", "inputs", "cancel_buffer_key", "cancel_msg_id")
+
+    def __init__(self, query, user_id, conversation_id=None, inputs=None, cancel_buffer_key=None, cancel_msg_id=None,
+                 api_key_variable="DIFY_API_KEY", base_url_variable="DIFY_BASE_URL", timeout_seconds=600, **kwargs):
+        super().__init__(**kwargs)
+        self.query = query
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.inputs = inputs
+        self.cancel_buffer_key = cancel_buffer_key
+        self.cancel_msg_id = cancel_msg_id
+        self.api_key_variable = api_key_variable
+        self.base_url_variable = base_url_variable
+        self.timeout_seconds = timeout_seconds
+
+    def execute(self, context):
+        payload = {
+            "query": self.query,
+            "inputs": self.inputs or {},
+            "response_mode": "streaming",
+            "user": self.user_id,
+        }
+        if self.conversation_id and self.conversation_id != "None":
+            payload["conversation_id"] = self.conversation_id
+
+        print(f"[DIFY] 提交问题, 用户: {self.user_id}, 会话ID: {payload.get('conversation_id')}")
+        self.defer(
+            trigger=DifyChatTrigger(
+                base_url_variable=self.base_url_variable,
+                api_key_variable=self.api_key_variable,
+                payload=payload,
+                cancel_buffer_key=self.cancel_buffer_key,
+                cancel_msg_id=self.cancel_msg_id,
+                timeout_seconds=self.timeout_seconds,
+            ),
+            method_name="execute_complete",
+        )
+
+    def execute_complete(self, context, event=None):
+        status = event["status"]
+        if status == "cancelled":
+            print(f"[PRE_STOP] 最新消息id不一致，已停止Dify生成, task_id: {event.get('task_id')}")
+            raise AirflowException("检测到提前停止信号，停止流程执行")
+        if status != "success":
+            raise AirflowException(f"Dify生成回复失败({status}): {event.get('message')}")
+
+        print(f"full_answer: {event['answer']}")
+        print(f"metadata: {event['metadata']}")
+        return {"answer": event["answer"], "metadata": event["metadata"]}
+
+
+class WaitRemoteFileOperator(BaseOperator):
+    """
+    等待Windows服务器(WINDOWS_SMB_DIR)上的文件写完, 替代固定的sleep和下载重试
+    返回(XCom): 远程文件的SMB路径
+    """
+
+    template_fields = ("remote_file_name",)
+
+    def __init__(self, remote_file_name, poll_interval=1.0, timeout_seconds=60, **kwargs):
+        super().__init__(**kwargs)
+        self.remote_file_name = remote_file_name
+        self.poll_interval = poll_interval
+        self.timeout_seconds = timeout_seconds
+
+    def execute(self, context):
+        server_name, share_name, server_path = parse_smb_dir(get_variable("WINDOWS_SMB_DIR"))
+        remote_path = f"//{server_name}/{share_name}/{server_path}/{self.remote_file_name}"
+        print(f"[SMB] 等待文件写完: {remote_path}")
+        self.defer(
+            trigger=RemoteFileReadyTrigger(
+                server=server_name,
+                username="Administrator",
+                password_variable="WINDOWS_SERVER_PASSWORD",
+                remote_path=remote_path,
+                poll_interval=self.poll_interval,
+                timeout_seconds=self.timeout_seconds,
+            ),
+            method_name="execute_complete",
+        )
+
+    def execute_complete(self, context, event=None):
+        if event["status"] != "ready":
+            raise AirflowException(f"等待文件超时: {event['remote_path']}")
+        print(f"[SMB] 文件已就绪: {event['remote_path']}, 大小: {event['size']}")
+        return event["remote_path"]
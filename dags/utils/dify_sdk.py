@@ -4,9 +4,15 @@
 
 # 第三方库导入
 import requests
-from airflow.models import Variable
 import json
 import os
+import socket
+
+from utils.conversation_registry import get_room_conversation_registry, get_mp_conversation_registry
+
+
+class ChatMessageCancelled(Exception):
+    """流式回复被取消(如已被新消息取代)"""
 
 
 class DifyAgent:
@@ -78,10 +84,8 @@ class DifyAgent:
             2. 如果缓存中有会话ID,则检查该会话是否仍然有效
             3. 如果会话无效或不存在,则返回空字符串,由调用方创建新会话
         """
-        conversation_infos = Variable.get(f"{user_id}_conversation_infos", default_var={}, deserialize_json=True)
-        
         # 检查是否存在会话ID
-        conversation_id = conversation_infos.get(room_id)
+        conversation_id = get_room_conversation_registry(user_id).get(room_id)
         if conversation_id:
             print(f"{user_id} 使用已存在的会话ID: {conversation_id}")
             # 尝试获取会话列表
@@ -117,10 +121,8 @@ class DifyAgent:
             2. 如果缓存中有会话ID,则检查该会话是否仍然有效
             3. 如果会话无效或不存在,则返回空字符串,由调用方创建新会话
         """
-        conversation_infos = Variable.get("wechat_mp_conversation_infos", default_var={}, deserialize_json=True)
-        
         # 检查是否存在会话ID
-        conversation_id = conversation_infos.get(user_id)
+        conversation_id = get_mp_conversation_registry().get(user_id)
         if conversation_id:
             print(f"用户 {user_id} 使用已存在的会话ID: {conversation_id}")
             # 尝试获取会话列表
@@ -251,14 +253,8 @@ class DifyAgent:
         
         response = requests.delete(url, headers=self.headers, json=payload)
         if response.status_code == 200:
-            # 从本地存储中删除会话ID映射
-            conversation_infos = Variable.get(f"{user_id}_conversation_infos", default_var={}, deserialize_json=True)
-            # 找到并删除对应的room_id
-            for room_id, conv_id in list(conversation_infos.items()):
-                if conv_id == conversation_id:
-                    del conversation_infos[room_id]
-                    Variable.set(f"{user_id}_conversation_infos", conversation_infos, serialize_json=True)
-                    break
+            # 从会话登记表中删除会话ID映射
+            get_room_conversation_registry(user_id).delete_conversation(conversation_id)
             return response.json()
         else:
             raise Exception(f"删除会话失败: {response.text}")
@@ -297,20 +293,25 @@ class DifyAgent:
             error_msg = f"状态码: {response.status_code}, 响应内容: {response.text}"
             raise Exception(f"创建消息反馈失败: {error_msg}")
 
-    def create_chat_message_stream(self, query, user_id, conversation_id="", inputs=None):
+    def iter_chat_message_stream(self, query, user_id, conversation_id="", inputs=None, cancel_token=None,
+                                 metadata=None):
         """
-        创建聊天消息并以流式方式返回结果
+        创建聊天消息, 逐段返回Dify流式生成的回答文本
         
         Args:
             query (str): 用户输入内容
             user_id (str): 用户标识
             conversation_id (str, optional): 会话ID
             inputs (dict, optional): 输入参数
+            cancel_token (optional): 取消标记, 需提供 is_set() 和 add_callback(callback),
+                如 RoomBuffer.watch_superseded 的返回值
+            metadata (dict, optional): 流式响应结束后写入元数据, 包含message_id, conversation_id, task_id等信息
             
-        Returns:
-            tuple: (完整回答文本, 元数据字典)
-                - 完整回答文本: AI助手的完整回答内容
-                - 元数据字典: 包含message_id, conversation_id, task_id等信息
+        Yields:
+            str: 回答文本片段
+
+        Raises:
+            ChatMessageCancelled: 流式响应过程中被取消, 已调用 stop_chat_message 停止Dify端的生成
         """
         if inputs is None:
             inputs = {}
@@ -325,8 +326,8 @@ class DifyAgent:
             "auto_generate_name": False
         }
 
-        full_answer = ""
-        metadata = {}
+        if metadata is None:
+            metadata = {}
         task_id = None
         workflow_metadata = {}
         
@@ -335,84 +336,142 @@ class DifyAgent:
             if response.status_code != 200:
                 raise Exception(f"创建消息失败: {response.text}")
             
-            for line in response.iter_lines():
-                if line:
-                    # 移除 "data: " 前缀并解析 JSON
-                    line = line.decode('utf-8')
-                    if not line.startswith("data: "):
-                        continue
+            if cancel_token is not None:
+                # 取消时立即断开连接, 中断阻塞中的SSE读取
+                cancel_token.add_callback(lambda: self._abort_stream(response))
+
+            try:
+                for line in response.iter_lines():
+                    if cancel_token is not None and cancel_token.is_set():
+                        break
+                    if line:
+                        # 移除 "data: " 前缀并解析 JSON
+                        line = line.decode('utf-8')
+                        if not line.startswith("data: "):
+                            continue
                     
-                    data = json.loads(line[6:])  # 跳过 "data: " 前缀
-                    print(f"data: {data}")
-                    event = data.get("event")
+                        data = json.loads(line[6:])  # 跳过 "data: " 前缀
+                        print(f"data: {data}")
+                        event = data.get("event")
                     
-                    # 保存task_id和message_id
-                    if "task_id" in data:
-                        task_id = data["task_id"]
-                    if "message_id" in data:
-                        message_id = data["message_id"]
+                        # 保存task_id和message_id
+                        if "task_id" in data:
+                            task_id = data["task_id"]
+                        if "message_id" in data:
+                            message_id = data["message_id"]
 
-                    # 处理不同类型的事件
-                    if event == "message":
-                        # 累积回答文本
-                        answer_chunk = data.get("answer", "")
-                        full_answer += answer_chunk
+                        # 处理不同类型的事件
+                        if event == "message":
+                            # 返回回答文本片段
+                            answer_chunk = data.get("answer", "")
+                            if answer_chunk:
+                                yield answer_chunk
                         
-                    elif event == "message_end":
-                        # 保存元数据
-                        metadata = {
-                            "message_id": data.get("message_id"),
-                            "conversation_id": data.get("conversation_id"),
-                            "metadata": data.get("metadata"),
-                            "usage": data.get("usage"),
-                            "retriever_resources": data.get("retriever_resources"),
-                            "task_id": task_id,  # 添加task_id到元数据中
-                            "workflow_metadata": workflow_metadata  # 添加workflow相关信息
-                        }
+                        elif event == "message_end":
+                            # 保存元数据
+                            metadata.update({
+                                "message_id": data.get("message_id"),
+                                "conversation_id": data.get("conversation_id"),
+                                "metadata": data.get("metadata"),
+                                "usage": data.get("usage"),
+                                "retriever_resources": data.get("retriever_resources"),
+                                "task_id": task_id,  # 添加task_id到元数据中
+                                "workflow_metadata": workflow_metadata  # 添加workflow相关信息
+                            })
                         
-                    elif event == "workflow_started":
-                        workflow_metadata["workflow_id"] = data.get("workflow_run_id")
-                        workflow_metadata["started_at"] = data.get("data", {}).get("created_at")
+                        elif event == "workflow_started":
+                            workflow_metadata["workflow_id"] = data.get("workflow_run_id")
+                            workflow_metadata["started_at"] = data.get("data", {}).get("created_at")
                         
-                    elif event == "workflow_finished":
-                        workflow_data = data.get("data", {})
-                        workflow_metadata.update({
-                            "status": workflow_data.get("status"),
-                            "elapsed_time": workflow_data.get("elapsed_time"),
-                            "total_tokens": workflow_data.get("total_tokens"),
-                            "total_steps": workflow_data.get("total_steps"),
-                            "finished_at": workflow_data.get("finished_at")
-                        })
+                        elif event == "workflow_finished":
+                            workflow_data = data.get("data", {})
+                            workflow_metadata.update({
+                                "status": workflow_data.get("status"),
+                                "elapsed_time": workflow_data.get("elapsed_time"),
+                                "total_tokens": workflow_data.get("total_tokens"),
+                                "total_steps": workflow_data.get("total_steps"),
+                                "finished_at": workflow_data.get("finished_at")
+                            })
                         
-                    elif event == "node_started":
-                        node_data = data.get("data", {})
-                        if "nodes" not in workflow_metadata:
-                            workflow_metadata["nodes"] = []
-                        workflow_metadata["nodes"].append({
-                            "node_id": node_data.get("node_id"),
-                            "node_type": node_data.get("node_type"),
-                            "title": node_data.get("title"),
-                            "status": "started",
-                            "started_at": node_data.get("created_at")
-                        })
+                        elif event == "node_started":
+                            node_data = data.get("data", {})
+                            if "nodes" not in workflow_metadata:
+                                workflow_metadata["nodes"] = []
+                            workflow_metadata["nodes"].append({
+                                "node_id": node_data.get("node_id"),
+                                "node_type": node_data.get("node_type"),
+                                "title": node_data.get("title"),
+                                "status": "started",
+                                "started_at": node_data.get("created_at")
+                            })
                         
-                    elif event == "node_finished":
-                        node_data = data.get("data", {})
-                        for node in workflow_metadata.get("nodes", []):
-                            if node.get("node_id") == node_data.get("node_id"):
-                                node.update({
-                                    "status": node_data.get("status"),
-                                    "elapsed_time": node_data.get("elapsed_time"),
-                                    "execution_metadata": node_data.get("execution_metadata"),
-                                    "finished_at": node_data.get("created_at")
-                                })
+                        elif event == "node_finished":
+                            node_data = data.get("data", {})
+                            for node in workflow_metadata.get("nodes", []):
+                                if node.get("node_id") == node_data.get("node_id"):
+                                    node.update({
+                                        "status": node_data.get("status"),
+                                        "elapsed_time": node_data.get("elapsed_time"),
+                                        "execution_metadata": node_data.get("execution_metadata"),
+                                        "finished_at": node_data.get("created_at")
+                                    })
                                 
-                    elif event == "error":
-                        error_msg = data.get("message", "未知错误")
-                        raise Exception(f"流式响应错误: {error_msg}")
+                        elif event == "error":
+                            error_msg = data.get("message", "未知错误")
+                            raise Exception(f"流式响应错误: {error_msg}")
+            except Exception:
+                # 取消时断开连接会使读取抛出异常
+                if cancel_token is None or not cancel_token.is_set():
+                    raise
+
+        if cancel_token is not None and cancel_token.is_set():
+            print(f"流式响应已取消, task_id: {task_id}")
+            if task_id:
+                try:
+                    self.stop_chat_message(task_id, user_id)
+                except Exception as error:
+                    print(f"停止流式响应失败: {error}")
+            raise ChatMessageCancelled(f"流式响应已取消, task_id: {task_id}")
+
+    def create_chat_message_stream(self, query, user_id, conversation_id="", inputs=None, cancel_token=None):
+        """
+        创建聊天消息并以流式方式返回结果
         
+        Args:
+            query (str): 用户输入内容
+            user_id (str): 用户标识
+            conversation_id (str, optional): 会话ID
+            inputs (dict, optional): 输入参数
+            cancel_token (optional): 取消标记, 见 iter_chat_message_stream
+            
+        Returns:
+            tuple: (完整回答文本, 元数据字典)
+                - 完整回答文本: AI助手的完整回答内容
+                - 元数据字典: 包含message_id, conversation_id, task_id等信息
+
+        Raises:
+            ChatMessageCancelled: 流式响应过程中被取消, 已调用 stop_chat_message 停止Dify端的生成
+        """
+        metadata = {}
+        full_answer = "".join(self.iter_chat_message_stream(query, user_id, conversation_id=conversation_id,
+                                                            inputs=inputs, cancel_token=cancel_token,
+                                                            metadata=metadata))
         return full_answer, metadata
 
+    @staticmethod
+    def _abort_stream(response):
+        """
+        断开流式响应的连接; 只close不一定能唤醒阻塞在读取上的线程, 先shutdown底层socket
+        """
+        try:
+            connection = getattr(response.raw, "_connection", None)
+            sock = getattr(connection, "sock", None)
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        response.close()
+
     def stop_chat_message(self, task_id, user_id):
         """
         停止流式响应
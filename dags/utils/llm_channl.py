@@ -4,7 +4,7 @@
 import os
 from anthropic import Anthropic
 from openai import OpenAI
-from airflow.models import Variable
+from utils.variable_cache import get_variable
 from contextlib import contextmanager
 import base64
 
@@ -27,7 +27,7 @@ def proxy_context():
     
     try:
         # 设置新代理
-        proxy_url = Variable.get("PROXY_URL", default_var="")
+        proxy_url = get_variable("PROXY_URL", default_var="")
         if proxy_url:
             os.environ['HTTPS_PROXY'] = proxy_url
             os.environ['HTTP_PROXY'] = proxy_url
@@ -62,9 +62,9 @@ def get_llm_response(user_question: str, model_name: str = None, system_prompt:
     """
     try:
         if not model_name:
-            model_name = Variable.get("model_name", default_var="gpt-4o-mini")
+            model_name = get_variable("model_name", default_var="gpt-4o-mini")
         if not system_prompt:
-            system_prompt = Variable.get("system_prompt", default_var="你是一个友好的AI助手，请用简短的中文回答问题。")
+            system_prompt = get_variable("system_prompt", default_var="你是一个友好的AI助手，请用简短的中文回答问题。")
         
         print(f"[AI] 使用模型: {model_name}")
         print(f"[AI] 系统提示: {system_prompt}")
@@ -84,7 +84,7 @@ def get_llm_response(user_question: str, model_name: str = None, system_prompt:
 
         with proxy_context():
             if model_name.startswith("gpt-"):
-                api_key = Variable.get("OPENAI_API_KEY")
+                api_key = get_variable("OPENAI_API_KEY")
                 os.environ['OPENAI_API_KEY'] = api_key
                 
                 client = OpenAI()
@@ -94,7 +94,7 @@ def get_llm_response(user_question: str, model_name: str = None, system_prompt:
                 ai_response = response.choices[0].message.content.strip()
                 
             elif model_name.startswith("claude-"):            
-                api_key = Variable.get("CLAUDE_API_KEY")
+                api_key = get_variable("CLAUDE_API_KEY")
                 client = Anthropic(api_key=api_key)
                 
                 # 剔除模型不支持的参数
@@ -132,9 +132,9 @@ def get_llm_response_with_image(user_question: str, image_path: str, model_name:
     """
     try:
         if not model_name:
-            model_name = Variable.get("model_name", default_var="gpt-4o-2024-11-20")
+            model_name = get_variable("model_name", default_var="gpt-4o-2024-11-20")
         if not system_prompt:
-            system_prompt = Variable.get("system_prompt", default_var="你是一个友好的AI助手，请用简短的中文回答关于图片的问题。")
+            system_prompt = get_variable("system_prompt", default_var="你是一个友好的AI助手，请用简短的中文回答关于图片的问题。")
             
         print(f"[AI] 使用模型: {model_name}")
         print(f"[AI] 系统提示: {system_prompt}")
@@ -147,7 +147,7 @@ def get_llm_response_with_image(user_question: str, image_path: str, model_name:
             
         with proxy_context():
             if model_name.startswith("gpt-"):
-                api_key = Variable.get("OPENAI_API_KEY")
+                api_key = get_variable("OPENAI_API_KEY")
                 os.environ['OPENAI_API_KEY'] = api_key
                 client = OpenAI()
                 
@@ -192,7 +192,7 @@ def get_llm_response_with_image(user_question: str, image_path: str, model_name:
                 ai_response = response.choices[0].message.content.strip()
                 
             elif model_name.startswith("claude-"):
-                api_key = Variable.get("CLAUDE_API_KEY")
+                api_key = get_variable("CLAUDE_API_KEY")
                 client = Anthropic(api_key=api_key)
                 
                 # 构建消息
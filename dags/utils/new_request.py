@@ -8,7 +8,7 @@
 """
 
 import requests
-from airflow.models.variable import Variable
+from utils.variable_cache import get_variable
 
 
 def make_request(method, url, use_proxy=True, **kwargs):
@@ -21,7 +21,7 @@ def make_request(method, url, use_proxy=True, **kwargs):
         **kwargs: 传递给 requests 的其他参数
     """
     if use_proxy:
-        system_proxy = Variable.get("PROXY_URL", default_var="")
+        system_proxy = get_variable("PROXY_URL", default_var="")
         if system_proxy:
             kwargs['proxies'] = {"https": system_proxy}
     
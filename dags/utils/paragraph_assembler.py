@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+段落拼装
+
+把流式生成的文本片段拼成完整的段落, 每遇到一个段落分隔符(空行, 或模型输出的转义字符 "\\n\\n")就返回之前的段落,
+与按完整回复 re.split(r'\\\\n\\\\n|\\n\\n', response) 分段的结果一致, 分隔符被拆到两个片段中时也能识别
+"""
+
+import re
+
+
+class ParagraphAssembler:
+    """段落拼装器"""
+
+    SEPARATOR = re.compile(r'\\n\\n|\n\n')
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, chunk):
+        """
+        追加文本片段
+        :return: 新的完整段落列表
+        """
+        self._buffer += chunk
+        parts = self.SEPARATOR.split(self._buffer)
+        # 最后一部分可能还没结束(或以不完整的分隔符结尾), 保留到下一个片段
+        self._buffer = parts.pop()
+        return self._clean(parts)
+
+    def flush(self):
+        """
+        文本结束, 返回剩余的段落
+        """
+        parts, self._buffer = [self._buffer], ""
+        return self._clean(parts)
+
+    @classmethod
+    def split(cls, text):
+        """
+        把完整的文本分成段落
+        """
+        assembler = cls()
+        return assembler.feed(text) + assembler.flush()
+
+    @staticmethod
+    def _clean(parts):
+        # 模型输出的转义换行符还原为换行, 跳过空段落
+        paragraphs = [part.replace('\\n', '\n') for part in parts]
+        return [paragraph for paragraph in paragraphs if paragraph.strip()]
@@ -1,50 +1,149 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import time
+import uuid
+import threading
 from contextlib import contextmanager
-from redis import Redis
+from redis import Redis, ConnectionPool
+
+# Airflow 使用的Redis服务
+REDIS_HOST = os.getenv("AIRFLOW_REDIS_HOST", "airflow_redis")
+REDIS_PORT = int(os.getenv("AIRFLOW_REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("AIRFLOW_REDIS_DB", "0"))
+
+# 进程内共享的连接池, 同一个worker进程中的任务复用连接
+_redis_pool = None
+
+
+def get_redis_client() -> Redis:
+    """
+    获取共享连接池的Redis客户端
+    """
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True,
+                                     socket_connect_timeout=5, health_check_interval=30)
+    return Redis(connection_pool=_redis_pool)
+
+
+def get_async_redis_client():
+    """
+    获取asyncio的Redis客户端, 供triggerer中的Trigger使用; 调用方用完后需关闭
+    """
+    from redis.asyncio import Redis as AsyncRedis
+    return AsyncRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True, socket_connect_timeout=5)
+
 
 class RedisLock:
-    """Redis分布式锁实现"""
-    
-    def __init__(self, lock_name, expire_seconds=60):
+    """
+    Redis分布式锁
+
+    - 使用共享连接池, 不再为每个锁创建连接
+    - 每次获取锁生成唯一token, 释放和续期时校验token(Lua脚本), 锁过期后被他人持有时不会误删
+    - 等待方阻塞在唤醒列表上(BLPOP), 持有方释放时推送唤醒信号, 不再每100ms轮询
+    - 长任务可调用 extend 续期, 或开启 auto_renew 由后台线程自动续期
+    """
+
+    # 校验token后删除锁, 并唤醒一个等待方
+    _RELEASE_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        redis.call('del', KEYS[1])
+        redis.call('del', KEYS[2])
+        redis.call('rpush', KEYS[2], '1')
+        redis.call('pexpire', KEYS[2], ARGV[2])
+        return 1
+    end
+    return 0
+    """
+
+    # 校验token后续期
+    _EXTEND_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(self, lock_name, expire_seconds=60, auto_renew=False, redis_client=None):
         """
         初始化Redis锁
         :param lock_name: 锁的名称
         :param expire_seconds: 锁的超时时间(秒)
+        :param auto_renew: 是否在持有期间自动续期, 适合执行时间不确定的长任务
         """
-        self.redis = Redis(host='airflow_redis', port=6379, decode_responses=True)
+        self.redis = redis_client or get_redis_client()
         self.lock_name = f"lock:{lock_name}"
+        self.wakeup_name = f"{self.lock_name}:wakeup"
         self.expire_seconds = expire_seconds
-        
+        self.auto_renew = auto_renew
+        self.token = None
+        self._renew_stop = None
+        self._release_script = self.redis.register_script(self._RELEASE_SCRIPT)
+        self._extend_script = self.redis.register_script(self._EXTEND_SCRIPT)
+
     def acquire(self, blocking=True, timeout=None) -> bool:
         """
         获取锁
         :param blocking: 是否阻塞等待
-        :param timeout: 等待超时时间(秒)
+        :param timeout: 等待超时时间(秒), None表示一直等待
         :return: 是否成功获取锁
         """
-        start_time = time.time()
-        
+        token = uuid.uuid4().hex
+        deadline = None if timeout is None else time.time() + timeout
+
         while True:
             # 尝试获取锁
-            if self.redis.set(self.lock_name, "1", nx=True, ex=self.expire_seconds):
+            if self.redis.set(self.lock_name, token, nx=True, px=int(self.expire_seconds * 1000)):
+                self.token = token
+                if self.auto_renew:
+                    self._start_renewal()
                 return True
-                
+
             if not blocking:
                 return False
-                
-            if timeout is not None:
-                if time.time() - start_time >= timeout:
+
+            # 等待唤醒信号, 最长等到当前持有者的锁过期(持有者异常退出时不会发出信号)
+            wait_seconds = self._remaining_lease()
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
                     return False
-            
-            time.sleep(0.1)  # 避免频繁请求Redis
-            
-    def release(self):
-        """释放锁"""
-        self.redis.delete(self.lock_name)
-        
+                wait_seconds = min(wait_seconds, remaining)
+            self.redis.blpop([self.wakeup_name], timeout=max(wait_seconds, 0.01))
+
+    def release(self) -> bool:
+        """
+        释放锁, 只释放自己持有的锁
+        :return: 锁是否由本次调用释放; 锁已过期或被他人持有时返回False
+        """
+        if self.token is None:
+            return False
+        self._stop_renewal()
+        token, self.token = self.token, None
+        released = bool(self._release_script(keys=[self.lock_name, self.wakeup_name],
+                                             args=[token, int(self.expire_seconds * 1000)]))
+        if not released:
+            print(f"[REDIS_LOCK] {self.lock_name} 释放时已过期或被其他任务持有")
+        return released
+
+    def extend(self, expire_seconds=None) -> bool:
+        """
+        续期, 把锁的剩余时间重置为 expire_seconds
+        :return: 是否续期成功; 锁已丢失时返回False
+        """
+        if self.token is None:
+            return False
+        expire_seconds = expire_seconds or self.expire_seconds
+        return bool(self._extend_script(keys=[self.lock_name], args=[self.token, int(expire_seconds * 1000)]))
+
+    def owned(self) -> bool:
+        """
+        锁是否仍由自己持有
+        """
+        return self.token is not None and self.redis.get(self.lock_name) == self.token
+
     @contextmanager
     def lock(self, blocking=True, timeout=None):
         """
@@ -52,14 +151,41 @@ class RedisLock:
         :param blocking: 是否阻塞等待
         :param timeout: 等待超时时间(秒)
         """
+        if not self.acquire(blocking, timeout):
+            raise TimeoutError(f"无法获取锁: {self.lock_name}")
         try:
-            if self.acquire(blocking, timeout):
-                yield self
-            else:
-                raise TimeoutError("无法获取锁")
+            yield self
         finally:
             self.release()
 
+    def _remaining_lease(self) -> float:
+        pttl = self.redis.pttl(self.lock_name)
+        # -2: 锁已不存在, -1: 锁没有过期时间
+        if pttl == -2:
+            return 0.01
+        if pttl == -1:
+            return self.expire_seconds
+        return pttl / 1000
+
+    def _start_renewal(self):
+        stop = threading.Event()
+        token = self.token
+        interval = max(self.expire_seconds / 3, 0.1)
+
+        def renew():
+            while not stop.wait(interval):
+                if self.token != token or not self.extend():
+                    print(f"[REDIS_LOCK] {self.lock_name} 续期失败, 锁已丢失")
+                    return
+
+        self._renew_stop = stop
+        threading.Thread(target=renew, name=f"redis-lock-renew:{self.lock_name}", daemon=True).start()
+
+    def _stop_renewal(self):
+        if self._renew_stop is not None:
+            self._renew_stop.set()
+            self._renew_stop = None
+
 
 # 使用示例:
 """
@@ -76,5 +202,10 @@ try:
         pass
 finally:
     lock.release()
+
+# 方式3: 长任务自动续期
+with RedisLock("my_lock", expire_seconds=30, auto_renew=True).lock(timeout=10):
+    # 执行时间可能超过30秒的代码
+    pass
 """
 
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+房间消息缓冲
+
+按房间(或房间+发送者)缓存最近的消息, 替代 {wx_user_name}_{room_id}_msg_list 等 Variable:
+- 消息保存在Redis list中, 追加和裁剪在同一个Lua脚本中完成, 并发的DAG Run不会互相覆盖
+- 按消息ID去重, 任务重试时重复追加同一条消息不会产生重复记录, 也不会通知处理中的任务
+- 最新消息ID单独保存, 提前停止检查只需一次GET
+- 已回复标记保存在有序集合中, 标记时不需要重写整个列表
+- 最新消息ID变化时通过pub/sub通知, 处理中的任务订阅后可立即得知已被更新的消息取代
+"""
+
+import json
+import time
+import threading
+
+from utils.redis import get_redis_client
+
+
+class RoomBuffer:
+    """Redis房间消息缓冲"""
+
+    # 追加ID未出现过的消息(没有ID的消息直接追加), 返回追加的条数; 有追加时更新最新消息ID并通知
+    _APPEND_SCRIPT = """
+    local max_len = tonumber(ARGV[1])
+    local ttl = tonumber(ARGV[2])
+    local added = 0
+    local latest_id = nil
+    for i = 5, #ARGV, 2 do
+        if ARGV[i] == '' or redis.call('zadd', KEYS[4], 'NX', ARGV[3], ARGV[i]) == 1 then
+            redis.call('rpush', KEYS[1], ARGV[i + 1])
+            added = added + 1
+            latest_id = ARGV[i]
+        end
+    end
+    if added == 0 then
+        return 0
+    end
+    redis.call('ltrim', KEYS[1], -max_len, -1)
+    redis.call('zremrangebyrank', KEYS[4], 0, -(max_len * 2) - 1)
+    redis.call('set', KEYS[2], latest_id)
+    for i = 1, 4 do
+        redis.call('expire', KEYS[i], ttl)
+    end
+    redis.call('publish', ARGV[4], latest_id)
+    return added
+    """
+
+    def __init__(self, buffer_key, max_len=100, ttl_seconds=7 * 24 * 3600, redis_client=None):
+        """
+        :param buffer_key: 缓冲的名称, 如 f"{wx_user_name}_{room_id}"
+        :param max_len: 保留的最近消息条数
+        :param ttl_seconds: 房间没有新消息时缓冲的过期时间(秒)
+        """
+        self.redis = redis_client or get_redis_client()
+        self.key = f"room_buffer:{buffer_key}"
+        self.latest_key = f"{self.key}:latest"
+        self.replied_key = f"{self.key}:replied"
+        self.ids_key = f"{self.key}:ids"
+        self.latest_channel = f"{self.key}:latest_changed"
+        self.max_len = max_len
+        self.ttl_seconds = ttl_seconds
+        self._append_script = self.redis.register_script(self._APPEND_SCRIPT)
+
+    def append(self, messages):
+        """
+        追加消息(按接收顺序), 只保留最近 max_len 条, 并记录最新消息ID; 已追加过的消息ID会被跳过
+        :param messages: 单条消息或消息列表
+        :return: 实际追加的条数
+        """
+        if isinstance(messages, dict):
+            messages = [messages]
+        if not messages:
+            return 0
+        args = [self.max_len, int(self.ttl_seconds), time.time(), self.latest_channel]
+        for msg in messages:
+            args.extend([str(msg.get('id', '')), json.dumps(msg, ensure_ascii=False)])
+        return self._append_script(keys=[self.key, self.latest_key, self.replied_key, self.ids_key], args=args)
+
+    def latest_id(self):
+        """
+        最新消息的ID, 没有消息时返回None
+        """
+        return self.redis.get(self.latest_key)
+
+    def is_latest(self, msg_id):
+        """
+        判断消息是否仍是房间中的最新消息
+        """
+        return self.latest_id() == str(msg_id)
+
+    def watch_superseded(self, msg_id):
+        """
+        订阅最新消息的变化, 有新消息到达时标记 msg_id 已被取代
+        :return: SupersededWatcher, 用完后需调用 stop(), 或使用 with 语句
+        """
+        return SupersededWatcher(self, msg_id)
+
+    def recent(self, count=None):
+        """
+        最近的消息(从旧到新), 已回复的消息带有 is_reply=True
+        :param count: 返回的条数, 默认返回全部
+        """
+        start = -count if count else 0
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lrange(self.key, start, -1)
+        pipe.zrange(self.replied_key, 0, -1)
+        raw_messages, replied_ids = pipe.execute()
+        replied_ids = set(replied_ids)
+        messages = []
+        for raw in raw_messages:
+            msg = json.loads(raw)
+            if str(msg.get('id', '')) in replied_ids:
+                msg['is_reply'] = True
+            messages.append(msg)
+        return messages
+
+    def unreplied(self, count=10):
+        """
+        最近 count 条消息中尚未回复的消息
+        """
+        return [msg for msg in self.recent(count) if not msg.get('is_reply')]
+
+    def mark_replied(self, msg_ids):
+        """
+        标记消息已回复
+        """
+        if not msg_ids:
+            return
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zadd(self.replied_key, {str(msg_id): now for msg_id in msg_ids})
+        # 已回复标记只需覆盖缓冲中的消息, 多保留一倍避免刚被裁剪的消息重新变成未回复
+        pipe.zremrangebyrank(self.replied_key, 0, -(self.max_len * 2) - 1)
+        pipe.expire(self.replied_key, int(self.ttl_seconds))
+        pipe.execute()
+
+    def clear(self):
+        """
+        清空缓冲
+        """
+        self.redis.delete(self.key, self.latest_key, self.replied_key, self.ids_key)
+
+
+class SupersededWatcher:
+    """
+    监听房间最新消息, 当前消息被更新的消息取代时:
+    - is_set() 返回True, 检查时不需要访问Redis
+    - 依次调用通过 add_callback 注册的回调, 如中断进行中的Dify流式请求
+    """
+
+    def __init__(self, room_buffer, msg_id):
+        self.msg_id = str(msg_id)
+        self._superseded = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+        self._pubsub = room_buffer.redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{room_buffer.latest_channel: self._on_message})
+        # 读取订阅确认后再检查一次, 订阅生效前到达的新消息不会漏掉
+        self._pubsub.get_message(timeout=1.0)
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        if not room_buffer.is_latest(msg_id):
+            self._mark_superseded()
+
+    def is_set(self):
+        return self._superseded.is_set()
+
+    def wait(self, timeout):
+        """
+        等待最多 timeout 秒
+        :return: 等待期间是否被取代
+        """
+        return self._superseded.wait(timeout)
+
+    def add_callback(self, callback):
+        """
+        注册被取代时的回调; 已被取代时立即调用
+        """
+        with self._lock:
+            if not self._superseded.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def stop(self):
+        """
+        停止监听, 释放订阅连接
+        """
+        self._thread.stop()
+        self._thread.join(timeout=2)
+        self._pubsub.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _on_message(self, message):
+        if message.get('data') != self.msg_id:
+            self._mark_superseded()
+
+    def _mark_superseded(self):
+        with self._lock:
+            if self._superseded.is_set():
+                return
+            self._superseded.set()
+            callbacks, self._callbacks = self._callbacks, []
+        print(f"[PRE_STOP] 消息 {self.msg_id} 已被新消息取代")
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    @staticmethod
+    def _run_callback(callback):
+        try:
+            callback()
+        except Exception as error:
+            print(f"[PRE_STOP] 执行取消回调失败: {error}")
+
+
+# 使用示例:
+"""
+buffer = RoomBuffer(f"{wx_user_name}_{room_id}")
+buffer.append(text_messages)
+if not buffer.is_latest(current_message['id']):
+    raise AirflowException("检测到提前停止信号，停止流程执行")
+up_for_reply_msgs = buffer.unreplied(10)
+buffer.mark_replied([msg['id'] for msg in up_for_reply_msgs])
+
+# 被新消息取代时中断Dify流式请求
+with buffer.watch_superseded(current_message['id']) as superseded:
+    answer, metadata = dify_agent.create_chat_message_stream(query, user_id, cancel_token=superseded)
+"""
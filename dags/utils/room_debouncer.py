@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+房间消息防抖
+
+替代每条消息占用一个worker执行 time.sleep 等待消息聚合:
+- 每个房间在有序集合中保存一个截止时间(score), 新消息到达时顺延; 同时保存最新的处理参数
+- 调度DAG取出已到截止时间的房间, 每个安静期只取出一次(Lua脚本原子地移入处理中集合并设置租约), 再触发回复DAG
+- 触发成功后确认(ack)才删除; 触发失败或调度任务中断时, 租约到期后房间会被重新取出
+- 等待期间不占用worker
+"""
+
+import json
+import time
+
+from utils.redis import get_redis_client
+
+
+# 默认的安静时间(秒), 房间在这段时间内没有新消息才开始回复
+DEFAULT_QUIET_SECONDS = 3
+# 取出后未确认的房间重新取出的时间(秒)
+DEFAULT_LEASE_SECONDS = 30
+
+
+class RoomDebouncer:
+    """按房间的消息防抖"""
+
+    # 先取出租约已过期的房间, 再取出已到截止时间的房间; 取出的房间移入处理中集合, 租约到期前不会再被取出
+    _POP_DUE_SCRIPT = """
+    local now = ARGV[1]
+    local limit = tonumber(ARGV[2])
+    local lease_until = ARGV[3]
+    local result = {}
+    local expired = redis.call('zrangebyscore', KEYS[3], '-inf', now, 'LIMIT', 0, limit)
+    for _, room in ipairs(expired) do
+        redis.call('zadd', KEYS[3], lease_until, room)
+        table.insert(result, room)
+        table.insert(result, redis.call('hget', KEYS[4], room) or false)
+    end
+    if #expired >= limit then
+        return result
+    end
+    local rooms = redis.call('zrangebyscore', KEYS[1], '-inf', now, 'LIMIT', 0, limit - #expired)
+    for _, room in ipairs(rooms) do
+        redis.call('zrem', KEYS[1], room)
+        local payload = redis.call('hget', KEYS[2], room)
+        redis.call('hdel', KEYS[2], room)
+        if payload then
+            redis.call('zadd', KEYS[3], lease_until, room)
+            redis.call('hset', KEYS[4], room, payload)
+        end
+        table.insert(result, room)
+        table.insert(result, payload or false)
+    end
+    return result
+    """
+
+    def __init__(self, name="wx_msg_reply", redis_client=None):
+        """
+        :param name: 防抖队列名称, 不同的回复流程使用不同的队列
+        """
+        self.redis = redis_client or get_redis_client()
+        self.deadlines_key = f"room_debounce:{name}:deadlines"
+        self.payloads_key = f"room_debounce:{name}:payloads"
+        self.leases_key = f"room_debounce:{name}:leases"
+        self.leased_payloads_key = f"room_debounce:{name}:leased_payloads"
+        self._pop_due_script = self.redis.register_script(self._POP_DUE_SCRIPT)
+
+    def touch(self, room_key, payload, quiet_seconds=DEFAULT_QUIET_SECONDS):
+        """
+        房间收到新消息: 截止时间顺延到 quiet_seconds 秒后, 参数替换为最新的
+        :param room_key: 房间标识, 如 f"{wx_user_name}|{room_id}"
+        :param payload: 回复时需要的参数(可JSON序列化)
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(self.payloads_key, room_key, json.dumps(payload, ensure_ascii=False))
+        pipe.zadd(self.deadlines_key, {room_key: time.time() + quiet_seconds})
+        pipe.execute()
+
+    def pop_due(self, limit=100, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        取出已到截止时间的房间, 处理成功后需调用 ack(room_key); 未确认的房间在 lease_seconds 秒后重新取出
+        :return: [(room_key, payload), ...]
+        """
+        now = time.time()
+        result = self._pop_due_script(
+            keys=[self.deadlines_key, self.payloads_key, self.leases_key, self.leased_payloads_key],
+            args=[now, limit, now + lease_seconds]
+        )
+        due_rooms = []
+        for room_key, payload in zip(result[::2], result[1::2]):
+            due_rooms.append((room_key, json.loads(payload) if payload else None))
+        return due_rooms
+
+    def ack(self, room_key):
+        """
+        房间已处理完成, 删除租约
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zrem(self.leases_key, room_key)
+        pipe.hdel(self.leased_payloads_key, room_key)
+        pipe.execute()
+
+    def seconds_until_next(self):
+        """
+        距离最早的截止时间(或租约到期时间)的秒数, 没有等待中的房间时返回None
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrange(self.deadlines_key, 0, 0, withscores=True)
+        pipe.zrange(self.leases_key, 0, 0, withscores=True)
+        scores = [earliest[0][1] for earliest in pipe.execute() if earliest]
+        if not scores:
+            return None
+        return max(min(scores) - time.time(), 0)
+
+    def cancel(self, room_key):
+        """
+        取消房间的等待
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zrem(self.deadlines_key, room_key)
+        pipe.hdel(self.payloads_key, room_key)
+        pipe.execute()
+
+
+# 使用示例:
+"""
+# 消息到达时
+RoomDebouncer().touch(f"{wx_user_name}|{room_id}", {"message_data": message_data})
+
+# 调度循环
+debouncer = RoomDebouncer()
+for room_key, payload in debouncer.pop_due():
+    trigger_dag(dag_id="wx_msg_reply", conf=payload, ...)
+    debouncer.ack(room_key)
+"""
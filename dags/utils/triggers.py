@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Airflow Trigger
+
+消息DAG中的长时间等待(等待Dify生成回复、等待远程文件写完)交给triggerer的asyncio循环,
+等待期间任务处于deferred状态, 不占用worker; 事件到达后再由 utils.deferrable_operators 中的算子恢复执行; 等待房间安静由 utils.room_debouncer 完成
+
+注意:
+- Trigger在triggerer进程中运行, 不能使用同步的Redis/HTTP/SMB调用阻塞事件循环
+- Trigger的参数以明文保存在元数据库并显示在UI中, 密钥只传Variable名称, 在 run() 中读取
+"""
+
+import asyncio
+import json
+
+import httpx
+from airflow.models import Variable
+from airflow.triggers.base import BaseTrigger, TriggerEvent
+
+from utils.redis import get_async_redis_client
+from utils.room_buffer import RoomBuffer
+
+
+async def _close_redis(client):
+    # redis-py 5.0.1 起提供 aclose, 旧版本使用 close
+    close = getattr(client, "aclose", None) or client.close
+    await close()
+
+
+async def _get_variable(name):
+    # Variable.get 是同步的数据库查询, 在线程池中执行
+    return await asyncio.to_thread(Variable.get, name)
+
+
+async def _wait_superseded(buffer_key, msg_id):
+    """
+    等待房间中出现比 msg_id 更新的消息
+    :return: 最新消息ID
+    """
+    room_buffer = RoomBuffer(buffer_key)
+    client = get_async_redis_client()
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    try:
+        # 先订阅再检查, 订阅生效前到达的新消息不会漏掉
+        await pubsub.subscribe(room_buffer.latest_channel)
+        latest_id = await client.get(room_buffer.latest_key)
+        while latest_id is None or latest_id == msg_id:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message and message.get("type") == "message":
+                latest_id = message["data"]
+        return latest_id
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.close()
+        await _close_redis(client)
+
+
+class DifyChatTrigger(BaseTrigger):
+    """
+    调用Dify流式接口生成回复, 读取SSE直到结束
+
+    指定 cancel_buffer_key 和 cancel_msg_id 时, 房间出现更新的消息后立即中断读取, 并调用stop接口停止Dify端的生成
+
+    事件:
+        {"status": "success", "answer": ..., "metadata": {...}}
+        {"status": "cancelled" | "timeout" | "error", "task_id": ..., "message": ...}
+    """
+
+    def __init__(self, base_url_variable, api_key_variable, payload, cancel_buffer_key=None, cancel_msg_id=None,
+                 timeout_seconds=600):
+        super().__init__()
+        self.base_url_variable = base_url_variable
+        self.api_key_variable = api_key_variable
+        self.base_url = None
+        self.api_key = None
+        self.payload = payload
+        self.cancel_buffer_key = cancel_buffer_key
+        self.cancel_msg_id = str(cancel_msg_id) if cancel_msg_id is not None else None
+        self.timeout_seconds = timeout_seconds
+
+    def serialize(self):
+        return ("utils.triggers.DifyChatTrigger", {
+            "base_url_variable": self.base_url_variable,
+            "api_key_variable": self.api_key_variable,
+            "payload": self.payload,
+            "cancel_buffer_key": self.cancel_buffer_key,
+            "cancel_msg_id": self.cancel_msg_id,
+            "timeout_seconds": self.timeout_seconds,
+        })
+
+    @property
+    def headers(self):
+        return {'Authorization': f'Bearer {self.api_key}', 'Content-Type': 'application/json'}
+
+    async def run(self):
+        try:
+            self.base_url = await _get_variable(self.base_url_variable)
+            self.api_key = await _get_variable(self.api_key_variable)
+        except Exception as error:
+            yield TriggerEvent({"status": "error", "task_id": None, "message": f"读取Dify配置失败: {error}"})
+            return
+
+        state = {"answer": "", "metadata": {}, "task_id": None}
+        stream_task = asyncio.ensure_future(self._read_stream(state))
+        waiters = [stream_task]
+        superseded_task = None
+        if self.cancel_buffer_key and self.cancel_msg_id:
+            superseded_task = asyncio.ensure_future(_wait_superseded(self.cancel_buffer_key, self.cancel_msg_id))
+            waiters.append(superseded_task)
+
+        try:
+            done, _ = await asyncio.wait(waiters, timeout=self.timeout_seconds, return_when=asyncio.FIRST_COMPLETED)
+            if stream_task in done:
+                error = stream_task.exception()
+                if error is not None:
+                    yield TriggerEvent({"status": "error", "task_id": state["task_id"], "message": str(error)})
+                else:
+                    yield TriggerEvent({"status": "success", "answer": state["answer"], "metadata": state["metadata"]})
+                return
+
+            # 被新消息取代, 检查新消息失败或超时: 中断读取, 停止Dify端的生成
+            stream_task.cancel()
+            message = None
+            if superseded_task is not None and superseded_task in done:
+                error = superseded_task.exception()
+                status, message = ("error", f"检查新消息失败: {error}") if error is not None else ("cancelled", None)
+            else:
+                status = "timeout"
+            self.log.info("Dify流式响应%s, task_id: %s", status, state["task_id"])
+            if state["task_id"]:
+                await self._stop(state["task_id"])
+            yield TriggerEvent({"status": status, "task_id": state["task_id"], "message": message or status})
+        finally:
+            for task in waiters:
+                if not task.done():
+                    task.cancel()
+
+    async def _read_stream(self, state):
+        url = f"{self.base_url}/chat-messages"
+        timeout = httpx.Timeout(30.0, read=None)
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            async with client.stream("POST", url, headers=self.headers, json=self.payload) as response:
+                if response.status_code != 200:
+                    raise Exception(f"创建消息失败: {(await response.aread()).decode('utf-8', 'ignore')}")
+
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    data = json.loads(line[6:])
+                    event = data.get("event")
+                    if "task_id" in data:
+                        state["task_id"] = data["task_id"]
+
+                    if event == "message":
+                        state["answer"] += data.get("answer", "")
+                    elif event == "message_end":
+                        state["metadata"] = {
+                            "message_id": data.get("message_id"),
+                            "conversation_id": data.get("conversation_id"),
+                            "metadata": data.get("metadata"),
+                            "usage": data.get("usage"),
+                            "retriever_resources": data.get("retriever_resources"),
+                            "task_id": state["task_id"],
+                        }
+                    elif event == "error":
+                        raise Exception(f"流式响应错误: {data.get('message', '未知错误')}")
+
+    async def _stop(self, task_id):
+        url = f"{self.base_url}/chat-messages/{task_id}/stop"
+        try:
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.post(url, headers=self.headers, json={"user": self.payload.get("user")})
+                self.log.info("停止流式响应: %s %s", response.status_code, response.text)
+        except Exception as error:
+            self.log.warning("停止流式响应失败: %s", error)
+
+
+class RemoteFileReadyTrigger(BaseTrigger):
+    """
+    等待SMB共享目录中的文件写完: 文件存在, 大小不为0, 且连续两次检查大小不变
+
+    事件: {"status": "ready", "remote_path": ..., "size": ...} 或 {"status": "timeout", "remote_path": ...}
+    """
+
+    def __init__(self, server, username, password_variable, remote_path, poll_interval=1.0, timeout_seconds=60):
+        super().__init__()
+        self.server = server
+        self.username = username
+        self.password_variable = password_variable
+        self.remote_path = remote_path
+        self.poll_interval = poll_interval
+        self.timeout_seconds = timeout_seconds
+
+    def serialize(self):
+        return ("utils.triggers.RemoteFileReadyTrigger", {
+            "server": self.server,
+            "username": self.username,
+            "password_variable": self.password_variable,
+            "remote_path": self.remote_path,
+            "poll_interval": self.poll_interval,
+            "timeout_seconds": self.timeout_seconds,
+        })
+
+    async def run(self):
+        import smbclient
+
+        # smbclient是同步库, 在线程池中执行
+        await asyncio.to_thread(smbclient.register_session, server=self.server, username=self.username,
+                                password=await _get_variable(self.password_variable))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout_seconds
+        last_size = None
+        while loop.time() < deadline:
+            try:
+                size = (await asyncio.to_thread(smbclient.stat, self.remote_path)).st_size
+            except OSError:
+                size = None
+            if size and size == last_size:
+                yield TriggerEvent({"status": "ready", "remote_path": self.remote_path, "size": size})
+                return
+            last_size = size
+            await asyncio.sleep(self.poll_interval)
+        yield TriggerEvent({"status": "timeout", "remote_path": self.remote_path})
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Airflow Variable 进程内缓存
+
+热点Variable(DIFY_API_KEY、WX_ACCOUNT_LIST、AI开关列表、system_prompt等)每次读取都会查询元数据库并解密,
+这里在进程内按key缓存:
+- 每个key可单独设置TTL, 缓存条数有上限, 超出时淘汰最久未使用的key
+- Airflow的每个任务实例在单独的进程中运行, 缓存只在任务内有效, 只按TTL失效, 不建立额外的Redis连接
+- 常驻进程(消息流消费者等)调用 start_invalidation_listener() 订阅失效通知:
+  通过 set_variable / delete_variable 修改Variable时, 经Redis pub/sub立即失效; Redis不可用时退化为只按TTL失效
+- 在Airflow页面或API直接修改的Variable, 最迟在TTL到期后生效
+- 同时记录Variable的最后修改时间, 供 variable_gc DAG 判断过期的Variable
+
+注意: 需要"读取-修改-写回"的Variable, 读取时应传 ttl=0 直接读取最新值, 避免基于过期的缓存写回
+"""
+
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+from airflow.models import Variable
+
+from utils.redis import get_redis_client
+
+
+# 默认缓存时间(秒)和缓存条数上限
+VARIABLE_CACHE_TTL_SECONDS = float(os.getenv("VARIABLE_CACHE_TTL_SECONDS", "30"))
+VARIABLE_CACHE_MAX_ENTRIES = int(os.getenv("VARIABLE_CACHE_MAX_ENTRIES", "512"))
+
+# Variable失效通知的频道
+INVALIDATION_CHANNEL = "airflow:variable_invalidate"
+# Variable最后修改时间的hash(key -> 时间戳)
+UPDATED_AT_KEY = "airflow:variable_updated_at"
+
+_NO_DEFAULT = object()
+_MISSING = object()
+# 缓存中表示"Variable不存在"的值
+_NOT_FOUND = object()
+
+
+class VariableCache:
+    """带TTL的LRU缓存"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (key, deserialize_json) -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, cache_key):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return _MISSING
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[cache_key]
+                return _MISSING
+            self._entries.move_to_end(cache_key)
+            return value
+
+    def put(self, cache_key, value, ttl):
+        with self._lock:
+            self._entries[cache_key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            for deserialize_json in (False, True):
+                self._entries.pop((key, deserialize_json), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = VariableCache(VARIABLE_CACHE_MAX_ENTRIES)
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _listen_invalidations():
+    """
+    订阅失效通知; 连接中断期间可能漏掉通知, 因此重新订阅成功后清空缓存
+    """
+    reconnecting = False
+    while True:
+        try:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            if reconnecting:
+                _cache.clear()
+                reconnecting = False
+            for message in pubsub.listen():
+                if message.get('type') == 'message':
+                    _cache.invalidate(message['data'])
+        except Exception as error:
+            print(f"[VARIABLE_CACHE] 失效通知订阅中断, 5秒后重试: {error}")
+            reconnecting = True
+            time.sleep(5)
+
+
+def start_invalidation_listener():
+    """
+    在常驻进程中启动失效通知的订阅线程, 每个进程只启动一个; fork出的子进程需要重新调用
+    短生命周期的任务进程不需要调用, 缓存按TTL失效
+    """
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _listener_lock:
+        if _listener_pid == pid:
+            return
+        threading.Thread(target=_listen_invalidations, name="variable-cache-invalidation", daemon=True).start()
+        _listener_pid = pid
+
+
+def _publish_invalidation(key, deleted=False):
+    _cache.invalidate(key)
+    try:
+        pipe = get_redis_client().pipeline(transaction=False)
+        if deleted:
+            pipe.hdel(UPDATED_AT_KEY, key)
+        else:
+            pipe.hset(UPDATED_AT_KEY, key, time.time())
+        pipe.publish(INVALIDATION_CHANNEL, key)
+        pipe.execute()
+    except Exception as error:
+        print(f"[VARIABLE_CACHE] 发送失效通知失败, 其他worker将在TTL到期后刷新: {key}, {error}")
+
+
+def get_variable(key, default_var=_NO_DEFAULT, deserialize_json=False, ttl=None):
+    """
+    读取Variable, 参数与 Variable.get 一致
+    :param ttl: 缓存时间(秒), 默认 VARIABLE_CACHE_TTL_SECONDS; 传0时直接读取最新值并刷新缓存
+    """
+    ttl = VARIABLE_CACHE_TTL_SECONDS if ttl is None else ttl
+    cache_key = (key, deserialize_json)
+
+    value = _cache.get(cache_key) if ttl > 0 else _MISSING
+    if value is _MISSING:
+        try:
+            value = Variable.get(key, deserialize_json=deserialize_json)
+        except KeyError:
+            # 不存在的Variable同样缓存, 避免反复查询
+            value = _NOT_FOUND
+        _cache.put(cache_key, value, ttl if ttl > 0 else VARIABLE_CACHE_TTL_SECONDS)
+
+    if value is _NOT_FOUND:
+        if default_var is _NO_DEFAULT:
+            raise KeyError(f"Variable {key} does not exist")
+        return default_var
+    # 返回副本, 调用方修改返回值不会影响缓存
+    return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+
+def set_variable(key, value, serialize_json=False, **kwargs):
+    """
+    写入Variable并通知所有worker失效, 参数与 Variable.set 一致
+    """
+    Variable.set(key, value, serialize_json=serialize_json, **kwargs)
+    _publish_invalidation(key)
+
+
+def delete_variable(key):
+    """
+    删除Variable并通知所有worker失效
+    """
+    Variable.delete(key)
+    _publish_invalidation(key, deleted=True)
+
+
+def invalidate_variable(key):
+    """
+    Variable在其他地方被修改后, 主动通知所有worker失效
+    """
+    _publish_invalidation(key)
+
+
+def invalidate_deleted_variables(keys):
+    """
+    批量删除Variable后, 通知所有worker失效并清除最后修改时间
+    """
+    keys = list(keys)
+    for key in keys:
+        _cache.invalidate(key)
+    if not keys:
+        return
+    try:
+        pipe = get_redis_client().pipeline(transaction=False)
+        pipe.hdel(UPDATED_AT_KEY, *keys)
+        for key in keys:
+            pipe.publish(INVALIDATION_CHANNEL, key)
+        pipe.execute()
+    except Exception as error:
+        print(f"[VARIABLE_CACHE] 发送失效通知失败, 其他worker将在TTL到期后刷新: {len(keys)}个key, {error}")
@@ -3,39 +3,9 @@
 from datetime import datetime
 
 from airflow.models import Variable
-from utils.wechat_channl import get_wx_self_info
 from utils.wechat_channl import get_wx_contact_list
-
-
-def update_wx_user_info(source_ip: str) -> dict:
-    """
-    获取用户信息，并缓存。对于新用户，会初始化其专属的 enable_ai_room_ids 列表
-    """
-    # 获取当前已缓存的用户信息
-    wx_account_list = Variable.get("WX_ACCOUNT_LIST", default_var=[], deserialize_json=True)
-
-    # 遍历用户列表，获取用户信息
-    for account in wx_account_list:
-        if source_ip == account['source_ip']:
-            print(f"获取到缓存的用户信息: {account}")
-            return account
-    
-    # 获取最新用户信息
-    new_account = get_wx_self_info(wcf_ip=source_ip)
-    new_account.update({
-        'update_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'source_ip': source_ip
-    })
-    # 添加新用户
-    wx_account_list.append(new_account)
-
-    # 初始化新用户的 enable_ai_room_ids 和 disable_ai_room_ids
-    Variable.set(f"{new_account['wxid']}_enable_ai_room_ids", [], serialize_json=True)
-    Variable.set(f"{new_account['wxid']}_disable_ai_room_ids", [], serialize_json=True)
-
-    print(f"新用户, 更新用户信息: {new_account}")
-    Variable.set("WX_ACCOUNT_LIST", wx_account_list, serialize_json=True)
-    return new_account
+# 账号信息统一由账号登记表维护
+from wx_dags.common.wx_tools import update_wx_user_info
 
 
 def get_contact_name(source_ip: str, wxid: str, wx_user_name: str) -> str:
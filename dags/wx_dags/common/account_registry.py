@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信账号登记表
+
+已登录WCF的微信账号保存在Redis hash中, 替代整体读写的 WX_ACCOUNT_LIST Variable:
+- 按 source_ip 或 wxid 的O(1)查询, 不再反序列化整个列表后线性查找
+- 按账号单独写入, 账号监控DAG更新一个账号不会覆盖其他账号
+- 每次写入同时同步到MySQL的 wx_accounts 表, 便于查看和排查
+- 首次使用时从 WX_ACCOUNT_LIST 迁移一次
+"""
+
+import json
+
+from utils.redis import get_redis_client, RedisLock
+from utils.variable_cache import get_variable
+from wx_dags.common.mysql_tools import save_wx_accounts_to_db
+
+
+KEY_PREFIX = "wx_accounts"
+
+# 迁移锁的过期时间(秒)
+MIGRATION_LOCK_SECONDS = 60
+
+
+class AccountRegistry:
+    """微信账号登记表"""
+
+    # 按wxid查询: wxid -> source_ip -> 账号信息
+    _GET_BY_WXID_SCRIPT = """
+    local source_ip = redis.call('hget', KEYS[2], ARGV[1])
+    if not source_ip then
+        return false
+    end
+    return redis.call('hget', KEYS[1], source_ip)
+    """
+
+    # 已完成迁移(进程内), 避免每次查询Redis
+    _migrated = False
+
+    def __init__(self, redis_client=None):
+        self.redis = redis_client or get_redis_client()
+        self.by_source_ip_key = f"{KEY_PREFIX}:by_source_ip"
+        self.by_wxid_key = f"{KEY_PREFIX}:by_wxid"
+        self.migrated_key = f"{KEY_PREFIX}:migrated"
+        self._get_by_wxid_script = self.redis.register_script(self._GET_BY_WXID_SCRIPT)
+
+    def get_by_source_ip(self, source_ip):
+        """
+        按WCF地址查询账号信息, 不存在时返回None
+        """
+        self._ensure_migrated()
+        account = self.redis.hget(self.by_source_ip_key, source_ip)
+        return json.loads(account) if account else None
+
+    def get_by_wxid(self, wxid):
+        """
+        按wxid查询账号信息, 不存在时返回None
+        """
+        self._ensure_migrated()
+        account = self._get_by_wxid_script(keys=[self.by_source_ip_key, self.by_wxid_key], args=[wxid])
+        return json.loads(account) if account else None
+
+    def list_accounts(self):
+        """
+        所有账号信息
+        """
+        self._ensure_migrated()
+        return [json.loads(account) for account in self.redis.hvals(self.by_source_ip_key)]
+
+    def upsert(self, account):
+        """
+        写入账号信息, 并同步到MySQL
+        :param account: 包含 source_ip 和 wxid 的账号信息
+        """
+        self._ensure_migrated()
+        self._write([account])
+        self._mirror([account])
+
+    def _write(self, accounts):
+        source_ips = [account['source_ip'] for account in accounts]
+        # 同一WCF地址换了登录账号时, 移除旧wxid的索引
+        old_accounts = self.redis.hmget(self.by_source_ip_key, source_ips)
+
+        pipe = self.redis.pipeline(transaction=True)
+        for account, old_account in zip(accounts, old_accounts):
+            old_wxid = json.loads(old_account).get('wxid') if old_account else None
+            if old_wxid and old_wxid != account.get('wxid'):
+                pipe.hdel(self.by_wxid_key, old_wxid)
+            pipe.hset(self.by_source_ip_key, account['source_ip'], json.dumps(account, ensure_ascii=False))
+            if account.get('wxid'):
+                pipe.hset(self.by_wxid_key, account['wxid'], account['source_ip'])
+        pipe.execute()
+
+    @staticmethod
+    def _mirror(accounts):
+        # MySQL只是副本, 同步失败不影响消息处理
+        try:
+            save_wx_accounts_to_db(accounts)
+        except Exception as error:
+            print(f"[ACCOUNT] 同步账号信息到MySQL失败: {error}")
+
+    def _ensure_migrated(self):
+        """
+        从 WX_ACCOUNT_LIST 迁移一次; 多个任务同时首次使用时只有一个执行迁移
+        """
+        if AccountRegistry._migrated:
+            return
+        if not self.redis.exists(self.migrated_key):
+            with RedisLock(f"{KEY_PREFIX}:migrate", expire_seconds=MIGRATION_LOCK_SECONDS,
+                           redis_client=self.redis).lock(timeout=MIGRATION_LOCK_SECONDS):
+                if not self.redis.exists(self.migrated_key):
+                    legacy_accounts = get_variable("WX_ACCOUNT_LIST", default_var=[], deserialize_json=True, ttl=0)
+                    # 不覆盖迁移前已写入的账号
+                    existing_source_ips = set(self.redis.hkeys(self.by_source_ip_key))
+                    legacy_accounts = [account for account in legacy_accounts or []
+                                       if account.get('source_ip') and account['source_ip'] not in existing_source_ips]
+                    if legacy_accounts:
+                        self._write(legacy_accounts)
+                        self._mirror(legacy_accounts)
+                    self.redis.set(self.migrated_key, len(legacy_accounts))
+                    print(f"[ACCOUNT] 从 WX_ACCOUNT_LIST 迁移账号信息, 数量: {len(legacy_accounts)}")
+        AccountRegistry._migrated = True
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI回复策略
+
+把保存在Variable中的房间开关列表编译成Redis集合, 按房间判断时:
+- 每个开关是一次 SISMEMBER, 不再对JSON列表做线性查找
+- 一条消息需要的所有开关和模型/提示词覆盖在一次Redis往返中返回
+- Variable仍是配置的来源(Web UI直接修改Variable), 编译结果 POLICY_TTL_SECONDS 后重新编译
+- 管理员命令修改配置时同时写Variable和Redis(write-through), 立即生效
+"""
+
+import json
+
+from utils.redis import get_redis_client
+from utils.variable_cache import get_variable
+
+
+# 编译结果的有效期(秒), 到期后从Variable重新编译
+POLICY_TTL_SECONDS = 60
+
+# 房间开关
+FLAG_AI_ENABLED = "ai_enabled"      # 开启AI的房间(群聊需要在此列表中)
+FLAG_AI_DISABLED = "ai_disabled"    # 禁用AI的房间
+FLAG_VIDEO_ENABLED = "video_enabled"
+FLAG_IMAGE_ENABLED = "image_enabled"
+ROOM_FLAGS = (FLAG_AI_ENABLED, FLAG_AI_DISABLED, FLAG_VIDEO_ENABLED, FLAG_IMAGE_ENABLED)
+
+
+class AiPolicy:
+    """单个账号(或业务)的AI回复策略"""
+
+    def __init__(self, scope, loader, redis_client=None):
+        """
+        :param scope: 策略的名称, 如 f"{wx_user_name}_{wx_user_id}"
+        :param loader: 从Variable读取配置的函数, 返回:
+            {
+                "ai_enabled": [room_id, ...], "ai_disabled": [...], "video_enabled": [...], "image_enabled": [...],
+                "defaults": {"model": ..., "system_prompt": ...},
+                "room_overrides": {room_id: {"model": ..., "system_prompt": ...}},
+            }
+        """
+        self.redis = redis_client or get_redis_client()
+        self.scope = scope
+        self.loader = loader
+        self.key_prefix = f"ai_policy:{scope}"
+        self.compiled_key = f"{self.key_prefix}:compiled"
+        self.defaults_key = f"{self.key_prefix}:defaults"
+        self.overrides_key = f"{self.key_prefix}:room_overrides"
+
+    def flag_key(self, flag):
+        return f"{self.key_prefix}:{flag}"
+
+    def get_room_policy(self, room_id):
+        """
+        查询房间的全部策略
+        :return: {"ai_enabled": bool, "ai_disabled": bool, "video_enabled": bool, "image_enabled": bool,
+                  "model": str|None, "system_prompt": str|None}
+        """
+        result = self._lookup(room_id)
+        if result is None:
+            self.compile()
+            result = self._lookup(room_id)
+        return result
+
+    def compile(self):
+        """
+        从Variable重新编译策略, 写入临时key后RENAME, 查询方不会看到编译了一半的结果
+        """
+        config = self.loader()
+        pipe = self.redis.pipeline(transaction=True)
+        for flag in ROOM_FLAGS:
+            self._replace(pipe, self.flag_key(flag), "sadd", list(config.get(flag) or []))
+        defaults = {field: value for field, value in (config.get("defaults") or {}).items() if value is not None}
+        self._replace(pipe, self.defaults_key, "hset", defaults)
+        overrides = {room_id: json.dumps(override, ensure_ascii=False)
+                     for room_id, override in (config.get("room_overrides") or {}).items()}
+        self._replace(pipe, self.overrides_key, "hset", overrides)
+        pipe.set(self.compiled_key, "1", ex=POLICY_TTL_SECONDS)
+        pipe.execute()
+        print(f"[AI_POLICY] 编译 {self.scope} 的AI策略: "
+              f"{ {flag: len(config.get(flag) or []) for flag in ROOM_FLAGS} }")
+
+    def set_room_flag(self, flag, room_id, enabled):
+        """
+        修改房间开关(write-through), 调用方需同时更新对应的Variable
+        """
+        if enabled:
+            self.redis.sadd(self.flag_key(flag), room_id)
+        else:
+            self.redis.srem(self.flag_key(flag), room_id)
+
+    def set_default(self, field, value):
+        """
+        修改默认的模型或提示词(write-through), 调用方需同时更新对应的Variable
+        """
+        self.redis.hset(self.defaults_key, field, value)
+
+    def _lookup(self, room_id):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(self.compiled_key)
+        for flag in ROOM_FLAGS:
+            pipe.sismember(self.flag_key(flag), room_id)
+        pipe.hgetall(self.defaults_key)
+        pipe.hget(self.overrides_key, room_id)
+        compiled, *flags, defaults, override = pipe.execute()
+        if not compiled:
+            return None
+
+        policy = {flag: bool(value) for flag, value in zip(ROOM_FLAGS, flags)}
+        policy.update({"model": defaults.get("model"), "system_prompt": defaults.get("system_prompt")})
+        if override:
+            policy.update({field: value for field, value in json.loads(override).items() if value is not None})
+        return policy
+
+    @staticmethod
+    def _replace(pipe, key, command, values):
+        tmp_key = f"{key}:tmp"
+        pipe.delete(tmp_key)
+        if values:
+            if command == "sadd":
+                pipe.sadd(tmp_key, *values)
+            else:
+                pipe.hset(tmp_key, mapping=values)
+            pipe.rename(tmp_key, key)
+        else:
+            pipe.delete(key)
+
+
+def get_account_policy(wx_user_name, wx_user_id):
+    """
+    个人微信账号的AI策略, 来源于账号专属的 enable/disable_ai_room_ids Variable
+    以及可选的 {wx_user_name}_{wx_user_id}_ai_room_overrides Variable({room_id: {"model": ..., "system_prompt": ...}})
+    """
+    scope = f"{wx_user_name}_{wx_user_id}"
+
+    def load_account_policy():
+        # 编译时直接读取最新值, 避免用过期的缓存覆盖管理员刚写入的开关
+        return {
+            FLAG_AI_ENABLED: get_variable(f"{scope}_enable_ai_room_ids", default_var=[], deserialize_json=True, ttl=0),
+            FLAG_AI_DISABLED: get_variable(f"{scope}_disable_ai_room_ids", default_var=[], deserialize_json=True, ttl=0),
+            "room_overrides": get_variable(f"{scope}_ai_room_overrides", default_var={}, deserialize_json=True, ttl=0),
+        }
+
+    return AiPolicy(scope, load_account_policy)
+
+
+def is_ai_reply_enabled(policy, is_group):
+    """
+    按房间策略判断是否自动回复:
+    群聊需要同时满足在开启列表中，且不在禁用列表中; 单聊默认开启AI, 在禁用列表中时关闭
+    """
+    if is_group:
+        return policy[FLAG_AI_ENABLED] and not policy[FLAG_AI_DISABLED]
+    return not policy[FLAG_AI_DISABLED]
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+个人微信AI回复
+
+房间安静期结束后(见 utils.room_debouncer), 由 wx_msg_reply DAG 调用:
+1. 合并房间中未回复的文字消息, 通过Dify的AI助手生成回复并发送
+2. 保存AI回复的消息到DB
+"""
+
+import time
+import uuid
+from datetime import datetime
+
+from airflow.exceptions import AirflowException
+
+from utils.dify_sdk import DifyAgent, ChatMessageCancelled
+from utils.conversation_registry import get_room_conversation_registry
+from utils.wechat_channl import send_wx_msg
+from utils.room_buffer import RoomBuffer
+from utils.paragraph_assembler import ParagraphAssembler
+from utils.variable_cache import get_variable
+from wx_dags.common.wx_tools import WX_MSG_TYPES
+from wx_dags.common.wx_tools import get_contact_name
+from wx_dags.common.wx_tools import get_contact_names
+from wx_dags.common.mysql_tools import save_msg_to_db
+
+
+def should_pre_stop(superseded):
+    """
+    检查是否需要提前停止流程
+    :param superseded: RoomBuffer.watch_superseded 的返回值, 房间有新消息时已被标记, 检查时不需要访问Redis
+    """
+    if superseded.is_set():
+        print(f"[PRE_STOP] 最新消息id不一致，停止流程执行")
+        raise AirflowException("检测到提前停止信号，停止流程执行")
+    else:
+        print(f"[PRE_STOP] 最新消息id一致，继续执行")
+
+
+def prepare_reply(message_data: dict, wx_account_info: dict, superseded):
+    """
+    准备AI回复: 查询房间信息和会话ID, 合并房间中未回复的文字消息
+    :param superseded: RoomBuffer.watch_superseded 的返回值
+    :return: 生成和发送回复需要的参数(可JSON序列化)
+    """
+    room_id = message_data.get('roomid')
+    sender = message_data.get('sender')
+    is_self = message_data.get('is_self', False)  # 是否自己发送的消息
+    source_ip = message_data.get('source_ip')
+    wx_user_name = wx_account_info['name']
+    buffer_key = f'{wx_user_name}_{room_id}'
+    room_buffer = RoomBuffer(buffer_key)
+
+    # 检查是否需要提前停止流程
+    should_pre_stop(superseded)
+
+    # 获取房间和发送者信息
+    contact_names = get_contact_names(source_ip, [room_id, sender], wx_user_name)
+    room_name = contact_names.get(room_id, '')
+    sender_name = contact_names.get(sender) or (wx_user_name if is_self else None)
+
+    # 打印调试信息
+    print(f"房间信息: {room_id}({room_name}), 发送者: {sender}({sender_name})")
+
+    # 初始化dify
+    dify_agent = DifyAgent(api_key=get_variable("DIFY_API_KEY"), base_url=get_variable("DIFY_BASE_URL"))
+
+    # 获取会话ID
+    conversation_id = dify_agent.get_conversation_id_for_room(wx_user_name, room_id)
+
+    # 检查是否需要提前停止流程
+    should_pre_stop(superseded)
+
+    # 如果开启AI，则遍历近期的消息是否已回复，没有回复，则合并到这次提问
+    up_for_reply_msg_content_list = []
+    up_for_reply_msg_id_list = []
+    for msg in room_buffer.unreplied(10):  # 只取最近的10条消息
+        up_for_reply_msg_content_list.append(msg.get('content', ''))
+        up_for_reply_msg_id_list.append(msg['id'])
+    # 整合未回复的消息
+    question = "\n\n".join(up_for_reply_msg_content_list)
+
+    print("-"*50)
+    print(f"question: {question}")
+    print("-"*50)
+
+    return {
+        "buffer_key": buffer_key,
+        "msg_id": superseded.msg_id,
+        "room_name": room_name,
+        "conversation_id": conversation_id,
+        "question": question,
+        "reply_msg_ids": up_for_reply_msg_id_list,
+    }
+
+
+def save_conversation_id(dify_agent, message_data: dict, wx_account_info: dict, prepared: dict, metadata: dict):
+    """
+    新会话时重命名会话并保存会话ID
+    :return: 会话ID
+    """
+    wx_user_name = wx_account_info['name']
+    conversation_id = prepared['conversation_id']
+    if not conversation_id:
+        # 新会话，重命名会话
+        conversation_id = metadata.get("conversation_id")
+        dify_agent.rename_conversation(conversation_id, wx_user_name, prepared['room_name'])
+
+        # 保存会话ID
+        get_room_conversation_registry(wx_user_name).set(message_data.get('roomid'), conversation_id)
+    else:
+        # 旧会话，不重命名
+        pass
+    return conversation_id
+
+
+def record_reply_result(dify_agent, wx_account_info: dict, prepared: dict, metadata: dict, conversation_id: str,
+                        send_error=None):
+    """
+    记录回复结果: Dify消息反馈, 成功时标记消息已回复
+    """
+    wx_user_name = wx_account_info['name']
+    dify_msg_id = metadata.get("message_id")
+    if send_error is None:
+        # 记录消息已被成功回复
+        dify_agent.create_message_feedback(message_id=dify_msg_id, user_id=wx_user_name, rating="like", content="微信自动回复成功")
+
+        # 缓存的消息中，标记消息已回复
+        RoomBuffer(prepared['buffer_key']).mark_replied(prepared['reply_msg_ids'])
+    else:
+        # 记录消息回复失败
+        dify_agent.create_message_feedback(message_id=dify_msg_id, user_id=wx_user_name, rating="dislike", content=f"微信自动回复失败, {send_error}")
+
+    # 打印会话消息
+    messages = dify_agent.get_conversation_messages(conversation_id, wx_user_name)
+    print("-"*50)
+    for msg in messages:
+        print(msg)
+    print("-"*50)
+
+
+def send_reply(message_data: dict, wx_account_info: dict, prepared: dict, answer: str, metadata: dict, superseded):
+    """
+    保存新会话的会话ID, 发送AI回复到微信, 并记录回复结果
+    :param prepared: prepare_reply 的返回值
+    :return: 发送成功时返回AI回复的内容, 发送失败时返回None
+    """
+    room_id = message_data.get('roomid')
+    source_ip = message_data.get('source_ip')
+
+    # 初始化dify
+    dify_agent = DifyAgent(api_key=get_variable("DIFY_API_KEY"), base_url=get_variable("DIFY_BASE_URL"))
+    conversation_id = save_conversation_id(dify_agent, message_data, wx_account_info, prepared, metadata)
+
+    # 检查是否需要提前停止流程
+    should_pre_stop(superseded)
+
+    # 开启AI，且不是自己发送的消息，则自动回复消息, 按段落分段发送
+    send_error = None
+    try:
+        for paragraph in ParagraphAssembler.split(answer):
+            send_wx_msg(wcf_ip=source_ip, message=paragraph, receiver=room_id)
+    except Exception as error:
+        print(f"[AI_REPLY] 发送消息失败: {error}")
+        send_error = error
+
+    record_reply_result(dify_agent, wx_account_info, prepared, metadata, conversation_id, send_error)
+    return answer if send_error is None else None
+
+
+def stream_reply(message_data: dict, wx_account_info: dict, prepared: dict, superseded):
+    """
+    流式回复: Dify生成回复的同时, 每个完整的段落立即发送到微信, 不等待完整的回复
+    :param prepared: prepare_reply 的返回值
+    :return: 发送成功时返回AI回复的内容, 发送失败时返回None
+    """
+    room_id = message_data.get('roomid')
+    source_ip = message_data.get('source_ip')
+    wx_user_name = wx_account_info['name']
+
+    # 初始化dify
+    dify_agent = DifyAgent(api_key=get_variable("DIFY_API_KEY"), base_url=get_variable("DIFY_BASE_URL"))
+
+    assembler = ParagraphAssembler()
+    answer_chunks = []
+    metadata = {}
+    sent_count = 0
+    send_error = None
+    start = time.perf_counter()
+
+    def deliver(paragraphs):
+        nonlocal sent_count, send_error
+        for paragraph in paragraphs:
+            # 发送失败或被新消息取代后不再发送
+            if send_error is not None or superseded.is_set():
+                return
+            try:
+                send_wx_msg(wcf_ip=source_ip, message=paragraph, receiver=room_id)
+            except Exception as error:
+                print(f"[AI_REPLY] 发送消息失败: {error}")
+                send_error = error
+                return
+            sent_count += 1
+            if sent_count == 1:
+                print(f"[AI_REPLY] 首段回复已发送, 耗时: {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    # 获取AI回复, 被新消息取代时中断流式响应并停止Dify端的生成
+    try:
+        for chunk in dify_agent.iter_chat_message_stream(
+            query=prepared['question'],
+            user_id=wx_user_name,
+            conversation_id=prepared['conversation_id'],
+            inputs={},
+            cancel_token=superseded,
+            metadata=metadata
+        ):
+            answer_chunks.append(chunk)
+            deliver(assembler.feed(chunk))
+    except ChatMessageCancelled:
+        print(f"[AI_REPLY] 被新消息取代, 已发送 {sent_count} 段")
+        raise AirflowException("检测到提前停止信号，停止流程执行")
+    deliver(assembler.flush())
+
+    full_answer = "".join(answer_chunks)
+    print(f"full_answer: {full_answer}")
+    print(f"metadata: {metadata}")
+    print(f"[AI_REPLY] 回复已全部发送, 段数: {sent_count}, 耗时: {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    conversation_id = save_conversation_id(dify_agent, message_data, wx_account_info, prepared, metadata)
+    record_reply_result(dify_agent, wx_account_info, prepared, metadata, conversation_id, send_error)
+    return full_answer if send_error is None else None
+
+
+def get_reply_base_message(message_data: dict):
+    """
+    批量消息中最后一条文字消息, 作为提前停止检查的基准
+    """
+    text_messages = [msg for msg in message_data.get('batch_messages') or [message_data]
+                     if WX_MSG_TYPES.get(msg.get('type')) == "文字"]
+    return text_messages[-1] if text_messages else message_data
+
+
+def reply_text_msg(message_data: dict, wx_account_info: dict, streaming: bool = False):
+    """
+    处理文本类消息, 通过Dify的AI助手进行聊天, 并回复微信消息(在当前进程中完成全部步骤)
+    :param streaming: 是否流式回复, 开启后每个完整的段落在生成过程中立即发送
+    :return: 发送成功时返回AI回复的内容, 发送失败时返回None
+    """
+    wx_user_name = wx_account_info['name']
+    current_message = get_reply_base_message(message_data)
+
+    # 订阅房间的最新消息, 有新消息到达时立即标记, 进行中的Dify流式响应也会被中断
+    room_buffer = RoomBuffer(f"{wx_user_name}_{message_data.get('roomid')}")
+    with room_buffer.watch_superseded(current_message['id']) as superseded:
+        prepared = prepare_reply(message_data, wx_account_info, superseded)
+
+        # 检查是否需要提前停止流程
+        should_pre_stop(superseded)
+
+        if streaming:
+            return stream_reply(message_data, wx_account_info, prepared, superseded)
+
+        # 获取AI回复, 被新消息取代时中断流式响应并停止Dify端的生成
+        dify_agent = DifyAgent(api_key=get_variable("DIFY_API_KEY"), base_url=get_variable("DIFY_BASE_URL"))
+        try:
+            full_answer, metadata = dify_agent.create_chat_message_stream(
+                query=prepared['question'],
+                user_id=wx_user_name,
+                conversation_id=prepared['conversation_id'],
+                inputs={},
+                cancel_token=superseded
+            )
+        except ChatMessageCancelled:
+            raise AirflowException("检测到提前停止信号，停止流程执行")
+        print(f"full_answer: {full_answer}")
+        print(f"metadata: {metadata}")
+
+        return send_reply(message_data, wx_account_info, prepared, full_answer, metadata, superseded)
+
+
+def save_ai_reply_msg(message_data: dict, wx_account_info: dict, ai_reply_msg: str):
+    """
+    保存AI回复的消息到DB
+    """
+    # 提取消息信息
+    save_msg = {}
+    save_msg['room_id'] = message_data.get('roomid', '')
+    save_msg['sender_id'] = wx_account_info.get('wxid', '')
+    save_msg['msg_id'] = str(uuid.uuid4())
+    save_msg['msg_type'] = 1  # 消息类型
+    save_msg['msg_type_name'] = WX_MSG_TYPES.get(save_msg['msg_type'], '文本')
+    save_msg['content'] = ai_reply_msg
+    save_msg['is_self'] = True  # 是否自己发送的消息
+    save_msg['is_group'] = message_data.get('is_group', False)  # 是否群聊
+    save_msg['msg_timestamp'] = int(datetime.now().timestamp())
+    save_msg['msg_datetime'] = datetime.now()
+    save_msg['source_ip'] = message_data.get('source_ip', '')
+    save_msg['wx_user_name'] = wx_account_info.get('name', '')
+    save_msg['wx_user_id'] = wx_account_info.get('wxid', '')
+
+    # 获取房间和发送者信息
+    room_name = get_contact_name(save_msg['source_ip'], save_msg['room_id'], save_msg['wx_user_name'])
+    save_msg['room_name'] = room_name
+    save_msg['sender_name'] = save_msg['wx_user_name']
+
+    # 保存消息到DB
+    save_msg_to_db(save_msg)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信联系人目录
+
+每个微信账号的联系人/群名称保存在Redis hash中, 替代整体读写的 {wx_user_name}_CONTACT_INFOS Variable:
+- 按wxid的O(1)查询, 多个wxid一次HMGET
+- 联系人列表由账号监控DAG定期刷新; 消息处理中发现列表过期或遇到未知wxid时, 只有拿到刷新锁的任务调用WCF接口,
+  其他任务直接使用已有数据
+- 刷新后仍不存在的wxid记入负缓存, 一段时间内不再因为它触发刷新(如大群中的陌生成员)
+"""
+
+import time
+
+from utils.redis import get_redis_client, RedisLock
+from utils.wechat_channl import get_wx_contact_list
+
+
+# 联系人列表的刷新周期(秒)
+CONTACTS_TTL_SECONDS = 3600
+# 未知wxid触发刷新的最小间隔(秒)
+MISS_REFRESH_MIN_INTERVAL_SECONDS = 60
+# 未知wxid的负缓存时间(秒)
+NEGATIVE_TTL_SECONDS = 600
+# 刷新锁的过期时间(秒), 防止刷新任务异常退出后锁不释放
+REFRESH_LOCK_SECONDS = 60
+# 首次加载时, 未拿到刷新锁的任务等待其他任务加载完成的最长时间(秒)
+COLD_START_WAIT_SECONDS = 10
+
+
+class ContactDirectory:
+    """单个微信账号的联系人目录"""
+
+    def __init__(self, wx_user_name, source_ip, redis_client=None):
+        self.redis = redis_client or get_redis_client()
+        self.source_ip = source_ip
+        self.key = f"wx_contacts:{wx_user_name}"
+        self.meta_key = f"{self.key}:meta"
+        self.unknown_key = f"{self.key}:unknown"
+        self.refresh_lock = RedisLock(f"{self.key}:refreshing", expire_seconds=REFRESH_LOCK_SECONDS,
+                                      redis_client=self.redis)
+
+    def get_names(self, wxids):
+        """
+        批量查询名称
+        :return: {wxid: 名称}, 未知的wxid名称为空字符串
+        """
+        wxids = [wxid for wxid in dict.fromkeys(wxids) if wxid]
+        if not wxids:
+            return {}
+
+        names, updated_at = self._lookup(wxids)
+        if updated_at is None:
+            # 首次加载
+            if not self.refresh():
+                self._wait_for_cold_start()
+            names, updated_at = self._lookup(wxids)
+        elif time.time() - updated_at > CONTACTS_TTL_SECONDS:
+            # 列表已过期, 由一个任务刷新, 其他任务继续使用已有数据
+            if self.refresh():
+                names, updated_at = self._lookup(wxids)
+
+        missing = [wxid for wxid in wxids if not names.get(wxid)]
+        if missing:
+            missing = self._filter_known_unknown(missing)
+        if missing and updated_at is not None and time.time() - updated_at > MISS_REFRESH_MIN_INTERVAL_SECONDS:
+            if self.refresh():
+                names, _ = self._lookup(wxids)
+                missing = [wxid for wxid in missing if not names.get(wxid)]
+                if missing:
+                    # 刷新后仍不存在, 记入负缓存
+                    self._remember_unknown(missing)
+
+        return {wxid: names.get(wxid) or '' for wxid in wxids}
+
+    def get_name(self, wxid):
+        """
+        查询单个联系人/群名称, 未知时返回空字符串
+        """
+        return self.get_names([wxid]).get(wxid, '')
+
+    def refresh(self, force=False):
+        """
+        从WCF重新加载联系人列表; 同一账号同时只有一个任务刷新
+        :param force: 为True时等待刷新锁, 保证本次调用完成刷新
+        :return: 本次调用是否完成了刷新
+        """
+        if not self.refresh_lock.acquire(blocking=force, timeout=REFRESH_LOCK_SECONDS):
+            print(f"[CONTACTS] {self.key} 正在由其他任务刷新, 使用已有数据")
+            return False
+
+        try:
+            wx_contact_list = get_wx_contact_list(wcf_ip=self.source_ip)
+            contact_names = {contact.get('wxid'): contact.get('name', '') for contact in wx_contact_list
+                             if contact.get('wxid')}
+            print(f"[CONTACTS] 刷新联系人列表缓存，数量: {len(contact_names)}")
+
+            # 写入临时key后RENAME, 读取方不会看到写了一半的列表
+            tmp_key = f"{self.key}:tmp"
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.delete(tmp_key)
+            if contact_names:
+                pipe.hset(tmp_key, mapping=contact_names)
+                pipe.rename(tmp_key, self.key)
+            else:
+                pipe.delete(self.key)
+            pipe.hset(self.meta_key, mapping={"update_time": time.time(), "count": len(contact_names)})
+            # 已加入联系人列表的wxid移出负缓存
+            if contact_names:
+                pipe.zrem(self.unknown_key, *contact_names.keys())
+            pipe.execute()
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    def _lookup(self, wxids):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self.key, wxids)
+        pipe.hget(self.meta_key, "update_time")
+        values, updated_at = pipe.execute()
+        return dict(zip(wxids, values)), (float(updated_at) if updated_at else None)
+
+    def _filter_known_unknown(self, wxids):
+        """
+        去掉负缓存中尚未过期的wxid
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for wxid in wxids:
+            pipe.zscore(self.unknown_key, wxid)
+        now = time.time()
+        return [wxid for wxid, marked_at in zip(wxids, pipe.execute())
+                if marked_at is None or now - marked_at > NEGATIVE_TTL_SECONDS]
+
+    def _remember_unknown(self, wxids):
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.unknown_key, {wxid: now for wxid in wxids})
+        pipe.zremrangebyscore(self.unknown_key, 0, now - NEGATIVE_TTL_SECONDS)
+        pipe.execute()
+
+    def _wait_for_cold_start(self):
+        deadline = time.time() + COLD_START_WAIT_SECONDS
+        while time.time() < deadline and not self.redis.exists(self.meta_key):
+            time.sleep(0.5)
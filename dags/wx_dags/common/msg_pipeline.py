@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+个人微信消息处理步骤
+
+wx_msg_watcher(每个步骤一个任务) 和 wx_msg_express(一个任务完成全部步骤) 共用:
+1. ingest_messages: 更新账号信息, 文字消息写入房间缓冲, 图片/视频分发到其他DAG, 消息计数(可重复执行)
+2. should_ai_reply: 判断是否需要AI回复
+3. save_inbound_messages: 保存收到的消息到DB
+"""
+
+# 标准库导入
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+# Airflow相关导入
+from airflow.api.common.trigger_dag import trigger_dag
+from airflow.exceptions import DagRunAlreadyExists
+from airflow.stats import Stats
+
+# 自定义库导入
+from utils.room_buffer import RoomBuffer
+from wx_dags.common.wx_tools import WX_MSG_TYPES
+from wx_dags.common.wx_tools import update_wx_user_info
+from wx_dags.common.wx_tools import get_contact_names
+from wx_dags.common.wx_tools import check_ai_enable
+from wx_dags.common.mysql_tools import save_msg_to_db
+from wx_dags.common.msg_stats import record_batch_messages
+
+
+# 房间没有新消息多久后开始AI回复(秒), 用于聚合连续发送的消息
+ROOM_QUIET_SECONDS = 3
+
+
+class StageTimer:
+    """
+    记录各处理步骤的耗时, 输出到日志并上报到Airflow的StatsD指标
+    """
+
+    def __init__(self, metric_prefix):
+        self.metric_prefix = metric_prefix
+        self.timings = {}
+        self._started_at = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0) + elapsed
+            Stats.timing(f"{self.metric_prefix}.{name}", timedelta(seconds=elapsed))
+
+    def report(self):
+        total = time.perf_counter() - self._started_at
+        Stats.timing(f"{self.metric_prefix}.total", timedelta(seconds=total))
+        stages = ", ".join(f"{name}={elapsed * 1000:.0f}ms" for name, elapsed in self.timings.items())
+        print(f"[TIMING] {self.metric_prefix} 总耗时: {total * 1000:.0f}ms, {stages}")
+        return dict(self.timings, total=total)
+
+
+def get_batch_messages(message_data: dict):
+    """
+    webhook聚合后的批量消息(按接收顺序), 最后一条即当前消息
+    """
+    return message_data.get('batch_messages') or [message_data]
+
+
+def get_text_messages(message_data: dict):
+    """
+    批次中的文字消息
+    """
+    return [msg for msg in get_batch_messages(message_data) if WX_MSG_TYPES.get(msg.get('type')) == "文字"]
+
+
+def ingest_messages(message_data: dict):
+    """
+    接收消息: 更新账号信息, 文字消息写入房间缓冲, 图片/视频消息分发到其他DAG, 消息计数
+
+    失败后可以重复执行: 缓冲按消息ID去重, 分发的DAG Run ID由消息ID生成, 消息计数按消息ID去重
+    :return: 微信账号信息
+    """
+    batch_messages = get_batch_messages(message_data)
+    print(f"[WATCHER] 本次处理的消息数: {len(batch_messages)}")
+
+    # 读取消息参数
+    room_id = message_data.get('roomid')
+    formatted_roomid = re.sub(r'[^a-zA-Z0-9]', '', str(room_id))  # 用于触发DAG的run_id
+    is_group = message_data.get('is_group', False)  # 是否群聊
+    source_ip = message_data.get('source_ip')
+
+    # 获取用户信息, 并缓存
+    wx_account_info = update_wx_user_info(source_ip)
+    wx_user_name = wx_account_info['name']
+
+    # 批次中的文字消息, 一次性写入缓存列表
+    text_messages = get_text_messages(message_data)
+    if text_messages:
+        # 用户的消息缓存列表, 只缓存最近的100条消息
+        RoomBuffer(f'{wx_user_name}_{room_id}', max_len=100).append(text_messages)
+
+    # 分场景分发微信消息
+    for msg in batch_messages:
+        msg_id = msg.get('id')
+        msg_type = msg.get('type')
+
+        # run_id只由消息生成, 重复处理同一条消息时不会重复触发
+        run_id = f'{formatted_roomid}_{msg.get("sender")}_{msg_id}'
+
+        if WX_MSG_TYPES.get(msg_type) == "文字":
+            # 文字消息已写入缓存列表, 由AI聊天流程统一处理
+            pass
+        elif WX_MSG_TYPES.get(msg_type) == "视频" and not is_group:
+            # 视频消息
+            print(f"[WATCHER] {room_id} 收到视频消息, 触发AI视频处理DAG")
+            trigger_media_dag('ai_tennis_video', msg, run_id)
+        elif WX_MSG_TYPES.get(msg_type) == "图片" and not is_group:
+            # 图片消息
+            print(f"[WATCHER] {room_id} 收到图片消息, 触发AI图片处理DAG")
+            trigger_media_dag('image_agent_001', msg, run_id)
+        else:
+            # 其他类型消息暂不处理
+            print(f"[WATCHER] 消息 {msg_id} 不触发AI聊天流程")
+
+    try:
+        # 账号的消息计数, 按消息ID去重, 重复处理同一条消息时不会重复计数
+        record_batch_messages(wx_user_name, room_id, batch_messages)
+    except Exception as error:
+        # 不影响主流程
+        print(f"[WATCHER] 更新消息计时器失败: {error}")
+
+    return wx_account_info
+
+
+def trigger_media_dag(dag_id: str, msg: dict, run_id: str):
+    """
+    触发图片/视频处理DAG, DAG Run已存在时说明之前已触发过
+    """
+    execution_date = datetime.now(timezone.utc) + timedelta(microseconds=hash(msg.get('id')) % 1000000)  # 添加随机毫秒延迟
+    try:
+        trigger_dag(
+            dag_id=dag_id,
+            conf={"current_message": msg},
+            run_id=run_id,
+            execution_date=execution_date
+        )
+    except DagRunAlreadyExists:
+        print(f"[WATCHER] {dag_id} 的DAG Run {run_id} 已存在, 跳过")
+
+
+def should_ai_reply(message_data: dict, wx_account_info: dict):
+    """
+    判断是否需要AI回复: 房间开启了AI, 不是自己发送的消息, 且有文字消息
+    """
+    room_id = message_data.get('roomid')
+    is_group = message_data.get('is_group', False)  # 是否群聊
+    is_self = message_data.get('is_self', False)  # 是否自己发送的消息
+
+    # 检查AI是否开启
+    is_ai_enable = check_ai_enable(wx_account_info['name'], wx_account_info['wxid'], room_id, is_group)
+    if is_ai_enable and not is_self and get_text_messages(message_data):
+        print("[WATCHER] 触发AI聊天流程")
+        return True
+    print("[WATCHER] 不触发AI聊天流程", is_self, is_ai_enable)
+    return False
+
+
+def save_inbound_messages(message_data: dict, wx_account_info: dict):
+    """
+    保存收到的消息到DB, 房间和发送者名称一次查询后逐条保存
+    """
+    batch_messages = get_batch_messages(message_data)
+    wxids = [wxid for msg in batch_messages for wxid in (msg.get('roomid'), msg.get('sender'))]
+    contact_names = get_contact_names(message_data.get('source_ip', ''), wxids, wx_account_info.get('name', ''))
+    for msg in batch_messages:
+        save_inbound_msg(msg, wx_account_info, contact_names)
+
+
+def save_inbound_msg(message_data: dict, wx_account_info: dict, contact_names: dict):
+    """
+    保存单条收到的消息到DB
+    """
+    save_msg = {}
+    # 提取消息信息
+    save_msg['room_id'] = message_data.get('roomid', '')
+    save_msg['sender_id'] = message_data.get('sender', '')
+    save_msg['msg_id'] = message_data.get('id', '')
+    save_msg['msg_type'] = message_data.get('type', 0)
+    save_msg['msg_type_name'] = WX_MSG_TYPES.get(save_msg['msg_type'], f"未知类型({save_msg['msg_type']})")
+    save_msg['content'] = message_data.get('content', '')
+    save_msg['is_self'] = message_data.get('is_self', False)  # 是否自己发送的消息
+    save_msg['is_group'] = message_data.get('is_group', False)  # 是否群聊
+    save_msg['msg_timestamp'] = message_data.get('ts', 0)
+    save_msg['msg_datetime'] = datetime.now() if not save_msg['msg_timestamp'] else datetime.fromtimestamp(save_msg['msg_timestamp'])
+    save_msg['source_ip'] = message_data.get('source_ip', '')
+    save_msg['wx_user_name'] = wx_account_info.get('name', '')
+    save_msg['wx_user_id'] = wx_account_info.get('wxid', '')
+
+    # 获取房间和发送者信息
+    room_name = contact_names.get(save_msg['room_id'], '')
+    save_msg['room_name'] = room_name
+    if save_msg['is_self']:
+        save_msg['sender_name'] = save_msg['wx_user_name']
+    else:
+        save_msg['sender_name'] = contact_names.get(save_msg['sender_id'], '')
+
+    print(f"房间信息: {save_msg['room_id']}({room_name}), 发送者: {save_msg['sender_id']}({save_msg['sender_name']})")
+
+    # 保存消息到DB
+    save_msg_to_db(save_msg)
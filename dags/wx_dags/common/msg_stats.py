@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信消息统计
+
+按 (账号, 房间, 方向) 统计消息数, 替代读-改-写的 {wx_user_name}_msg_count Variable:
+- 计数使用Redis HINCRBY, 并发的DAG Run不会丢失计数, 每条消息只需一次Redis往返
+- 按分钟、小时、天分桶, 每个时间桶一个hash; 有数据的桶记录在索引中, 由 wx_msg_stats_rollup DAG 汇总到MySQL
+- webhook的persist sink直接入库的消息由webhook按相同的key计数(webhook_server.record_message_stats)
+- 收到的消息按消息ID去重计数, 任务重试或消息流重新投递时同一条消息只计数一次
+- 账号累计总数保存在 wx_stats:total 中, 由汇总DAG同步回 {wx_user_name}_msg_count Variable, 兼容旧的读取方
+"""
+
+import time
+from datetime import datetime, timedelta, timezone
+
+from utils.redis import get_redis_client
+
+
+# 消息方向
+DIRECTION_IN = "in"     # 收到的消息
+DIRECTION_OUT = "out"   # 发出的消息
+
+# 统计时区, 与Airflow的默认时区(Asia/Shanghai)一致
+STATS_TZ = timezone(timedelta(hours=8))
+
+# 时间桶粒度: 桶名格式, 桶长度(秒), Redis中的保留时间(秒)
+GRANULARITIES = {
+    "minute": ("%Y%m%d%H%M", 60, 2 * 24 * 3600),
+    "hour": ("%Y%m%d%H", 3600, 14 * 24 * 3600),
+    "day": ("%Y%m%d", 24 * 3600, 90 * 24 * 3600),
+}
+
+KEY_PREFIX = "wx_stats"
+TOTAL_KEY = f"{KEY_PREFIX}:total"
+
+# 已计数消息ID标记的保留时间(秒), 需覆盖消息的重试和重新投递
+COUNTED_MARKER_TTL = 24 * 3600
+
+
+def bucket_key(granularity, bucket):
+    return f"{KEY_PREFIX}:{granularity}:{bucket}"
+
+
+def bucket_index_key(granularity):
+    """
+    有数据的时间桶索引(有序集合, score为桶的起始时间戳)
+    """
+    return f"{KEY_PREFIX}:buckets:{granularity}"
+
+
+def bucket_start(granularity, ts):
+    """
+    时间戳所在时间桶的名称和起始时间戳
+    """
+    bucket_format = GRANULARITIES[granularity][0]
+    bucket = datetime.fromtimestamp(ts, tz=STATS_TZ).strftime(bucket_format)
+    start = datetime.strptime(bucket, bucket_format).replace(tzinfo=STATS_TZ).timestamp()
+    return bucket, start
+
+
+def stats_field(wx_user_name, room_id, direction):
+    return f"{wx_user_name}|{room_id}|{direction}"
+
+
+def parse_stats_field(field):
+    """
+    解析统计字段, 账号名中可能包含分隔符, 从右侧拆分
+    """
+    wx_user_name, room_id, direction = field.rsplit("|", 2)
+    return wx_user_name, room_id, direction
+
+
+def record_messages(wx_user_name, room_id, direction, count=1, ts=None, redis_client=None):
+    """
+    记录消息数, 所有粒度的计数在一次Redis往返中完成
+    :param direction: DIRECTION_IN 或 DIRECTION_OUT
+    :param count: 消息数, 批量消息时为批次大小
+    :param ts: 消息时间戳, 默认当前时间
+    """
+    if count <= 0:
+        return
+    ts = ts or time.time()
+    redis_client = redis_client or get_redis_client()
+    field = stats_field(wx_user_name, room_id, direction)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for granularity, (_, _, retention) in GRANULARITIES.items():
+        bucket, start = bucket_start(granularity, ts)
+        key = bucket_key(granularity, bucket)
+        pipe.hincrby(key, field, count)
+        pipe.expire(key, retention)
+        pipe.zadd(bucket_index_key(granularity), {bucket: start})
+    pipe.hincrby(TOTAL_KEY, f"{wx_user_name}|{direction}", count)
+    pipe.execute()
+
+
+def counted_marker_key(wx_user_name, msg_id):
+    return f"{KEY_PREFIX}:counted:{wx_user_name}:{msg_id}"
+
+
+def record_batch_messages(wx_user_name, room_id, batch_messages, redis_client=None):
+    """
+    记录一批收到的消息, 按消息ID去重: 同一条消息重复处理时只计数一次(没有ID的消息每次都计数)
+    自己在其他设备上发送的消息记为发出
+    :return: 本次计数的消息数
+    """
+    redis_client = redis_client or get_redis_client()
+    msgs_with_id = [msg for msg in batch_messages if msg.get('id')]
+    pipe = redis_client.pipeline(transaction=False)
+    for msg in msgs_with_id:
+        pipe.set(counted_marker_key(wx_user_name, msg['id']), 1, nx=True, ex=COUNTED_MARKER_TTL)
+    first_seen = pipe.execute() if msgs_with_id else []
+    new_messages = [msg for msg, added in zip(msgs_with_id, first_seen) if added]
+    new_messages += [msg for msg in batch_messages if not msg.get('id')]
+
+    self_count = sum(1 for msg in new_messages if msg.get('is_self'))
+    record_messages(wx_user_name, room_id, DIRECTION_IN, len(new_messages) - self_count, redis_client=redis_client)
+    record_messages(wx_user_name, room_id, DIRECTION_OUT, self_count, redis_client=redis_client)
+    return len(new_messages)
+
+
+def get_account_totals(redis_client=None):
+    """
+    各账号的累计消息数
+    :return: {wx_user_name: {direction: count}}
+    """
+    redis_client = redis_client or get_redis_client()
+    totals = {}
+    for field, count in redis_client.hgetall(TOTAL_KEY).items():
+        wx_user_name, direction = field.rsplit("|", 1)
+        totals.setdefault(wx_user_name, {})[direction] = int(count)
+    return totals
@@ -7,6 +7,8 @@ MySQL数据库工具模块
 1. 初始化微信聊天记录表
 2. 保存微信消息到数据库
 3. 查询微信消息记录
+4. 初始化和写入微信消息统计
+5. 同步微信账号信息
 
 特点:
 1. 支持多账号数据隔离
@@ -14,6 +16,7 @@ MySQL数据库工具模块
 3. 异常重试和事务回滚
 """
 
+import json
 
 from airflow.hooks.base import BaseHook
 
@@ -195,3 +198,158 @@ def save_msg_to_db(msg_data: dict):
                 db_conn.close()
             except:
                 pass
+
+
+def init_wx_msg_stats_table():
+    """
+    初始化微信消息统计表
+    """
+    db_hook = BaseHook.get_connection("wx_db").get_hook()
+    db_conn = db_hook.get_conn()
+    cursor = db_conn.cursor()
+
+    create_table_sql = """CREATE TABLE IF NOT EXISTS `wx_msg_stats` (
+        `id` bigint(20) NOT NULL AUTO_INCREMENT,
+        `granularity` varchar(16) NOT NULL COMMENT '统计粒度: minute/hour/day',
+        `bucket_time` datetime NOT NULL COMMENT '时间桶的起始时间',
+        `wx_user_name` varchar(64) NOT NULL COMMENT '微信用户名',
+        `room_id` varchar(64) NOT NULL COMMENT '聊天室ID',
+        `direction` varchar(8) NOT NULL COMMENT '消息方向: in/out',
+        `msg_count` int(11) NOT NULL DEFAULT '0' COMMENT '消息数',
+        `created_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+        `updated_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+        PRIMARY KEY (`id`),
+        UNIQUE KEY `uk_bucket` (`granularity`, `bucket_time`, `wx_user_name`, `room_id`, `direction`),
+        KEY `idx_wx_user_name_bucket` (`wx_user_name`, `granularity`, `bucket_time`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='微信消息统计';
+    """
+    cursor.execute(create_table_sql)
+    db_conn.commit()
+
+    cursor.close()
+    db_conn.close()
+
+
+def save_msg_stats_to_db(stats_rows: list):
+    """
+    批量写入消息统计, 同一时间桶重复写入时以最新的计数覆盖
+    stats_rows: [(granularity, bucket_time, wx_user_name, room_id, direction, msg_count), ...]
+    """
+    if not stats_rows:
+        return
+
+    insert_sql = """INSERT INTO `wx_msg_stats`
+    (granularity, bucket_time, wx_user_name, room_id, direction, msg_count)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+    msg_count = VALUES(msg_count),
+    updated_at = CURRENT_TIMESTAMP
+    """
+    db_conn = None
+    cursor = None
+    try:
+        db_hook = BaseHook.get_connection("wx_db").get_hook()
+        db_conn = db_hook.get_conn()
+        cursor = db_conn.cursor()
+        cursor.executemany(insert_sql, stats_rows)
+        db_conn.commit()
+        print(f"[DB_SAVE] 成功写入消息统计: {len(stats_rows)} 行")
+    except Exception as e:
+        print(f"[DB_SAVE] 写入消息统计失败: {e}")
+        if db_conn:
+            try:
+                db_conn.rollback()
+            except:
+                pass
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except:
+                pass
+        if db_conn:
+            try:
+                db_conn.close()
+            except:
+                pass
+
+
+def init_wx_accounts_table():
+    """
+    初始化微信账号表
+    """
+    db_hook = BaseHook.get_connection("wx_db").get_hook()
+    db_conn = db_hook.get_conn()
+    cursor = db_conn.cursor()
+
+    create_table_sql = """CREATE TABLE IF NOT EXISTS `wx_accounts` (
+        `id` bigint(20) NOT NULL AUTO_INCREMENT,
+        `source_ip` varchar(64) NOT NULL COMMENT 'WCF服务地址',
+        `wxid` varchar(64) NOT NULL COMMENT '微信ID',
+        `name` varchar(128) DEFAULT NULL COMMENT '微信昵称',
+        `account_info` text COMMENT '完整的账号信息(JSON)',
+        `update_time` datetime DEFAULT NULL COMMENT '账号信息更新时间',
+        `created_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+        `updated_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+        PRIMARY KEY (`id`),
+        UNIQUE KEY `uk_source_ip` (`source_ip`),
+        KEY `idx_wxid` (`wxid`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='微信账号';
+    """
+    cursor.execute(create_table_sql)
+    db_conn.commit()
+
+    cursor.close()
+    db_conn.close()
+
+
+def save_wx_accounts_to_db(accounts: list):
+    """
+    批量写入微信账号信息, 同一WCF地址以最新的账号信息覆盖
+    accounts: [{'source_ip': ..., 'wxid': ..., 'name': ..., 'update_time': ...}, ...]
+    """
+    if not accounts:
+        return
+
+    insert_sql = """INSERT INTO `wx_accounts`
+    (source_ip, wxid, name, account_info, update_time)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+    wxid = VALUES(wxid),
+    name = VALUES(name),
+    account_info = VALUES(account_info),
+    update_time = VALUES(update_time)
+    """
+    rows = [(account['source_ip'], account.get('wxid', ''), account.get('name', ''),
+             json.dumps(account, ensure_ascii=False), account.get('update_time'))
+            for account in accounts]
+    db_conn = None
+    cursor = None
+    try:
+        init_wx_accounts_table()
+        db_hook = BaseHook.get_connection("wx_db").get_hook()
+        db_conn = db_hook.get_conn()
+        cursor = db_conn.cursor()
+        cursor.executemany(insert_sql, rows)
+        db_conn.commit()
+        print(f"[DB_SAVE] 成功写入微信账号: {len(rows)} 个")
+    except Exception as e:
+        print(f"[DB_SAVE] 写入微信账号失败: {e}")
+        if db_conn:
+            try:
+                db_conn.rollback()
+            except:
+                pass
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except:
+                pass
+        if db_conn:
+            try:
+                db_conn.close()
+            except:
+                pass
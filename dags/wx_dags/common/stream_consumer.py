@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+个人微信消息流消费者
+
+webhook的stream sink把消息写入Redis Stream(WX_MSG_STREAM_KEY), 由本消费者常驻处理, 替代每条消息一次 wx_msg_watcher DAG Run:
+- 处理步骤与 wx_msg_watcher 相同(wx_dags.common.msg_pipeline), 开启AI的房间登记到防抖队列, 由 wx_msg_reply 回复
+- 按 (source_ip, roomid) 分配到固定的处理通道: 同一房间的消息按顺序处理, 不同房间并行处理
+- 消息保存到DB后才确认(XACK); 进程中断时未确认的消息在下次启动时重新处理
+- 处理失败时整条消息重试, 各步骤可重复执行(房间缓冲按消息ID去重, 图片/视频DAG Run ID由消息ID生成)
+- 多次处理失败的消息转入死信流, 并确认, 不阻塞房间后续的消息
+
+webhook的 WEBHOOK_REDIS_URL 必须与 utils.redis 连接同一个Redis(AIRFLOW_REDIS_HOST),
+两边的 WX_MSG_STREAM_KEY 环境变量也必须一致, 否则读不到消息。
+
+同一消费组只运行一个消费者, 才能保证同一房间的消息顺序; 由 wx_msg_stream_consumer DAG 运行, 也可作为常驻服务运行:
+    cd dags && python -m wx_dags.common.stream_consumer
+"""
+
+# 标准库导入
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+# 第三方库导入
+from redis.exceptions import ResponseError
+
+# 自定义库导入
+from utils.redis import get_redis_client
+from utils.variable_cache import start_invalidation_listener
+from utils.room_debouncer import RoomDebouncer
+from wx_dags.common.msg_pipeline import ROOM_QUIET_SECONDS
+from wx_dags.common.msg_pipeline import ingest_messages, should_ai_reply, save_inbound_messages
+
+
+# 与webhook读取同一个环境变量, 两边需配置相同的值
+STREAM_KEY = os.getenv("WX_MSG_STREAM_KEY", "wx_msg_stream")
+GROUP_NAME = "wx_msg_consumer"
+CONSUMER_NAME = "wx_msg_consumer-1"
+
+# 处理通道数, 即最多同时处理的房间数
+DEFAULT_LANES = 8
+# 单条消息的最大处理次数
+MAX_ATTEMPTS = 3
+
+
+def process_stream_message(message_data: dict):
+    """
+    处理一条消息(或同一房间的一批消息), 与 wx_msg_watcher 的处理步骤相同
+    """
+    wx_account_info = ingest_messages(message_data)
+
+    # 房间安静后由调度DAG触发AI回复
+    if should_ai_reply(message_data, wx_account_info):
+        RoomDebouncer().touch(f"{wx_account_info['name']}|{message_data.get('roomid')}",
+                              {"message_data": message_data, "wx_account_info": wx_account_info},
+                              quiet_seconds=ROOM_QUIET_SECONDS)
+
+    save_inbound_messages(message_data, wx_account_info)
+
+
+class MessageStreamConsumer:
+    """Redis Stream消息消费者"""
+
+    def __init__(self, stream_key=STREAM_KEY, group_name=GROUP_NAME, consumer_name=CONSUMER_NAME,
+                 lanes=DEFAULT_LANES, max_attempts=MAX_ATTEMPTS, redis_client=None):
+        self.redis = redis_client or get_redis_client()
+        self.stream_key = stream_key
+        self.dead_letter_key = f"{stream_key}:dead"
+        self.group_name = group_name
+        self.consumer_name = consumer_name
+        self.lanes = lanes
+        self.max_attempts = max_attempts
+        self.processed = 0
+        self.failed = 0
+        self._counter_lock = threading.Lock()
+
+    def ensure_group(self):
+        """
+        创建消费组, 从Stream的开头开始消费
+        """
+        try:
+            self.redis.xgroup_create(self.stream_key, self.group_name, id="0", mkstream=True)
+            print(f"[STREAM] 创建消费组: {self.stream_key} {self.group_name}")
+        except ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+
+    def run(self, run_seconds=None, batch_size=50, block_ms=1000):
+        """
+        消费消息, 直到超过 run_seconds 秒(None表示一直运行); 退出前处理完已读取的消息
+        """
+        self.ensure_group()
+        # 常驻消费期间Variable被修改时立即失效缓存
+        start_invalidation_listener()
+        deadline = time.time() + run_seconds if run_seconds else None
+        lane_queues = [queue.Queue(maxsize=batch_size * 2) for _ in range(self.lanes)]
+        workers = [threading.Thread(target=self._run_lane, args=(lane_queue,), daemon=True)
+                   for lane_queue in lane_queues]
+        for worker in workers:
+            worker.start()
+
+        # 先处理本消费者上次未确认的消息, 处理完后再读取新消息
+        read_id = "0"
+        try:
+            while deadline is None or time.time() < deadline:
+                result = self.redis.xreadgroup(self.group_name, self.consumer_name, {self.stream_key: read_id},
+                                               count=batch_size, block=None if read_id != ">" else block_ms)
+                entries = result[0][1] if result else []
+                if read_id != ">":
+                    if not entries:
+                        print("[STREAM] 未确认的消息已全部重新处理")
+                        read_id = ">"
+                        continue
+                    read_id = entries[-1][0]
+
+                for entry_id, fields in entries:
+                    if not fields:
+                        # 已被裁剪的未确认消息
+                        self.redis.xack(self.stream_key, self.group_name, entry_id)
+                        continue
+                    message_data = json.loads(fields["conf"])
+                    lane = zlib.crc32(f"{message_data.get('source_ip')}|{message_data.get('roomid')}".encode()) % self.lanes
+                    # 通道已满时阻塞, 不再读取新消息
+                    lane_queues[lane].put((entry_id, message_data))
+        finally:
+            for lane_queue in lane_queues:
+                lane_queue.put(None)
+            for worker in workers:
+                worker.join()
+            print(f"[STREAM] 消费结束, 处理成功: {self.processed}, 转入死信: {self.failed}")
+
+    def _run_lane(self, lane_queue):
+        while True:
+            item = lane_queue.get()
+            if item is None:
+                return
+            try:
+                self._handle(*item)
+            except Exception as error:
+                # 确认失败时消息保持未确认, 下次启动时重新处理
+                print(f"[STREAM] 确认消息 {item[0]} 失败: {error}")
+
+    def _handle(self, entry_id, message_data):
+        start = time.perf_counter()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                process_stream_message(message_data)
+                with self._counter_lock:
+                    self.processed += 1
+                print(f"[STREAM] 消息处理完成: {entry_id} {message_data.get('roomid')} {message_data.get('id')}, "
+                      f"耗时: {(time.perf_counter() - start) * 1000:.0f}ms")
+                break
+            except Exception as error:
+                print(f"[STREAM] 第{attempt}次处理消息 {entry_id} 失败: {error}")
+                if attempt == self.max_attempts:
+                    self.redis.xadd(self.dead_letter_key, {"entry_id": entry_id, "error": str(error),
+                                                           "conf": json.dumps(message_data, ensure_ascii=False)})
+                    with self._counter_lock:
+                        self.failed += 1
+                else:
+                    time.sleep(attempt)
+        # 消息已保存(或已转入死信流)后确认
+        self.redis.xack(self.stream_key, self.group_name, entry_id)
+
+
+if __name__ == "__main__":
+    MessageStreamConsumer().run()
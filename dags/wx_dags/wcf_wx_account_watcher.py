@@ -19,11 +19,12 @@ from datetime import datetime, timedelta
 
 # Airflow相关导入
 from airflow import DAG
-from airflow.models.variable import Variable
 from airflow.operators.python import PythonOperator
 
 # 自定义库导入
 from utils.wechat_channl import get_wx_contact_list, get_wx_self_info, check_wx_login
+from wx_dags.common.contact_directory import ContactDirectory
+from wx_dags.common.account_registry import AccountRegistry
 
 
 DAG_ID = "wx_account_watcher"
@@ -36,12 +37,12 @@ def check_wx_account_status(**context):
     Args:
         **context: Airflow上下文参数，包含dag_run等信息
     """
-    # 获取当前已缓存的用户信息
-    wx_account_list = Variable.get("WX_ACCOUNT_LIST", default_var=[], deserialize_json=True)
+    # 获取当前已登记的用户信息
+    account_registry = AccountRegistry()
+    wx_account_list = account_registry.list_accounts()
     print(f"当前已缓存的用户信息: {len(wx_account_list)}")
 
-    # 更新微信账号信息
-    updated_account_list = []
+    # 更新微信账号信息, 逐个账号写入, 不会覆盖期间新登记的账号
     for account in wx_account_list:
         print(f"checking account: {account}")
         source_ip = account['source_ip']
@@ -54,10 +55,13 @@ def check_wx_account_status(**context):
         new_wx_account_info['update_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
         # 更新缓存
-        updated_account_list.append(new_wx_account_info)
+        account_registry.upsert(new_wx_account_info)
 
-    # 更新缓存
-    Variable.set("WX_ACCOUNT_LIST", updated_account_list, serialize_json=True)
+        # 刷新联系人目录, 消息处理时无需再调用WCF接口
+        try:
+            ContactDirectory(new_wx_account_info['name'], source_ip).refresh(force=True)
+        except Exception as error:
+            print(f"刷新联系人目录失败: {source_ip}, {error}")
 
 
 # 创建DAG
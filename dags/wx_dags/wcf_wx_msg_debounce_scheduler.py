@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+个人微信消息防抖调度DAG
+
+功能：
+1. 等待开启AI的房间安静(见 wx_dags.common.msg_pipeline 中的 ROOM_QUIET_SECONDS)
+2. 房间安静后触发一次 wx_msg_reply DAG 回复
+
+特点：
+1. 每5分钟启动一次, 每次运行在5分钟内持续调度, 最大并发运行数为1
+2. 所有房间的等待只占用这一个worker, 消息处理DAG不再 sleep 等待聚合
+3. 房间的截止时间保存在Redis有序集合中, 调度任务重启不会丢失
+4. 触发成功后才确认房间, 触发失败的房间在租约到期(LEASE_SECONDS)后重试
+5. 两次运行之间有十秒左右的间隔(运行时长短于调度周期, 加上调度延迟), 期间安静的房间由下一次运行回复, 回复会延迟但不会丢失
+"""
+
+# 标准库导入
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+# Airflow相关导入
+from airflow import DAG
+from airflow.api.common.trigger_dag import trigger_dag
+from airflow.operators.python import PythonOperator
+
+from airflow.exceptions import DagRunAlreadyExists
+
+# 自定义库导入
+from utils.room_debouncer import RoomDebouncer
+
+
+DAG_ID = "wx_msg_debounce_scheduler"
+REPLY_DAG_ID = "wx_msg_reply"
+
+# 每次运行的调度时长(秒), 略短于调度周期, 下一次运行可以按时开始
+RUN_SECONDS = 290
+# 两次检查之间的最长等待(秒)
+MAX_WAIT_SECONDS = 0.5
+# 触发失败后重试的间隔(秒)
+LEASE_SECONDS = 10
+
+
+def trigger_reply(room_key, payload):
+    """
+    触发房间的AI回复
+    """
+    message_data = payload['message_data']
+    room_id = message_data.get('roomid')
+    formatted_roomid = re.sub(r'[^a-zA-Z0-9]', '', str(room_id))
+    # run_id由房间的最新消息生成, 重试时不会重复触发
+    run_id = f'{formatted_roomid}_{message_data.get("id")}'
+    print(f"[DEBOUNCE] {room_key} 已安静, 触发AI回复: {run_id}")
+    try:
+        trigger_dag(
+            dag_id=REPLY_DAG_ID,
+            conf=payload,
+            run_id=run_id,
+            execution_date=datetime.now(timezone.utc)
+        )
+    except DagRunAlreadyExists:
+        print(f"[DEBOUNCE] {run_id} 已存在, 跳过")
+
+
+def schedule_room_replies(**context):
+    """
+    持续取出已安静的房间, 触发AI回复
+    """
+    debouncer = RoomDebouncer()
+    deadline = time.time() + RUN_SECONDS
+    triggered = 0
+    while time.time() < deadline:
+        for room_key, payload in debouncer.pop_due(lease_seconds=LEASE_SECONDS):
+            if not payload:
+                debouncer.ack(room_key)
+                continue
+            try:
+                trigger_reply(room_key, payload)
+                triggered += 1
+            except Exception as error:
+                # 不确认, 租约到期后重新取出
+                print(f"[DEBOUNCE] {room_key} 触发AI回复失败, {LEASE_SECONDS}秒后重试: {error}")
+                continue
+            debouncer.ack(room_key)
+
+        # 等到最早的截止时间, 最长 MAX_WAIT_SECONDS, 期间新登记的房间最多延迟这么久
+        wait_seconds = debouncer.seconds_until_next()
+        if wait_seconds is None or wait_seconds > MAX_WAIT_SECONDS:
+            wait_seconds = MAX_WAIT_SECONDS
+        time.sleep(min(wait_seconds, max(deadline - time.time(), 0)))
+    print(f"[DEBOUNCE] 本次运行触发AI回复: {triggered}")
+
+
+# 创建DAG
+dag = DAG(
+    dag_id=DAG_ID,
+    default_args={'owner': 'claude89757'},
+    start_date=datetime(2024, 1, 1),
+    schedule_interval=timedelta(minutes=5),
+    max_active_runs=1,
+    dagrun_timeout=timedelta(minutes=10),
+    catchup=False,
+    tags=['个人微信'],
+    description='个人微信消息防抖调度',
+)
+
+# 创建调度任务
+schedule_room_replies_task = PythonOperator(
+    task_id='schedule_room_replies',
+    python_callable=schedule_room_replies,
+    provide_context=True,
+    dag=dag
+)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+个人微信消息快速处理DAG(express模式)
+
+功能：
+1. 与 wx_msg_watcher + wx_msg_reply 相同的处理步骤: 接收消息和分发、判断是否AI回复、保存收到的消息、AI回复、保存AI回复
+2. 所有步骤在一个任务中完成, 输出各步骤耗时(日志和StatsD指标 wx_msg_express.*)
+
+特点：
+1. 由webhook触发，不进行定时调度; 在webhook的路由表中把消息的目标改为 {"dag_id": "wx_msg_express"} 即可启用
+2. 只有一个任务, 没有分支和XCom, 每条消息只产生一次任务调度
+3. 等待房间安静与保存收到的消息同时进行, 房间有新消息时由新消息的DAG Run回复
+4. 等待房间安静和Dify生成回复期间占用worker, 适合回复延迟优先、消息量不大的账号
+5. 流式回复: Dify生成的同时逐段发送, 首段回复不需要等待完整的回复生成
+"""
+
+# 标准库导入
+import time
+from datetime import datetime
+
+# Airflow相关导入
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+
+# 自定义库导入
+from utils.room_buffer import RoomBuffer
+from wx_dags.common.ai_reply import get_reply_base_message, reply_text_msg, save_ai_reply_msg
+from wx_dags.common.msg_pipeline import ROOM_QUIET_SECONDS, StageTimer
+from wx_dags.common.msg_pipeline import ingest_messages, should_ai_reply, save_inbound_messages
+
+
+DAG_ID = "wx_msg_express"
+
+# 保存收到的消息的重试次数和间隔(秒), 与 wx_msg_watcher 的 save_message_to_db 任务一致
+SAVE_MSG_RETRIES = 5
+SAVE_MSG_RETRY_DELAY = 1
+
+# 是否流式回复, 每个完整的段落在生成过程中立即发送
+STREAMING_REPLY = True
+
+
+def save_inbound_messages_with_retry(message_data: dict, wx_account_info: dict):
+    """
+    保存收到的消息到DB, 失败时在任务内重试, 避免整个任务重试时重复分发消息
+    """
+    for attempt in range(SAVE_MSG_RETRIES + 1):
+        try:
+            return save_inbound_messages(message_data, wx_account_info)
+        except Exception as error:
+            if attempt == SAVE_MSG_RETRIES:
+                raise
+            print(f"[EXPRESS] 第{attempt + 1}次保存消息失败: {error}，{SAVE_MSG_RETRY_DELAY}秒后重试...")
+            time.sleep(SAVE_MSG_RETRY_DELAY)
+
+
+def process_wx_message_express(**context):
+    """
+    在一个任务中完成微信消息的全部处理步骤
+    """
+    dag_run = context.get('dag_run')
+    if not (dag_run and dag_run.conf):
+        print("[EXPRESS] 没有收到消息数据")
+        return
+    message_data = dag_run.conf
+    print(f"[EXPRESS] 收到微信消息: {message_data.get('roomid')} {message_data.get('sender')} {message_data.get('id')}")
+
+    timer = StageTimer(DAG_ID)
+    try:
+        with timer.stage("ingest"):
+            wx_account_info = ingest_messages(message_data)
+        with timer.stage("branch"):
+            need_reply = should_ai_reply(message_data, wx_account_info)
+
+        if not need_reply:
+            with timer.stage("save_inbound"):
+                save_inbound_messages_with_retry(message_data, wx_account_info)
+            return
+
+        # 先订阅房间的最新消息, 保存消息的同时计算安静时间
+        room_buffer = RoomBuffer(f"{wx_account_info['name']}_{message_data.get('roomid')}")
+        current_message = get_reply_base_message(message_data)
+        quiet_since = time.monotonic()
+        with room_buffer.watch_superseded(current_message['id']) as superseded:
+            with timer.stage("save_inbound"):
+                save_inbound_messages_with_retry(message_data, wx_account_info)
+            with timer.stage("wait_quiet"):
+                if superseded.wait(max(ROOM_QUIET_SECONDS - (time.monotonic() - quiet_since), 0)):
+                    print("[EXPRESS] 房间有新消息, 由新消息的DAG Run回复")
+                    return
+
+        with timer.stage("ai_reply"):
+            ai_reply_msg = reply_text_msg(message_data, wx_account_info, streaming=STREAMING_REPLY)
+        if ai_reply_msg is not None:
+            with timer.stage("save_ai_reply"):
+                save_ai_reply_msg(message_data, wx_account_info, ai_reply_msg)
+    finally:
+        timer.report()
+
+
+# 创建DAG
+dag = DAG(
+    dag_id=DAG_ID,
+    default_args={'owner': 'claude89757'},
+    start_date=datetime(2024, 1, 1),
+    schedule_interval=None,
+    max_active_runs=50,
+    catchup=False,
+    tags=['个人微信'],
+    description='个人微信消息快速处理(单任务)',
+)
+
+# 创建处理消息的任务
+process_message_express_task = PythonOperator(
+    task_id='process_wx_message_express',
+    python_callable=process_wx_message_express,
+    provide_context=True,
+    dag=dag
+)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+个人微信AI回复DAG
+
+功能：
+1. 房间安静后, 合并未回复的文字消息, 通过Dify的AI助手回复
+2. 保存AI回复的消息到DB
+
+特点：
+1. 由 wx_msg_debounce_scheduler 触发，不进行定时调度
+2. 最大并发运行数为200, Dify生成期间不占用worker, 并发数不受worker数量限制
+3. 每个房间的一个安静期只触发一次
+4. 等待Dify生成回复时任务处于deferred状态, 由triggerer读取流式响应, 不占用worker
+"""
+
+# 标准库导入
+from datetime import datetime
+
+# Airflow相关导入
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+
+# 自定义库导入
+from utils.room_buffer import RoomBuffer
+from utils.deferrable_operators import DifyChatOperator
+from wx_dags.common.ai_reply import get_reply_base_message, prepare_reply, send_reply, save_ai_reply_msg
+
+
+DAG_ID = "wx_msg_reply"
+
+
+def handler_prepare_reply(**context):
+    """
+    准备AI回复: 查询会话ID, 合并未回复的文字消息
+    """
+    conf = context.get('dag_run').conf
+    message_data = conf['message_data']
+    wx_account_info = conf['wx_account_info']
+    current_message = get_reply_base_message(message_data)
+    room_buffer = RoomBuffer(f"{wx_account_info['name']}_{message_data.get('roomid')}")
+    with room_buffer.watch_superseded(current_message['id']) as superseded:
+        return prepare_reply(message_data, wx_account_info, superseded)
+
+
+def handler_send_reply(**context):
+    """
+    发送AI回复到微信
+    """
+    conf = context.get('dag_run').conf
+    prepared = context['task_instance'].xcom_pull(task_ids='prepare_reply')
+    chat_result = context['task_instance'].xcom_pull(task_ids='dify_chat')
+    room_buffer = RoomBuffer(prepared['buffer_key'])
+    with room_buffer.watch_superseded(prepared['msg_id']) as superseded:
+        response = send_reply(conf['message_data'], conf['wx_account_info'], prepared,
+                              chat_result['answer'], chat_result['metadata'], superseded)
+    if response is not None:
+        # response缓存到xcom中
+        context['task_instance'].xcom_push(key='ai_reply_msg', value=response)
+
+
+def handler_save_ai_reply_msg(**context):
+    """
+    保存AI回复的消息到DB
+    """
+    conf = context.get('dag_run').conf
+    ai_reply_msg = context.get('task_instance').xcom_pull(key='ai_reply_msg')
+    save_ai_reply_msg(conf['message_data'], conf['wx_account_info'], ai_reply_msg)
+
+
+# 创建DAG
+dag = DAG(
+    dag_id=DAG_ID,
+    default_args={'owner': 'claude89757'},
+    start_date=datetime(2024, 1, 1),
+    schedule_interval=None,
+    max_active_runs=200,
+    catchup=False,
+    tags=['个人微信'],
+    description='个人微信AI回复',
+)
+
+# 准备AI回复
+prepare_reply_task = PythonOperator(
+    task_id='prepare_reply',
+    python_callable=handler_prepare_reply,
+    provide_context=True,
+    dag=dag
+)
+
+# 通过Dify生成回复, 等待期间释放worker; 房间有新消息时中断生成
+PREPARED = "ti.xcom_pull(task_ids='prepare_reply')"
+dify_chat_task = DifyChatOperator(
+    task_id='dify_chat',
+    query="{{ %s['question'] }}" % PREPARED,
+    user_id="{{ dag_run.conf['wx_account_info']['name'] }}",
+    conversation_id="{{ %s['conversation_id'] }}" % PREPARED,
+    cancel_buffer_key="{{ %s['buffer_key'] }}" % PREPARED,
+    cancel_msg_id="{{ %s['msg_id'] }}" % PREPARED,
+    dag=dag
+)
+
+# 发送AI回复
+send_reply_task = PythonOperator(
+    task_id='send_reply',
+    python_callable=handler_send_reply,
+    provide_context=True,
+    dag=dag
+)
+
+# 保存AI回复的消息到数据库
+save_ai_reply_msg_task = PythonOperator(
+    task_id='save_ai_reply_msg',
+    python_callable=handler_save_ai_reply_msg,
+    provide_context=True,
+    dag=dag
+)
+
+# 设置任务依赖关系
+prepare_reply_task >> dify_chat_task >> send_reply_task >> save_ai_reply_msg_task
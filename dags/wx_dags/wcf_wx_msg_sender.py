@@ -22,14 +22,14 @@ from datetime import datetime, timedelta
 # Airflow相关导入
 from airflow import DAG
 from airflow.operators.python import PythonOperator
-from airflow.models import Variable
 
 # 自定义库导入
 from utils.wechat_channl import send_wx_msg
 from wx_dags.common.wx_tools import WX_MSG_TYPES
 from wx_dags.common.wx_tools import update_wx_user_info
-from wx_dags.common.wx_tools import get_contact_name
+from wx_dags.common.wx_tools import get_contact_names
 from wx_dags.common.mysql_tools import save_msg_to_db
+from wx_dags.common.msg_stats import record_messages, DIRECTION_OUT
 
 
 DAG_ID = "wx_msg_sender"
@@ -82,19 +82,19 @@ def save_msg(**context):
     save_msg['wx_user_id'] = wx_account_info.get('wxid', '')
 
     # 获取房间和发送者信息
-    save_msg['room_name'] = get_contact_name(save_msg['source_ip'], save_msg['room_id'], save_msg['wx_user_name'])
+    contact_names = get_contact_names(save_msg['source_ip'], [save_msg['room_id'], save_msg['sender_id']], save_msg['wx_user_name'])
+    save_msg['room_name'] = contact_names.get(save_msg['room_id'], '')
     if save_msg['is_self']:
         save_msg['sender_name'] = save_msg['wx_user_name']
     else:
-        save_msg['sender_name'] = get_contact_name(save_msg['source_ip'], save_msg['sender_id'], save_msg['wx_user_name'])
+        save_msg['sender_name'] = contact_names.get(save_msg['sender_id'], '')
     
     # 保存消息到数据库
     save_msg_to_db(save_msg)
 
     try:
-        # 账号的消息计时器+1
-        msg_count = Variable.get(f"{save_msg['wx_user_name']}_msg_count", default_var=0, deserialize_json=True)
-        Variable.set(f"{save_msg['wx_user_name']}_msg_count", msg_count+1, serialize_json=True)
+        # 账号的消息计数+1
+        record_messages(save_msg['wx_user_name'], save_msg['room_id'], DIRECTION_OUT)
     except Exception as error:
         # 不影响主流程
         print(f"[WATCHER] 更新消息计时器失败: {error}")
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微信消息统计汇总DAG
+
+功能：
+1. 将Redis中按分钟、小时、天分桶的消息统计写入MySQL的 wx_msg_stats 表
+2. 将各账号的累计消息数同步到 {wx_user_name}_msg_count Variable
+
+特点：
+1. 每5分钟执行一次
+2. 最大并发运行数为1
+3. 写入的是时间桶的当前计数, 重复执行结果不变
+4. 时间桶结束后再写入一次, 随后移出待汇总索引
+"""
+
+# 标准库导入
+import time
+from datetime import datetime, timedelta
+
+# Airflow相关导入
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+
+# 自定义库导入
+from utils.redis import get_redis_client
+from utils.variable_cache import get_variable, set_variable
+from wx_dags.common.msg_stats import GRANULARITIES, STATS_TZ, TOTAL_KEY
+from wx_dags.common.msg_stats import bucket_key, bucket_index_key, parse_stats_field, get_account_totals
+from wx_dags.common.mysql_tools import init_wx_msg_stats_table, save_msg_stats_to_db
+
+
+DAG_ID = "wx_msg_stats_rollup"
+
+# 时间桶结束后, 等待迟到计数的时间(秒)
+CLOSE_GRACE_SECONDS = 120
+
+# 改用Redis计数之前, Variable中已有的累计值在 wx_stats:total 中的方向名
+LEGACY_DIRECTION = "legacy"
+
+
+def rollup_msg_stats(**context):
+    """
+    汇总消息统计到MySQL
+    """
+    redis_client = get_redis_client()
+    init_wx_msg_stats_table()
+
+    now = time.time()
+    for granularity, (_, bucket_seconds, _) in GRANULARITIES.items():
+        index_key = bucket_index_key(granularity)
+        buckets = redis_client.zrange(index_key, 0, -1, withscores=True)
+        print(f"[STATS] {granularity} 待汇总的时间桶: {len(buckets)}")
+
+        closed_buckets = []
+        for bucket, start in buckets:
+            counts = redis_client.hgetall(bucket_key(granularity, bucket))
+            bucket_time = datetime.fromtimestamp(start, tz=STATS_TZ).replace(tzinfo=None)
+            stats_rows = []
+            for field, count in counts.items():
+                wx_user_name, room_id, direction = parse_stats_field(field)
+                stats_rows.append((granularity, bucket_time, wx_user_name, room_id, direction, int(count)))
+            save_msg_stats_to_db(stats_rows)
+
+            # 已结束的时间桶写入最终计数后不再汇总
+            if start + bucket_seconds + CLOSE_GRACE_SECONDS < now:
+                closed_buckets.append(bucket)
+
+        if closed_buckets:
+            redis_client.zrem(index_key, *closed_buckets)
+            print(f"[STATS] {granularity} 已完成汇总的时间桶: {len(closed_buckets)}")
+
+
+def sync_msg_count_variables(**context):
+    """
+    同步各账号的累计消息数到Variable
+    """
+    redis_client = get_redis_client()
+    for wx_user_name, counts in get_account_totals(redis_client).items():
+        if LEGACY_DIRECTION not in counts:
+            # 首次同步时, 把改用Redis计数之前Variable中的累计值并入总数
+            legacy_count = get_variable(f"{wx_user_name}_msg_count", default_var=0, deserialize_json=True, ttl=0)
+            redis_client.hsetnx(TOTAL_KEY, f"{wx_user_name}|{LEGACY_DIRECTION}", int(legacy_count or 0))
+            counts = get_account_totals(redis_client)[wx_user_name]
+        msg_count = sum(counts.values())
+        print(f"[STATS] {wx_user_name} 累计消息数: {msg_count}, {counts}")
+        set_variable(f"{wx_user_name}_msg_count", msg_count, serialize_json=True)
+
+
+# 创建DAG
+dag = DAG(
+    dag_id=DAG_ID,
+    default_args={'owner': 'claude89757'},
+    start_date=datetime(2024, 1, 1),
+    schedule_interval=timedelta(minutes=5),
+    max_active_runs=1,
+    dagrun_timeout=timedelta(minutes=5),
+    catchup=False,
+    tags=['个人微信'],
+    description='个人微信消息统计汇总',
+)
+
+# 汇总消息统计到MySQL
+rollup_msg_stats_task = PythonOperator(
+    task_id='rollup_msg_stats',
+    python_callable=rollup_msg_stats,
+    provide_context=True,
+    dag=dag
+)
+
+# 同步累计消息数到Variable
+sync_msg_count_task = PythonOperator(
+    task_id='sync_msg_count_variables',
+    python_callable=sync_msg_count_variables,
+    provide_context=True,
+    dag=dag
+)
+
+rollup_msg_stats_task >> sync_msg_count_task
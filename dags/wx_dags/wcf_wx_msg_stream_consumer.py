@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+个人微信消息流消费DAG
+
+功能：
+1. 消费webhook写入Redis Stream的微信消息(路由目标为 {"sink": "stream"}), 见 wx_dags.common.stream_consumer
+2. 处理步骤与 wx_msg_watcher 相同, 每条消息不再产生DAG Run、任务实例和XCom
+
+特点：
+1. 每5分钟启动一次, 每次运行在5分钟内持续消费, 最大并发运行数为1, 保证同一房间的消息顺序
+2. 同一房间的消息按顺序处理, 不同房间并行处理
+3. 消息保存到DB后才确认, 任务中断时未确认的消息由下一次运行重新处理
+"""
+
+# 标准库导入
+from datetime import datetime, timedelta
+
+# Airflow相关导入
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+
+# 自定义库导入
+from wx_dags.common.stream_consumer import MessageStreamConsumer
+
+
+DAG_ID = "wx_msg_stream_consumer"
+
+# 每次运行的消费时长(秒), 略短于调度周期, 下一次运行可以按时开始
+RUN_SECONDS = 290
+
+
+def consume_wx_msg_stream(**context):
+    """
+    持续消费微信消息流
+    """
+    consumer = MessageStreamConsumer()
+    consumer.run(run_seconds=RUN_SECONDS)
+    print(f"[STREAM] 本次运行处理消息: {consumer.processed}, 转入死信: {consumer.failed}")
+
+
+# 创建DAG
+dag = DAG(
+    dag_id=DAG_ID,
+    default_args={'owner': 'claude89757'},
+    start_date=datetime(2024, 1, 1),
+    schedule_interval=timedelta(minutes=5),
+    max_active_runs=1,
+    dagrun_timeout=timedelta(minutes=10),
+    catchup=False,
+    tags=['个人微信'],
+    description='个人微信消息流消费',
+)
+
+# 创建消费任务
+consume_wx_msg_stream_task = PythonOperator(
+    task_id='consume_wx_msg_stream',
+    python_callable=consume_wx_msg_stream,
+    provide_context=True,
+    dag=dag
+)
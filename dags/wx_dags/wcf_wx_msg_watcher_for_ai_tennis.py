@@ -32,7 +32,10 @@ from airflow.utils.session import create_session
 from utils.wechat_channl import send_wx_msg
 from utils.wechat_channl import get_wx_contact_list
 from utils.redis import RedisLock
+from utils.variable_cache import get_variable, set_variable, delete_variable
 from utils.llm_channl import get_llm_response
+from wx_dags.common.ai_policy import AiPolicy
+from wx_dags.common.ai_policy import FLAG_AI_ENABLED, FLAG_AI_DISABLED, FLAG_VIDEO_ENABLED, FLAG_IMAGE_ENABLED
 
 
 # 微信消息类型定义
@@ -76,12 +79,43 @@ WX_MSG_TYPES = {
 
 WX_USERNAME = "教练小 H"
 
+DEFAULT_SYSTEM_PROMPT = "你是一个友好的AI助手，请用简短的中文回答关于图片的问题。"
+
+
+def load_ai_tennis_policy() -> dict:
+    """
+    从Variable读取AI网球的房间开关和系统提示词, 用于编译AI策略
+    """
+    enable_ai_room_ids = get_variable('enable_ai_room_ids', default_var=[], deserialize_json=True, ttl=0)
+    enable_ai_video_ids = get_variable('enable_ai_video_ids', default_var=[], deserialize_json=True, ttl=0)
+    system_prompt = get_variable("system_prompt", default_var=DEFAULT_SYSTEM_PROMPT, deserialize_json=True, ttl=0)
+
+    # 全局禁用AI的房间: 所有值为true的 {room_id}_disable_ai Variable
+    with create_session() as session:
+        disable_keys = [key for (key,) in session.query(Variable.key).filter(
+            Variable.key.like('%\\_disable\\_ai', escape='\\'))]
+    disabled_room_ids = [key[:-len('_disable_ai')] for key in disable_keys
+                         if get_variable(key, default_var=False, deserialize_json=True, ttl=0)]
+
+    return {
+        FLAG_AI_ENABLED: enable_ai_room_ids,
+        FLAG_AI_DISABLED: disabled_room_ids,
+        FLAG_VIDEO_ENABLED: enable_ai_video_ids,
+        # 图片处理与AI聊天使用同一个群列表
+        FLAG_IMAGE_ENABLED: enable_ai_room_ids,
+        "defaults": {"system_prompt": system_prompt},
+    }
+
+
+def get_ai_tennis_policy() -> AiPolicy:
+    return AiPolicy("ai_tennis", load_ai_tennis_policy)
+
 
 def excute_wx_command(content: str, room_id: str, sender: str, source_ip: str) -> bool:
     """执行命令"""
 
     # 检查是否是管理员
-    admin_wxid = Variable.get('admin_wxid', default_var=[], deserialize_json=True)
+    admin_wxid = get_variable('admin_wxid', default_var=[], deserialize_json=True)
     if sender not in admin_wxid:
         # 非管理员不执行命令
         print(f"[命令] {sender} 不是管理员，不执行命令")
@@ -89,52 +123,63 @@ def excute_wx_command(content: str, room_id: str, sender: str, source_ip: str) -
 
     if content.replace(f'@{WX_USERNAME}', '').strip().lower() == 'ai off':
         print("[命令] 禁用AI聊天")
-        Variable.set(f'{room_id}_disable_ai', True, serialize_json=True)
+        set_variable(f'{room_id}_disable_ai', True, serialize_json=True)
+        get_ai_tennis_policy().set_room_flag(FLAG_AI_DISABLED, room_id, True)
         send_wx_msg(wcf_ip=source_ip, message=f'[bot] {room_id} 已禁用AI聊天', receiver=room_id)
         return True
     elif content.replace(f'@{WX_USERNAME}', '').strip().lower() == 'ai on':
         print("[命令] 启用AI聊天")
-        Variable.delete(f'{room_id}_disable_ai')
+        delete_variable(f'{room_id}_disable_ai')
+        get_ai_tennis_policy().set_room_flag(FLAG_AI_DISABLED, room_id, False)
         send_wx_msg(wcf_ip=source_ip, message=f'[bot] {room_id} 已启用AI聊天', receiver=room_id)
         return True
     elif f"@{WX_USERNAME}" in content and "开启AI聊天" in content:
         # 加入AI聊天群
-        enable_ai_room_ids = Variable.get('enable_ai_room_ids', default_var=[], deserialize_json=True)
+        enable_ai_room_ids = get_variable('enable_ai_room_ids', default_var=[], deserialize_json=True, ttl=0)
         enable_ai_room_ids.append(room_id)
-        Variable.set('enable_ai_room_ids', enable_ai_room_ids, serialize_json=True)
+        set_variable('enable_ai_room_ids', enable_ai_room_ids, serialize_json=True)
+        ai_tennis_policy = get_ai_tennis_policy()
+        ai_tennis_policy.set_room_flag(FLAG_AI_ENABLED, room_id, True)
+        ai_tennis_policy.set_room_flag(FLAG_IMAGE_ENABLED, room_id, True)
         send_wx_msg(wcf_ip=source_ip, message=f'[bot] {room_id} 已加入AI聊天群', receiver=room_id)
         return True
     elif f"@{WX_USERNAME}" in content and "关闭AI聊天" in content:
         # 退出AI聊天群
-        enable_ai_room_ids = Variable.get('enable_ai_room_ids', default_var=[], deserialize_json=True)
+        enable_ai_room_ids = get_variable('enable_ai_room_ids', default_var=[], deserialize_json=True, ttl=0)
         enable_ai_room_ids.remove(room_id)
-        Variable.set('enable_ai_room_ids', enable_ai_room_ids, serialize_json=True)
+        set_variable('enable_ai_room_ids', enable_ai_room_ids, serialize_json=True)
+        ai_tennis_policy = get_ai_tennis_policy()
+        ai_tennis_policy.set_room_flag(FLAG_AI_ENABLED, room_id, False)
+        ai_tennis_policy.set_room_flag(FLAG_IMAGE_ENABLED, room_id, False)
         send_wx_msg(wcf_ip=source_ip, message=f'[bot] {room_id} 已退出AI聊天群', receiver=room_id)
         return True
     elif f"@{WX_USERNAME}" in content and "开启AI视频" in content:
         # 开启AI视频处理
-        enable_ai_video_ids = Variable.get('enable_ai_video_ids', default_var=[], deserialize_json=True)
+        enable_ai_video_ids = get_variable('enable_ai_video_ids', default_var=[], deserialize_json=True, ttl=0)
         enable_ai_video_ids.append(room_id)
-        Variable.set('enable_ai_video_ids', enable_ai_video_ids, serialize_json=True)
+        set_variable('enable_ai_video_ids', enable_ai_video_ids, serialize_json=True)
+        get_ai_tennis_policy().set_room_flag(FLAG_VIDEO_ENABLED, room_id, True)
         send_wx_msg(wcf_ip=source_ip, message=f'[bot] {room_id} 已打开AI视频处理', receiver=room_id)
         return True
     elif f"@{WX_USERNAME}" in content and "关闭AI视频" in content:
         # 关闭AI视频处理
-        enable_ai_video_ids = Variable.get('enable_ai_video_ids', default_var=[], deserialize_json=True)
+        enable_ai_video_ids = get_variable('enable_ai_video_ids', default_var=[], deserialize_json=True, ttl=0)
         enable_ai_video_ids.remove(room_id)
-        Variable.set('enable_ai_video_ids', enable_ai_video_ids, serialize_json=True)
+        set_variable('enable_ai_video_ids', enable_ai_video_ids, serialize_json=True)
+        get_ai_tennis_policy().set_room_flag(FLAG_VIDEO_ENABLED, room_id, False)
         send_wx_msg(wcf_ip=source_ip, message=f'[bot] {room_id} 已关闭AI视频处理', receiver=room_id)
         return True
     elif f"@{WX_USERNAME}" in content and "显示提示词" in content:
         # 显示系统提示词
-        system_prompt = Variable.get("system_prompt", default_var="你是一个友好的AI助手，请用简短的中文回答关于图片的问题。", deserialize_json=True)
+        system_prompt = get_ai_tennis_policy().get_room_policy(room_id)["system_prompt"] or DEFAULT_SYSTEM_PROMPT
         send_wx_msg(wcf_ip=source_ip, message=f'[bot] 当前系统提示词: \n\n---\n{system_prompt}\n---', receiver=room_id)
         return True
     elif f"@{WX_USERNAME}" in content and "设置提示词" in content:
         # 设置系统提示词
         line_list = content.splitlines()
         system_prompt = "\n".join(line_list[1:])
-        Variable.set("system_prompt", system_prompt, serialize_json=True)
+        set_variable("system_prompt", system_prompt, serialize_json=True)
+        get_ai_tennis_policy().set_default("system_prompt", system_prompt)
         send_wx_msg(wcf_ip=source_ip, message=f'[bot] 已设置系统提示词: \n\n---\n{system_prompt}\n---', receiver=room_id)
         return True
     elif f"@{WX_USERNAME}" in content and "帮助" in content:
@@ -183,7 +228,16 @@ def process_wx_message(**context):
     print("--------------------------------")
     print(json.dumps(message_data, ensure_ascii=False, indent=2))
     print("--------------------------------")
-    
+
+    # webhook聚合后的批量消息(按接收顺序), 逐条处理
+    for msg in message_data.get('batch_messages') or [message_data]:
+        process_single_message(msg)
+
+
+def process_single_message(message_data: dict):
+    """
+    处理单条微信消息: 执行命令或分发到其他DAG
+    """
     # 读取消息参数
     room_id = message_data.get('roomid')
     formatted_roomid = re.sub(r'[^a-zA-Z0-9]', '', str(room_id))  # 用于触发DAG的run_id
@@ -199,17 +253,16 @@ def process_wx_message(**context):
     if excute_wx_command(content, room_id, sender, source_ip):
         return
     
+    # 房间的AI策略(开关、系统提示词), 一次查询
+    room_policy = get_ai_tennis_policy().get_room_policy(room_id)
+
     # 检查room_id是否在AI黑名单中(全局开关)
-    if Variable.get(f'{room_id}_disable_ai', default_var=False, deserialize_json=True):
+    if room_policy[FLAG_AI_DISABLED]:
         print(f"[WATCHER] {room_id} 已禁用AI聊天，停止处理")
         return
-    
-    # 开启AI聊天群聊的room_id
-    enable_ai_room_ids = Variable.get('enable_ai_room_ids', default_var=[], deserialize_json=True)
-    # 开启AI视频处理的room_id
-    enable_ai_video_ids = Variable.get('enable_ai_video_ids', default_var=[], deserialize_json=True)
+
     # 获取系统提示词
-    system_prompt = Variable.get("system_prompt", default_var="你是一个友好的AI助手，请用简短的中文回答关于图片的问题。", deserialize_json=True)
+    system_prompt = room_policy["system_prompt"] or DEFAULT_SYSTEM_PROMPT
 
     # 生成run_id
     now = datetime.now(timezone.utc)
@@ -217,13 +270,13 @@ def process_wx_message(**context):
     run_id = f'{formatted_roomid}_{sender}_{msg_id}_{now.timestamp()}'
     
     # 分场景分发微信消息
-    if msg_type == 1 and  (is_group and room_id in enable_ai_room_ids) and f"@{WX_USERNAME}" in content:
+    if msg_type == 1 and  (is_group and room_policy[FLAG_AI_ENABLED]) and f"@{WX_USERNAME}" in content:
         # 用户的消息缓存列表（跨DAG共享该变量）
-        llm_response = get_llm_response(content, model_name="gpt-4o-mini", system_prompt=system_prompt)
+        llm_response = get_llm_response(content, model_name=room_policy["model"] or "gpt-4o-mini", system_prompt=system_prompt)
         # 发送LLM响应
         send_wx_msg(wcf_ip=source_ip, message=llm_response, receiver=room_id)
 
-    elif WX_MSG_TYPES.get(msg_type) == "视频" and (not is_group or (is_group and room_id in enable_ai_video_ids)):
+    elif WX_MSG_TYPES.get(msg_type) == "视频" and (not is_group or (is_group and room_policy[FLAG_VIDEO_ENABLED])):
         # 视频消息
         print(f"[WATCHER] {room_id} 收到视频消息, 触发AI视频处理DAG")
         trigger_dag(
@@ -233,7 +286,7 @@ def process_wx_message(**context):
             execution_date=execution_date
         )
         
-    elif WX_MSG_TYPES.get(msg_type) == "图片" and (not is_group or (is_group and room_id in enable_ai_room_ids)):
+    elif WX_MSG_TYPES.get(msg_type) == "图片" and (not is_group or (is_group and room_policy[FLAG_IMAGE_ENABLED])):
         # 图片消息
         print(f"[WATCHER] {room_id} 收到图片消息, 触发AI图片处理DAG")
         trigger_dag(
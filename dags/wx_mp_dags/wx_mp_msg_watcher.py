@@ -39,6 +39,7 @@ from airflow.utils.state import DagRunState
 
 # 自定义库导入
 from utils.dify_sdk import DifyAgent
+from utils.conversation_registry import get_mp_conversation_registry
 from utils.redis import RedisLock
 from utils.wechat_mp_channl import WeChatMPBot
 from utils.tts import text_to_speech
@@ -147,9 +148,7 @@ def handler_text_msg(**context):
             print(f"[WATCHER] 重命名会话失败: {e}")
         
         # 保存会话ID
-        conversation_infos = Variable.get("wechat_mp_conversation_infos", default_var={}, deserialize_json=True)
-        conversation_infos[from_user_name] = conversation_id
-        Variable.set("wechat_mp_conversation_infos", conversation_infos, serialize_json=True)
+        get_mp_conversation_registry().set(from_user_name, conversation_id)
     
     # 发送回复消息
     try:
@@ -397,9 +396,7 @@ def handler_image_msg(**context):
                 print(f"[WATCHER] 重命名会话失败: {e}")
             
             # 保存会话ID
-            conversation_infos = Variable.get("wechat_mp_conversation_infos", default_var={}, deserialize_json=True)
-            conversation_infos[from_user_name] = conversation_id
-            Variable.set("wechat_mp_conversation_infos", conversation_infos, serialize_json=True)
+            get_mp_conversation_registry().set(from_user_name, conversation_id)
         
         # 发送回复消息
         try:
@@ -564,9 +561,7 @@ def handler_voice_msg(**context):
                 print(f"[WATCHER] 重命名会话失败: {e}")
             
             # 保存会话ID
-            conversation_infos = Variable.get("wechat_mp_conversation_infos", default_var={}, deserialize_json=True)
-            conversation_infos[from_user_name] = conversation_id
-            Variable.set("wechat_mp_conversation_infos", conversation_infos, serialize_json=True)
+            get_mp_conversation_registry().set(from_user_name, conversation_id)
         
         # 4. 使用阿里云的文字转语音功能
         audio_response_path = os.path.join(temp_dir, f"wx_audio_response_{from_user_name}_{timestamp}.mp3")
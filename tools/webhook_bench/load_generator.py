@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+webhook_server 压测脚本
+=======================
+
+按固定速率(开环)向 webhook_server 回放WCF回调, 消息类型按比例混合文字、图片和群聊消息,
+结束后从Airflow替身服务读取实际到达的消息, 输出:
+- 吞吐量(发送速率、应答速率)
+- 应答延迟 p50/p95/p99 (从计划发送时间算起, 避免协调遗漏)
+- 应答状态分布(入队、缓冲、429、错误)
+- 丢失: 已被webhook接受但在等待时间内没有到达Airflow的消息
+- 端到端延迟 p50/p95/p99 (计划发送时间 -> 替身服务收到DAG Run)
+
+使用方法:
+   python tools/webhook_bench/load_generator.py --rate 200 --duration 60 \
+       --webhook-url http://127.0.0.1:5000 --stub-url http://127.0.0.1:8081
+
+   --json 输出机器可读的结果, 便于对比不同worker数或版本之间的回归
+"""
+
+import sys
+import math
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import httpx
+
+# WCF回调中的消息类型
+MSG_TYPE_TEXT = 1
+MSG_TYPE_IMAGE = 3
+
+TEXT_SAMPLES = [
+    "在吗",
+    "今天下午有空打球吗？",
+    "好的，收到",
+    "帮我查一下明天上海的天气",
+    "这个问题我想再确认一下，昨天说的方案最后定了吗？",
+    "哈哈哈哈",
+    "[强]",
+    "麻烦把上次的会议纪要发我一份，谢谢",
+]
+
+
+# =====================
+# Payloads
+# =====================
+
+class PayloadFactory:
+    """
+    生成与WCF回调格式一致的消息, 消息ID在单次压测内唯一
+    """
+    def __init__(self, self_wxid, rooms, groups, seed=None):
+        self.random = random.Random(seed)
+        self.self_wxid = self_wxid
+        self.contacts = [f"wxid_bench_contact_{i:04d}" for i in range(rooms)]
+        self.groups = [f"{4000000000 + i}@chatroom" for i in range(groups)]
+        self.id_base = int(time.time() * 1000) * 1000
+        self.seq = 0
+
+    def next_id(self):
+        self.seq += 1
+        return str(self.id_base + self.seq)
+
+    def base_message(self, msg_type, sender, roomid, is_group):
+        return {
+            "id": self.next_id(),
+            "ts": int(time.time()),
+            "sign": "",
+            "type": msg_type,
+            "xml": "<msgsource><silence>0</silence><membercount>0</membercount></msgsource>",
+            "sender": sender,
+            "roomid": roomid,
+            "content": "",
+            "thumb": "",
+            "extra": "",
+            "is_at": False,
+            "is_self": False,
+            "is_group": is_group,
+        }
+
+    def text(self):
+        contact = self.random.choice(self.contacts)
+        message = self.base_message(MSG_TYPE_TEXT, contact, contact, False)
+        message["content"] = self.random.choice(TEXT_SAMPLES)
+        return message
+
+    def image(self):
+        contact = self.random.choice(self.contacts)
+        message = self.base_message(MSG_TYPE_IMAGE, contact, contact, False)
+        month = time.strftime("%Y-%m")
+        message["thumb"] = f"C:\\Users\\Administrator\\Documents\\WeChat Files\\{self.self_wxid}\\FileStorage\\Cache\\{month}\\{message['id']}_t.dat"
+        message["extra"] = f"C:\\Users\\Administrator\\Documents\\WeChat Files\\{self.self_wxid}\\FileStorage\\MsgAttach\\{message['id']}.dat"
+        return message
+
+    def group(self):
+        roomid = self.random.choice(self.groups)
+        sender = self.random.choice(self.contacts)
+        message = self.base_message(MSG_TYPE_TEXT, sender, roomid, True)
+        message["content"] = self.random.choice(TEXT_SAMPLES)
+        message["is_at"] = self.random.random() < 0.1
+        return message
+
+
+def parse_mix(value):
+    """
+    解析消息类型比例, 如 "text=6,image=2,group=2"
+    """
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ("text", "image", "group"):
+            raise argparse.ArgumentTypeError(f"未知的消息类型: {name}")
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("消息类型比例不能为空")
+    return mix
+
+
+# =====================
+# Statistics
+# =====================
+
+def percentile(values, pct):
+    """
+    最近秩法计算百分位数, values需已排序
+    """
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def latency_summary(seconds):
+    values = sorted(seconds)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2) if values else None,
+        "p95_ms": round(percentile(values, 95) * 1000, 2) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 2) if values else None,
+        "max_ms": round(values[-1] * 1000, 2) if values else None,
+    }
+
+
+class Result:
+    """
+    单条回调的发送结果
+    """
+    __slots__ = ("msg_id", "kind", "scheduled_at", "acked_at", "status", "outcome")
+
+    def __init__(self, msg_id, kind, scheduled_at):
+        self.msg_id = msg_id
+        self.kind = kind
+        self.scheduled_at = scheduled_at
+        self.acked_at = None
+        self.status = None
+        self.outcome = None
+
+
+def classify_response(response):
+    """
+    按webhook的应答判断消息去向: accepted 需要到达Airflow, 其余不计入丢失
+    """
+    if response.status_code == 429:
+        return "rejected"
+    if response.status_code >= 400:
+        return "error"
+    try:
+        body = response.json()
+    except ValueError:
+        return "error"
+    if "queue_id" in body or "position" in body:
+        return "accepted"
+    return "ignored"
+
+
+# =====================
+# Load Generation
+# =====================
+
+async def send_one(client, url, message, result, semaphore):
+    async with semaphore:
+        try:
+            response = await client.post(url, json=message)
+            result.status = response.status_code
+            result.outcome = classify_response(response)
+        except httpx.HTTPError as e:
+            result.status = type(e).__name__
+            result.outcome = "error"
+        finally:
+            result.acked_at = time.time()
+
+
+async def run_load(args, factory):
+    """
+    开环发送: 第i条消息的计划发送时间为 start + i / rate, 不因服务端变慢而降速
+    """
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+    total = int(args.rate * args.duration)
+    url = f"{args.webhook_url.rstrip('/')}{args.path}"
+    semaphore = asyncio.Semaphore(args.max_in_flight)
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+
+    results = []
+    tasks = []
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        start = time.time()
+        for i in range(total):
+            scheduled_at = start + i / args.rate
+            delay = scheduled_at - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = factory.random.choices(kinds, weights)[0]
+            message = getattr(factory, kind)()
+            result = Result(message["id"], kind, scheduled_at)
+            results.append(result)
+            tasks.append(asyncio.create_task(send_one(client, url, message, result, semaphore)))
+        send_finished = time.time()
+        await asyncio.gather(*tasks)
+        ack_finished = time.time()
+
+    return results, start, send_finished, ack_finished
+
+
+async def wait_for_delivery(args, accepted_ids):
+    """
+    轮询替身服务, 直到所有已接受的消息到达或超过等待时间
+    """
+    stats_url = f"{args.stub_url.rstrip('/')}/bench/stats"
+    deadline = time.time() + args.drain_seconds
+    async with httpx.AsyncClient(timeout=30) as client:
+        while True:
+            response = await client.get(stats_url, params={"include_messages": "true"})
+            response.raise_for_status()
+            stub_stats = response.json()
+            arrivals = stub_stats.pop("message_arrivals", {})
+            missing = [msg_id for msg_id in accepted_ids if msg_id not in arrivals]
+            if not missing or time.time() >= deadline:
+                return stub_stats, arrivals, missing
+            await asyncio.sleep(1)
+
+
+async def reset_stub(args):
+    async with httpx.AsyncClient(timeout=10) as client:
+        response = await client.post(f"{args.stub_url.rstrip('/')}/bench/reset")
+        response.raise_for_status()
+
+
+def build_report(args, results, start, send_finished, ack_finished, stub_stats, arrivals, missing):
+    outcomes = {}
+    statuses = {}
+    for result in results:
+        outcomes[result.outcome] = outcomes.get(result.outcome, 0) + 1
+        statuses[str(result.status)] = statuses.get(str(result.status), 0) + 1
+
+    accepted = [result for result in results if result.outcome == "accepted"]
+    ack_latency = [result.acked_at - result.scheduled_at for result in results if result.outcome != "error"]
+    e2e_latency = [arrivals[result.msg_id] - result.scheduled_at for result in accepted if result.msg_id in arrivals]
+
+    by_kind = {}
+    for kind in args.mix:
+        kind_results = [result for result in results if result.kind == kind]
+        by_kind[kind] = latency_summary([result.acked_at - result.scheduled_at
+                                         for result in kind_results if result.outcome != "error"])
+
+    return {
+        "config": {
+            "rate": args.rate,
+            "duration": args.duration,
+            "mix": args.mix,
+            "path": args.path,
+            "max_in_flight": args.max_in_flight,
+        },
+        "throughput": {
+            "sent": len(results),
+            "send_seconds": round(send_finished - start, 3),
+            "offered_rps": round(len(results) / max(send_finished - start, 1e-9), 2),
+            "acked_rps": round(len(results) / max(ack_finished - start, 1e-9), 2),
+        },
+        "outcomes": outcomes,
+        "statuses": statuses,
+        "ack_latency": latency_summary(ack_latency),
+        "ack_latency_by_kind": by_kind,
+        "delivery": {
+            "accepted": len(accepted),
+            "delivered": len(accepted) - len(missing),
+            "lost": len(missing),
+            "loss_rate": round(len(missing) / len(accepted), 6) if accepted else 0,
+            "e2e_latency": latency_summary(e2e_latency),
+        },
+        "airflow_stub": stub_stats,
+    }
+
+
+def print_report(report):
+    throughput = report["throughput"]
+    ack = report["ack_latency"]
+    delivery = report["delivery"]
+    e2e = delivery["e2e_latency"]
+    print(f"发送: {throughput['sent']} 条, 用时 {throughput['send_seconds']}s, "
+          f"发送速率 {throughput['offered_rps']}/s, 应答速率 {throughput['acked_rps']}/s")
+    print(f"应答结果: {report['outcomes']}, 状态码: {report['statuses']}")
+    print(f"应答延迟: p50={ack['p50_ms']}ms p95={ack['p95_ms']}ms p99={ack['p99_ms']}ms max={ack['max_ms']}ms")
+    for kind, summary in report["ack_latency_by_kind"].items():
+        print(f"  {kind}: p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms")
+    print(f"投递: 接受 {delivery['accepted']}, 到达 {delivery['delivered']}, "
+          f"丢失 {delivery['lost']} ({delivery['loss_rate']:.4%})")
+    print(f"端到端延迟: p50={e2e['p50_ms']}ms p95={e2e['p95_ms']}ms p99={e2e['p99_ms']}ms max={e2e['max_ms']}ms")
+    stub = report["airflow_stub"]
+    print(f"Airflow替身: 请求 {stub['requests']}, DAG Run {stub['dag_runs']}, 409 {stub['conflicts']}, "
+          f"注入错误 {stub['injected_errors']}, 注入超时 {stub['injected_timeouts']}, 批次大小 {stub['batch_sizes']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="webhook_server 压测脚本")
+    parser.add_argument("--webhook-url", default="http://127.0.0.1:5000", help="webhook_server地址")
+    parser.add_argument("--stub-url", default="http://127.0.0.1:8081", help="Airflow替身服务地址")
+    parser.add_argument("--path", default="/wcf_callback", help="回调路径, 如 /wcf_callback 或 /callback/wcf")
+    parser.add_argument("--rate", type=float, default=100, help="每秒发送的回调数")
+    parser.add_argument("--duration", type=float, default=30, help="发送时长(秒)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=6,image=2,group=2"),
+                        help="消息类型比例, 默认 text=6,image=2,group=2")
+    parser.add_argument("--rooms", type=int, default=50, help="私聊联系人数量")
+    parser.add_argument("--groups", type=int, default=10, help="群聊数量")
+    parser.add_argument("--self-wxid", default="wxid_bench_self", help="模拟的机器人账号wxid")
+    parser.add_argument("--max-in-flight", type=int, default=500, help="最大并发请求数")
+    parser.add_argument("--timeout", type=float, default=30, help="单个请求的超时时间(秒)")
+    parser.add_argument("--drain-seconds", type=float, default=60, help="发送结束后等待消息到达Airflow的最长时间(秒)")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子, 固定后消息序列可复现")
+    parser.add_argument("--no-reset", action="store_true", help="开始前不清空替身服务的统计")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    if not args.no_reset:
+        await reset_stub(args)
+
+    factory = PayloadFactory(args.self_wxid, args.rooms, args.groups, seed=args.seed)
+    results, start, send_finished, ack_finished = await run_load(args, factory)
+    accepted_ids = [result.msg_id for result in results if result.outcome == "accepted"]
+    stub_stats, arrivals, missing = await wait_for_delivery(args, accepted_ids)
+
+    report = build_report(args, results, start, send_finished, ack_finished, stub_stats, arrivals, missing)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    return 1 if missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Airflow API 替身服务
+====================
+
+用于 webhook_server 压测, 模拟 Airflow 的 POST /api/v1/dags/{dag_id}/dagRuns 接口:
+- 可配置的响应延迟(固定延迟 + 随机抖动)
+- 可配置的错误率(返回5xx)和超时率(不返回直到客户端超时)
+- 记录收到的每条消息ID及首次到达时间, 供压测脚本计算丢失率和端到端延迟
+- 相同 dag_run_id 重复提交时返回409, 与真实Airflow一致
+
+配置(环境变量):
+   STUB_LATENCY_MS=<每次调用的固定延迟(毫秒), 默认50>
+   STUB_JITTER_MS=<随机抖动上限(毫秒), 默认0>
+   STUB_ERROR_RATE=<返回500的概率, 0~1, 默认0>
+   STUB_TIMEOUT_RATE=<挂起请求的概率, 0~1, 默认0>
+   STUB_TIMEOUT_SECONDS=<挂起请求的时长(秒), 默认30>
+
+使用方法:
+   uvicorn tools.webhook_bench.stub_airflow:app --host 0.0.0.0 --port 8081
+
+运行期间可通过 POST /bench/config 调整以上参数, GET /bench/stats 读取统计, POST /bench/reset 清空统计
+"""
+
+import os
+import time
+import random
+import asyncio
+
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
+
+# =====================
+# Configuration
+# =====================
+
+config = {
+    "latency_ms": float(os.getenv("STUB_LATENCY_MS", "50")),
+    "jitter_ms": float(os.getenv("STUB_JITTER_MS", "0")),
+    "error_rate": float(os.getenv("STUB_ERROR_RATE", "0")),
+    "timeout_rate": float(os.getenv("STUB_TIMEOUT_RATE", "0")),
+    "timeout_seconds": float(os.getenv("STUB_TIMEOUT_SECONDS", "30")),
+}
+
+# =====================
+# State
+# =====================
+
+class BenchStats:
+    """
+    替身服务收到的调用统计
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.time()
+        self.requests = 0
+        self.injected_errors = 0
+        self.injected_timeouts = 0
+        self.conflicts = 0
+        self.dag_runs = {}          # dag_run_id -> dag_id
+        self.runs_per_dag = {}      # dag_id -> 成功创建的DAG Run数
+        self.batch_sizes = {}       # 单次DAG Run携带的消息数 -> 次数
+        self.messages = {}          # msg_id -> 首次到达的时间戳
+
+    def record_run(self, dag_id, dag_run_id, conf):
+        now = time.time()
+        self.dag_runs[dag_run_id] = dag_id
+        self.runs_per_dag[dag_id] = self.runs_per_dag.get(dag_id, 0) + 1
+        messages = conf.get("batch_messages") or [conf]
+        self.batch_sizes[len(messages)] = self.batch_sizes.get(len(messages), 0) + 1
+        for message in messages:
+            msg_id = str(message.get("id", ""))
+            if msg_id and msg_id not in self.messages:
+                self.messages[msg_id] = now
+
+    def summary(self, include_messages=False):
+        result = {
+            "started_at": self.started_at,
+            "requests": self.requests,
+            "injected_errors": self.injected_errors,
+            "injected_timeouts": self.injected_timeouts,
+            "conflicts": self.conflicts,
+            "dag_runs": len(self.dag_runs),
+            "runs_per_dag": self.runs_per_dag,
+            "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            "messages": len(self.messages),
+        }
+        if include_messages:
+            result["message_arrivals"] = self.messages
+        return result
+
+
+stats = BenchStats()
+
+# =====================
+# FastAPI App Initialization
+# =====================
+
+app = FastAPI(title="Airflow API Stub", description="webhook_server压测用的Airflow API替身")
+
+# =====================
+# Routes
+# =====================
+
+@app.post("/api/v1/dags/{dag_id}/dagRuns")
+async def create_dag_run(dag_id: str, request: Request):
+    """
+    模拟Airflow触发DAG Run
+    """
+    payload = await request.json()
+    stats.requests += 1
+
+    delay = config["latency_ms"] + random.uniform(0, config["jitter_ms"])
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+    roll = random.random()
+    if roll < config["timeout_rate"]:
+        stats.injected_timeouts += 1
+        await asyncio.sleep(config["timeout_seconds"])
+        return JSONResponse(status_code=status.HTTP_504_GATEWAY_TIMEOUT, content={"detail": "injected timeout"})
+    if roll < config["timeout_rate"] + config["error_rate"]:
+        stats.injected_errors += 1
+        return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"detail": "injected error"})
+
+    dag_run_id = payload.get("dag_run_id", "")
+    if dag_run_id in stats.dag_runs:
+        stats.conflicts += 1
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"detail": f"DAGRun {dag_run_id} already exists"})
+
+    stats.record_run(dag_id, dag_run_id, payload.get("conf") or {})
+    return JSONResponse(status_code=status.HTTP_200_OK, content={
+        "dag_id": dag_id,
+        "dag_run_id": dag_run_id,
+        "state": "queued",
+    })
+
+
+@app.get("/bench/stats")
+async def get_stats(include_messages: bool = False):
+    """
+    读取统计; include_messages=true 时返回每条消息的到达时间
+    """
+    return stats.summary(include_messages=include_messages)
+
+
+@app.post("/bench/reset")
+async def reset_stats():
+    """
+    清空统计
+    """
+    stats.reset()
+    return stats.summary()
+
+
+@app.post("/bench/config")
+async def update_config(request: Request):
+    """
+    运行期间调整延迟、错误率等参数, 只更新传入的字段
+    """
+    changes = await request.json()
+    unknown = set(changes) - set(config)
+    if unknown:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": f"未知参数: {sorted(unknown)}"})
+    for key, value in changes.items():
+        config[key] = float(value)
+    return config
@@ -11,8 +11,16 @@ Optimized Webhook Server using FastAPI
 优化内容：
 - 使用FastAPI提升并发性能
 - 实现异步处理，提高API调用成功率
+- 回调消息先写入本地SQLite队列再应答, 后台投递器带重试地触发Airflow
+- 进程内共享Airflow API连接池, 复用keep-alive连接
+- 按消息ID过滤重复回调, 重复消息不会产生任何网络调用
+- 通用回调入口 /callback/{route}, 按路由表(消息类型、群聊、自己发送、房间)决定触发的DAG或在边缘过滤
+- persist sink: 只需存储的消息由webhook批量写入MySQL, 不再产生DAG Run
+- stream sink: 消息写入Redis Stream, 由常驻的消费者(wx_msg_stream_consumer)处理, 不再每条消息产生DAG Run
+- /metrics 暴露Prometheus指标: 请求数、各路由耗时、Airflow调用耗时与状态码、队列深度、重复消息命中等
+- 日志经内存队列由后台线程输出JSON, 回调数据按字段截断, 可按路由设置级别和采样率
 - 单一文件结构，简化项目架构
-- 实现API限速配置
+- 实现API限速配置: 消息先落盘, 后台投递器按账号的令牌桶限制投递Airflow的速率; 账号积压超过上限时返回429
 - 清晰的导入和代码结构
 
 使用方法：
@@ -23,8 +31,47 @@ Optimized Webhook Server using FastAPI
    AIRFLOW_BASE_URL=<Your Airflow Base URL>
    AIRFLOW_USERNAME=<Your Airflow Username>
    AIRFLOW_PASSWORD=<Your Airflow Password>
+   AIRFLOW_HTTP_TIMEOUT=<调用Airflow API的超时时间(秒), 默认10>
+   AIRFLOW_HTTP_MAX_CONNECTIONS=<Airflow API连接池的最大连接数, 默认20>
+   AIRFLOW_HTTP_MAX_KEEPALIVE=<Airflow API连接池的最大keep-alive连接数, 默认10>
+   AIRFLOW_HTTP_KEEPALIVE_EXPIRY=<keep-alive连接的空闲过期时间(秒), 默认30>
+   AIRFLOW_HTTP2=<是否启用HTTP/2(需安装h2), 默认true>
    RATE_LIMIT_UPDATE=<Rate limit for /update endpoint, e.g., "10/minute">
-   RATE_LIMIT_WCF=<Rate limit for /wcf_callback endpoint, e.g., "100/minute">
+   RATE_LIMIT_WCF=<每个微信账号(source_ip)投递到每个目标DAG的默认速率, 如 "100/minute", 配置Redis后多个worker共享限额>
+   RATE_LIMIT_TARGETS=<可选, 按投递目标(路由表中的dag_id)覆盖RATE_LIMIT_WCF, 如 "wx_msg_watcher=100/minute,wx_msg_watcher_for_ai_tennis=30/minute">
+   WCF_AGGREGATE_WINDOW_SECONDS=<同一房间消息聚合的静默窗口(秒), 0表示不聚合, 默认2>
+   WCF_AGGREGATE_MAX_WAIT_SECONDS=<单个聚合批次的最长等待时间(秒), 默认10>
+   WCF_AGGREGATE_MAX_BATCH_SIZE=<单个聚合批次的最大消息数, 默认20>
+   RATE_LIMIT_OVERFLOW_SIZE=<目标DAG配置了限流时, 每个账号在本地队列中等待投递到该目标的最大消息数, 超过后返回429, 默认200>
+   WEBHOOK_REDIS_URL=<可选, 如 redis://redis:6379/0, 用于共享重复消息过滤、限流和路由表; 使用stream sink或persist sink的消息统计时必须指向Airflow使用的Redis>
+   DEDUP_TTL_SECONDS=<重复消息过滤的记忆时间(秒), 默认600>
+   DEDUP_MAX_ENTRIES=<本地重复消息过滤的最大条数, 默认100000>
+   DEDUP_REDIS_URL=<可选, 默认同 WEBHOOK_REDIS_URL, 多个worker共享重复消息过滤>
+   ROUTES_FILE=<可选, 回调路由表JSON文件, 格式见 webhook_routes.example.json>
+   ROUTES_REDIS_KEY=<Redis中路由表的key, 优先于ROUTES_FILE, 默认 webhook:routes>
+   ROUTES_RELOAD_SECONDS=<路由表重新加载的间隔(秒), 默认60>
+   WX_DB_HOST / WX_DB_PORT / WX_DB_USER / WX_DB_PASSWORD / WX_DB_NAME=<可选, 聊天记录MySQL, 配置后启用persist sink>
+   WX_DB_POOL_SIZE=<MySQL连接池大小, 默认5>
+   PERSIST_FLUSH_INTERVAL_MS=<persist sink批量写入的间隔(毫秒), 默认200>
+   PERSIST_FLUSH_MAX_ROWS=<persist sink单次批量写入的最大行数, 达到后立即写入, 默认200>
+   WX_MSG_STREAM_KEY=<stream sink写入的Redis Stream, 配置WEBHOOK_REDIS_URL后启用, 默认 wx_msg_stream>
+   WX_MSG_STREAM_MAXLEN=<Redis Stream保留的最大消息数(近似裁剪), 默认100000>
+   WCF_API_PORT=<WCF API端口, 默认9999>
+   WCF_CONTACTS_TTL_SECONDS=<WCF联系人名称缓存时间(秒), 默认3600>
+   WCF_CONTACTS_MISS_REFRESH_SECONDS=<遇到未知联系人时刷新缓存的最小间隔(秒), 默认60>
+   INGEST_QUEUE_PATH=<本地持久化队列的SQLite文件路径, 默认 database/webhook/ingest_queue.db>
+   DISPATCH_CONCURRENCY=<后台投递Airflow的最大并发数, 默认8>
+   DISPATCH_MAX_RETRIES=<单条消息的最大投递次数, 默认10>
+   DISPATCH_RETRY_BASE_SECONDS=<投递失败的指数退避基数(秒), 默认1>
+   DISPATCH_LEASE_SECONDS=<出队消息的租约时间(秒), 超时未确认则重新投递, 默认60>
+   DISPATCH_POLL_INTERVAL=<投递循环的轮询间隔(秒), 默认0.2>
+   LOG_LEVEL=<日志级别, 默认INFO>
+   LOG_FORMAT=<日志格式, json或text, 默认json>
+   LOG_QUEUE_SIZE=<日志内存队列长度, 队列满时丢弃日志, 默认10000>
+   LOG_PAYLOAD_MAX_CHARS=<日志中回调数据每个字段的最大长度, 默认512>
+   LOG_ROUTE_LEVELS=<可选, 按路由的日志级别, 如 "wcf=WARNING,update=INFO">
+   LOG_ROUTE_SAMPLE_RATES=<可选, 按路由的INFO及以下日志采样率, 如 "wcf=0.1", WARNING及以上不采样>
+   PROMETHEUS_MULTIPROC_DIR=<可选, 多worker部署时prometheus_client的共享目录, 启动前需清空>
 
 3. 运行服务器:
    使用 Uvicorn 启动:
@@ -39,17 +86,47 @@ Optimized Webhook Server using FastAPI
 
 import os
 import re
+import json
+import uuid
+import sqlite3
 import subprocess
+import copy
+import queue
+import atexit
+import random
 import logging
-from logging.handlers import RotatingFileHandler
-from datetime import datetime
+import contextvars
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import time
 
+import math
 import asyncio
 import httpx
 from fastapi import FastAPI, Request, status
-from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.responses import PlainTextResponse, JSONResponse, Response
 from dotenv import load_dotenv
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, REGISTRY
+)
+
+try:
+    import h2  # noqa: F401  httpx的HTTP/2支持依赖h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
 
 # =====================
 # Configuration
@@ -63,9 +140,74 @@ AIRFLOW_BASE_URL = os.getenv("AIRFLOW_BASE_URL")
 AIRFLOW_USERNAME = os.getenv("AIRFLOW_USERNAME")
 AIRFLOW_PASSWORD = os.getenv("AIRFLOW_PASSWORD")
 
+# Airflow API 连接池配置
+AIRFLOW_HTTP_TIMEOUT = float(os.getenv("AIRFLOW_HTTP_TIMEOUT", "10"))
+AIRFLOW_HTTP_MAX_CONNECTIONS = int(os.getenv("AIRFLOW_HTTP_MAX_CONNECTIONS", "20"))
+AIRFLOW_HTTP_MAX_KEEPALIVE = int(os.getenv("AIRFLOW_HTTP_MAX_KEEPALIVE", "10"))
+AIRFLOW_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("AIRFLOW_HTTP_KEEPALIVE_EXPIRY", "30"))
+AIRFLOW_HTTP2 = os.getenv("AIRFLOW_HTTP2", "true").lower() in ("1", "true", "yes")
+
+# 消息聚合配置: 同一 (source_ip, roomid) 的连续消息在静默窗口内合并为一次DAG触发
+WCF_AGGREGATE_WINDOW_SECONDS = float(os.getenv("WCF_AGGREGATE_WINDOW_SECONDS", "2"))
+WCF_AGGREGATE_MAX_WAIT_SECONDS = float(os.getenv("WCF_AGGREGATE_MAX_WAIT_SECONDS", "10"))
+WCF_AGGREGATE_MAX_BATCH_SIZE = int(os.getenv("WCF_AGGREGATE_MAX_BATCH_SIZE", "20"))
+
+# webhook使用的Redis, 用于共享重复消息过滤和路由表
+WEBHOOK_REDIS_URL = os.getenv("WEBHOOK_REDIS_URL", "")
+
+# 重复消息过滤配置: 本地LRU+TTL, 配置Redis后多个worker共享
+DEDUP_TTL_SECONDS = float(os.getenv("DEDUP_TTL_SECONDS", "600"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+DEDUP_REDIS_URL = os.getenv("DEDUP_REDIS_URL", WEBHOOK_REDIS_URL)
+
+# 回调路由表配置: 优先读取Redis中的key, 其次读取本地JSON文件
+ROUTES_REDIS_KEY = os.getenv("ROUTES_REDIS_KEY", "webhook:routes")
+ROUTES_FILE = os.getenv("ROUTES_FILE", "")
+ROUTES_RELOAD_SECONDS = float(os.getenv("ROUTES_RELOAD_SECONDS", "60"))
+
+# 限流配置: 按 (投递目标, source_ip) 的令牌桶, 格式如 "100/minute", 留空表示不限流
+RATE_LIMIT_UPDATE = os.getenv("RATE_LIMIT_UPDATE", "")
+RATE_LIMIT_WCF = os.getenv("RATE_LIMIT_WCF", "")
+# 按投递目标覆盖 RATE_LIMIT_WCF, 如 "wx_msg_watcher=100/minute,wx_msg_watcher_for_ai_tennis=30/minute"
+RATE_LIMIT_TARGETS = os.getenv("RATE_LIMIT_TARGETS", "")
+RATE_LIMIT_OVERFLOW_SIZE = int(os.getenv("RATE_LIMIT_OVERFLOW_SIZE", "200"))
+
+# 仅存储消息的快速通道: webhook直接批量写入MySQL的 wx_chat_records 表
+WX_DB_HOST = os.getenv("WX_DB_HOST", "")
+WX_DB_PORT = int(os.getenv("WX_DB_PORT", "3306"))
+WX_DB_USER = os.getenv("WX_DB_USER", "")
+WX_DB_PASSWORD = os.getenv("WX_DB_PASSWORD", "")
+WX_DB_NAME = os.getenv("WX_DB_NAME", "")
+WX_DB_POOL_SIZE = int(os.getenv("WX_DB_POOL_SIZE", "5"))
+PERSIST_FLUSH_INTERVAL_MS = int(os.getenv("PERSIST_FLUSH_INTERVAL_MS", "200"))
+PERSIST_FLUSH_MAX_ROWS = int(os.getenv("PERSIST_FLUSH_MAX_ROWS", "200"))
+WX_MSG_STREAM_KEY = os.getenv("WX_MSG_STREAM_KEY", "wx_msg_stream")
+WX_MSG_STREAM_MAXLEN = int(os.getenv("WX_MSG_STREAM_MAXLEN", "100000"))
+
+# WCF API配置, 用于获取账号信息和联系人名称
+WCF_API_PORT = os.getenv("WCF_API_PORT", "9999")
+WCF_CONTACTS_TTL_SECONDS = float(os.getenv("WCF_CONTACTS_TTL_SECONDS", "3600"))
+WCF_CONTACTS_MISS_REFRESH_SECONDS = float(os.getenv("WCF_CONTACTS_MISS_REFRESH_SECONDS", "60"))
+
+# 日志配置: 日志经队列由后台线程输出, 支持按路由设置级别和采样率
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "512"))
+LOG_ROUTE_LEVELS = os.getenv("LOG_ROUTE_LEVELS", "")
+LOG_ROUTE_SAMPLE_RATES = os.getenv("LOG_ROUTE_SAMPLE_RATES", "")
+
 # Repository Path
 REPO_PATH = os.path.dirname(os.path.abspath(__file__))
 
+# 本地持久化队列与后台投递配置
+INGEST_QUEUE_PATH = os.getenv("INGEST_QUEUE_PATH", os.path.join(REPO_PATH, "database", "webhook", "ingest_queue.db"))
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", "8"))
+DISPATCH_MAX_RETRIES = int(os.getenv("DISPATCH_MAX_RETRIES", "10"))
+DISPATCH_RETRY_BASE_SECONDS = float(os.getenv("DISPATCH_RETRY_BASE_SECONDS", "1"))
+DISPATCH_LEASE_SECONDS = float(os.getenv("DISPATCH_LEASE_SECONDS", "60"))
+DISPATCH_POLL_INTERVAL = float(os.getenv("DISPATCH_POLL_INTERVAL", "0.2"))
+
 # 设置时区为中国时区
 os.environ['TZ'] = 'Asia/Shanghai'
 try:
@@ -78,20 +220,213 @@ except AttributeError:
 # Logging Configuration
 # =====================
 
+# 当前请求所属的回调路由, 由路由处理函数设置, 日志按路由决定级别和采样率
+log_route = contextvars.ContextVar("log_route", default="")
+
+
+def parse_route_settings(value, convert):
+    """
+    解析按路由的日志配置, 如 "wcf=WARNING,update=INFO"
+    """
+    settings = {}
+    for item in value.split(","):
+        route, sep, setting = item.partition("=")
+        if sep and route.strip():
+            settings[route.strip()] = convert(setting.strip())
+    return settings
+
+
+def parse_log_level(name, invalid_names):
+    """
+    日志级别名称转为数值, 无法识别的名称记录到 invalid_names 并使用INFO
+    """
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        invalid_names.append(name)
+        return logging.INFO
+    return level
+
+
+def truncate_payload(payload, max_chars):
+    """
+    截断payload中过长的字符串字段, 保留结构便于检索
+    """
+    if isinstance(payload, dict):
+        return {key: truncate_payload(value, max_chars) for key, value in payload.items()}
+    if isinstance(payload, list):
+        return [truncate_payload(value, max_chars) for value in payload]
+    if isinstance(payload, str) and len(payload) > max_chars:
+        return f"{payload[:max_chars]}...(共{len(payload)}字符)"
+    return payload
+
+
+class RouteLogFilter(logging.Filter):
+    """
+    按当前路由过滤日志: 路由可单独设置级别; INFO及以下按路由采样, WARNING及以上始终保留
+    """
+    def __init__(self, default_level, route_levels, sample_rates):
+        super().__init__()
+        self.default_level = default_level
+        self.route_levels = route_levels
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        route = getattr(record, "route", None) or log_route.get()
+        record.route = route
+        if record.levelno < self.route_levels.get(route, self.default_level):
+            return False
+        sample_rate = self.sample_rates.get(route, 1.0)
+        if record.levelno < logging.WARNING and sample_rate < 1.0 and random.random() >= sample_rate:
+            return False
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    日志记录放入内存队列后立即返回, 由后台线程输出; 队列满时丢弃并计数, 不阻塞事件循环
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # 只在调用方合并消息参数, payload的序列化和截断在输出线程中完成
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        payload = getattr(record, "payload", None)
+        if isinstance(payload, dict):
+            # 浅拷贝, 避免输出前payload被后续处理修改
+            record.payload = dict(payload)
+        return record
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    每条日志输出为一行JSON
+    """
+    def __init__(self, payload_max_chars):
+        super().__init__()
+        self.payload_max_chars = payload_max_chars
+
+    def format(self, record):
+        entry = {
+            "time": f"{self.formatTime(record, '%Y-%m-%d %H:%M:%S')}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "route", ""):
+            entry["route"] = record.route
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            entry["payload"] = truncate_payload(payload, self.payload_max_chars)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    """
+    文本格式日志, payload截断后附加在消息末尾
+    """
+    def __init__(self, payload_max_chars):
+        super().__init__('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+        self.payload_max_chars = payload_max_chars
+
+    def format(self, record):
+        line = super().format(record)
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            line = f"{line}, 数据: {truncate_payload(payload, self.payload_max_chars)}"
+        return line
+
+
 def setup_logging():
+    """
+    日志经内存队列交给后台线程写到标准输出, 事件循环中不做同步IO
+    """
+    invalid_levels = []
+    default_level = parse_log_level(LOG_LEVEL, invalid_levels)
+    route_levels = parse_route_settings(LOG_ROUTE_LEVELS, lambda value: parse_log_level(value, invalid_levels))
+    sample_rates = parse_route_settings(LOG_ROUTE_SAMPLE_RATES, float)
+
     logger = logging.getLogger("webhook_server")
-    logger.setLevel(logging.INFO)
+    # logger本身放行所有路由中最低的级别, 具体级别由RouteLogFilter按路由判断
+    logger.setLevel(min([default_level, *route_levels.values()]))
+    logger.addFilter(RouteLogFilter(default_level, route_levels, sample_rates))
 
     # 将日志输出到标准输出，这样可以通过docker logs查看
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
-    )
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    return logger
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "text":
+        stream_handler.setFormatter(TextLogFormatter(LOG_PAYLOAD_MAX_CHARS))
+    else:
+        stream_handler.setFormatter(JsonLogFormatter(LOG_PAYLOAD_MAX_CHARS))
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    listener = QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    # 进程退出前输出队列中剩余的日志
+    atexit.register(stop_log_listener, listener)
+
+    for name in invalid_levels:
+        logger.warning(f'无效的日志级别: {name}, 使用INFO')
+    return logger, queue_handler, listener
+
+
+def stop_log_listener(listener):
+    """
+    停止日志输出线程, 重复调用时直接返回
+    """
+    if listener._thread is not None:
+        listener.stop()
+
+
+logger, log_queue_handler, log_listener = setup_logging()
+
+# =====================
+# Metrics
+# =====================
+# gunicorn多worker部署时, 设置 PROMETHEUS_MULTIPROC_DIR 环境变量可汇总所有worker的指标
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
-logger = setup_logging()
+HTTP_REQUESTS = Counter(
+    "webhook_http_requests_total", "HTTP请求数", ["route", "method", "status"])
+HTTP_REQUEST_LATENCY = Histogram(
+    "webhook_http_request_duration_seconds", "HTTP请求处理耗时", ["route"], buckets=LATENCY_BUCKETS)
+AIRFLOW_TRIGGER_LATENCY = Histogram(
+    "webhook_airflow_trigger_duration_seconds", "trigger_airflow_dag 耗时", ["dag_id"], buckets=LATENCY_BUCKETS)
+AIRFLOW_RESPONSES = Counter(
+    "webhook_airflow_responses_total", "Airflow API响应状态码, 请求异常记为error", ["dag_id", "status"])
+DISPATCH_BATCHES = Counter(
+    "webhook_dispatch_batches_total", "后台投递的批次数", ["target", "result"])
+DISPATCH_BATCH_SIZE = Histogram(
+    "webhook_dispatch_batch_size", "每个投递批次的消息数", buckets=(1, 2, 3, 5, 10, 20, 50))
+QUEUE_DEPTH = Gauge(
+    "webhook_ingest_queue_depth", "本地队列中的消息数", ["status"], multiprocess_mode="max")
+RATE_LIMIT_ADMISSIONS = Counter(
+    "webhook_rate_limit_admissions_total", "限流判定结果", ["route", "result"])
+ROUTED_MESSAGES = Counter(
+    "webhook_routed_messages_total", "按路由规则分发的消息数", ["route", "target"])
+PERSIST_ROWS = Counter(
+    "webhook_persist_rows_total", "persist sink写入MySQL的行数", ["result"])
+PERSIST_FLUSH_LATENCY = Histogram(
+    "webhook_persist_flush_duration_seconds", "persist sink单次批量写入耗时", buckets=LATENCY_BUCKETS)
+DEDUPE_RESULTS = Counter(
+    "webhook_dedupe_total", "重复消息过滤结果, hit表示重复消息", ["result"])
 
 # =====================
 # FastAPI App Initialization
@@ -99,6 +434,30 @@ logger = setup_logging()
 
 app = FastAPI(title="Optimized Webhook Server")
 
+# 进程内共享的Airflow API客户端, 在应用启动时创建、关闭时释放
+airflow_client = None
+
+# 定期重新加载路由表的后台任务
+routes_reload_task = None
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """
+    记录每个路由的请求数和处理耗时, 按路由模板聚合避免标签爆炸
+    """
+    start_time = time.perf_counter()
+    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        HTTP_REQUEST_LATENCY.labels(route=route_path).observe(time.perf_counter() - start_time)
+        HTTP_REQUESTS.labels(route=route_path, method=request.method, status=str(status_code)).inc()
+
 # =====================
 # Routes
 # =====================
@@ -109,11 +468,15 @@ async def update_code(request: Request):
     处理GitHub webhook请求，执行代码更新
     """
     try:
+        log_route.set("update")
         logger.info('接收到GitHub webhook请求')
-        
-        # 使用loop.run_in_executor替代asyncio.to_thread
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, execute_git_commands)
+
+        allowed, retry_after = await update_rate_limiter.try_acquire(request.client.host)
+        if not allowed:
+            logger.warning(f'代码更新请求超出限流, Retry-After: {retry_after}')
+            return PlainTextResponse(content="请求过于频繁", status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                     headers={"Retry-After": str(retry_after)})
+        await run_git_commands()
 
         logger.info('代码更新成功')
         return PlainTextResponse(content="更新成功", status_code=status.HTTP_200_OK)
@@ -124,11 +487,16 @@ async def update_code(request: Request):
         logger.error(f'代码更新失败: {e}')
         return PlainTextResponse(content="更新失败", status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@app.post("/wcf_callback")
-async def handle_wcf_callback(request: Request):
+@app.post("/callback/{route}")
+async def handle_callback(route: str, request: Request):
     """
-    处理WCF回调请求，触发Airflow DAG
+    通用回调入口: 按路由表决定消息触发哪个DAG, 或在边缘直接过滤
     """
+    log_route.set(route)
+    if not routing_table.has_route(route):
+        logger.warning(f'未配置的回调路由: {route}')
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": f"未配置的回调路由: {route}"})
+
     try:
         callback_data = await request.json()
         if not callback_data:
@@ -137,55 +505,61 @@ async def handle_wcf_callback(request: Request):
 
         # 获取请求的源IP地址
         client_ip = request.client.host
-        logger.info(f'接收到来自 {client_ip} 的WCF回调数据: {callback_data}')
+        logger.info(f'接收到来自 {client_ip} 的WCF回调数据, 路由: {route}', extra={"payload": callback_data})
         
         # 将源IP添加到callback_data中
         callback_data['source_ip'] = client_ip
 
-        # Trigger Airflow DAG asynchronously
-        dag_run_id = await trigger_airflow_dag(callback_data, dag_id='wx_msg_watcher')
+        # 过滤重复回调, 不产生任何网络调用
+        dedup_key = callback_dedup_key(callback_data)
+        if dedup_key and await seen_messages.check_and_add(dedup_key):
+            logger.info(f'重复消息, 已忽略: {dedup_key}')
+            return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "重复消息, 已忽略"})
 
-        logger.info(f'Airflow DAG触发成功, dag_run_id: {dag_run_id}')
-        return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "DAG触发成功", "dag_run_id": dag_run_id})
+        # 按路由规则决定消息去向, 被过滤的消息不占用限流配额
+        target = routing_table.resolve(route, callback_data)
+        ROUTED_MESSAGES.labels(route=route, target=target.name).inc()
+        if target.sink == SINK_DROP:
+            logger.info(f'消息按路由规则忽略, 路由: {route}, 消息类型: {callback_data.get("type")}')
+            return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "消息已按路由规则忽略"})
+
+        # 消息落盘后立即应答, 由后台投递器按 (目标, 账号) 限流异步投递; 积压超过上限时不落盘, 返回429由WCF重试
+        try:
+            queue_id, backlog = await enqueue_callback(callback_data, target.name)
+        except Exception:
+            if dedup_key:
+                await seen_messages.discard(dedup_key)
+            raise
+
+        if queue_id is None:
+            retry_after = wcf_rate_limiter.backlog_retry_after(backlog, scope=target.name)
+            logger.warning(f'{client_ip} 投递到 {target.name} 的待投递消息已达上限({backlog}), Retry-After: {retry_after}')
+            if dedup_key:
+                await seen_messages.discard(dedup_key)
+            return rate_limited_response(retry_after)
+
+        logger.info(f'消息已入队, 目标: {target.name}, queue_id: {queue_id}')
+        return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "消息已入队", "queue_id": queue_id})
 
-    except httpx.RequestError as req_err:
-        logger.error(f'调用Airflow API时发生请求异常: {req_err}')
-        return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"message": "Airflow API请求失败", "error": str(req_err)})
     except Exception as e:
         logger.error(f'处理WCF回调失败: {e}')
         return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"message": "处理失败", "error": str(e)})
 
 
-@app.post("/wcf_callback_for_ai_tennis")
-async def handle_wcf_callback_for_ai_tennis(request: Request):
+@app.post("/wcf_callback")
+async def handle_wcf_callback(request: Request):
     """
-    处理WCF回调请求，触发Airflow DAG
+    处理WCF回调请求, 兼容旧地址, 等同于 /callback/wcf
     """
-    try:
-        callback_data = await request.json()
-        if not callback_data:
-            logger.warning('没有收到有效的回调数据')
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "无效的数据"})
-
-        # 获取请求的源IP地址
-        client_ip = request.client.host
-        logger.info(f'接收到来自 {client_ip} 的WCF回调数据: {callback_data}')
-        
-        # 将源IP添加到callback_data中
-        callback_data['source_ip'] = client_ip
+    return await handle_callback("wcf", request)
 
-        # Trigger Airflow DAG asynchronously
-        dag_run_id = await trigger_airflow_dag(callback_data, dag_id='wx_msg_watcher_for_ai_tennis')
 
-        logger.info(f'Airflow DAG触发成功, dag_run_id: {dag_run_id}')
-        return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "DAG触发成功", "dag_run_id": dag_run_id})
-
-    except httpx.RequestError as req_err:
-        logger.error(f'调用Airflow API时发生请求异常: {req_err}')
-        return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"message": "Airflow API请求失败", "error": str(req_err)})
-    except Exception as e:
-        logger.error(f'处理WCF回调失败: {e}')
-        return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"message": "处理失败", "error": str(e)})
+@app.post("/wcf_callback_for_ai_tennis")
+async def handle_wcf_callback_for_ai_tennis(request: Request):
+    """
+    处理WCF回调请求, 兼容旧地址, 等同于 /callback/wcf_ai_tennis
+    """
+    return await handle_callback("wcf_ai_tennis", request)
 
 
 @app.get("/health")
@@ -195,13 +569,39 @@ async def health_check():
     """
     return JSONResponse(
         status_code=status.HTTP_200_OK,
-        content={"status": "healthy", "timestamp": datetime.now().isoformat()}
+        content={"status": "healthy", "timestamp": datetime.now().isoformat(), "queue_depth": await ingest_queue.depth(),
+                 "dedupe": seen_messages.stats(), "log_dropped": log_queue_handler.dropped}
     )
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus指标端点
+    """
+    for status_value in ("pending", "inflight", "dead"):
+        QUEUE_DEPTH.labels(status=status_value).set(0)
+    for status_value, count in (await ingest_queue.depth()).items():
+        QUEUE_DEPTH.labels(status=status_value).set(count)
+
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
 # =====================
 # Helper Functions
 # =====================
 
+async def run_git_commands():
+    """
+    在线程池中执行git命令, 避免阻塞事件循环
+    """
+    # 使用loop.run_in_executor替代asyncio.to_thread
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, execute_git_commands)
+
 def execute_git_commands():
     """
     执行git fetch和git reset命令以更新代码
@@ -218,12 +618,47 @@ def execute_git_commands():
         logger.error(f'Git命令执行失败: {e}')
         raise
 
+def create_airflow_client():
+    """
+    创建进程内共享的Airflow API客户端, 复用连接池与keep-alive连接, 支持时启用HTTP/2
+    """
+    http2_enabled = AIRFLOW_HTTP2 and HTTP2_AVAILABLE
+    if AIRFLOW_HTTP2 and not HTTP2_AVAILABLE:
+        logger.warning('未安装h2库, Airflow API客户端使用HTTP/1.1')
+    logger.info(f'创建Airflow API客户端, 最大连接数: {AIRFLOW_HTTP_MAX_CONNECTIONS}, '
+                f'最大keep-alive连接数: {AIRFLOW_HTTP_MAX_KEEPALIVE}, HTTP/2: {http2_enabled}')
+    return httpx.AsyncClient(
+        base_url=AIRFLOW_BASE_URL,
+        auth=(AIRFLOW_USERNAME, AIRFLOW_PASSWORD),
+        timeout=AIRFLOW_HTTP_TIMEOUT,
+        http2=http2_enabled,
+        limits=httpx.Limits(
+            max_connections=AIRFLOW_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AIRFLOW_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=AIRFLOW_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+async def enqueue_callback(callback_data, target):
+    """
+    回调消息写入本地队列, 按 (投递目标, source_ip, roomid) 分组聚合
+
+    返回 (queue_id, 账号投递到该目标的待投递消息数); 目标配置了限流且积压已达上限时不写入, queue_id为None
+    """
+    source_ip = callback_data.get('source_ip', '')
+    batch_key = f"{target}|{source_ip}|{callback_data.get('roomid', '')}"
+    max_backlog = RATE_LIMIT_OVERFLOW_SIZE if wcf_rate_limiter.limit_for(target) else 0
+    queue_id, backlog = await ingest_queue.put(target, batch_key, callback_data, account=f"{target}|{source_ip}",
+                                               max_backlog=max_backlog)
+    if queue_id is not None:
+        airflow_dispatcher.notify()
+    return queue_id, backlog
+
 async def trigger_airflow_dag(callback_data, dag_id):
     """
     异步触发Airflow DAG
     """
     try:
-        # todo(@claude89757): 这里可以考虑增加消息聚合的逻辑，等待一段时间，多个消息合并为一个, 触发一次dag
         # 根据Airflow的DAG run ID命名规范, 删除所有非字母数字字符
         formatted_roomid = re.sub(r'[^a-zA-Z0-9]', '', str(callback_data.get("roomid", "")))
         msg_id = str(callback_data.get("id", ""))
@@ -237,16 +672,27 @@ async def trigger_airflow_dag(callback_data, dag_id):
 
         logger.info(f'准备触发Airflow DAG, dag_run_id: {dag_run_id}')
 
-        async with httpx.AsyncClient(auth=(AIRFLOW_USERNAME, AIRFLOW_PASSWORD), timeout=10) as client:
-            response = await client.post(
-                f"{AIRFLOW_BASE_URL}/api/v1/dags/{dag_id}/dagRuns",
+        start_time = time.perf_counter()
+        try:
+            response = await airflow_client.post(
+                f"/api/v1/dags/{dag_id}/dagRuns",
                 json=airflow_payload,
                 headers={'Content-Type': 'application/json'}
             )
+        except httpx.RequestError:
+            AIRFLOW_RESPONSES.labels(dag_id=dag_id, status="error").inc()
+            raise
+        finally:
+            AIRFLOW_TRIGGER_LATENCY.labels(dag_id=dag_id).observe(time.perf_counter() - start_time)
+        AIRFLOW_RESPONSES.labels(dag_id=dag_id, status=str(response.status_code)).inc()
 
         if response.status_code in [200, 201]:
             logger.info(f'成功触发Airflow DAG: {dag_id}, dag_run_id: {dag_run_id}')
             return dag_run_id
+        elif response.status_code == 409:
+            # 重试投递时DAG Run已存在, 说明之前的请求已成功
+            logger.info(f'Airflow DAG Run已存在, 视为触发成功: {dag_id}, dag_run_id: {dag_run_id}')
+            return dag_run_id
         else:
             logger.error(f'触发Airflow DAG失败: {response.status_code} - {response.text}')
             response.raise_for_status()
@@ -258,6 +704,1217 @@ async def trigger_airflow_dag(callback_data, dag_id):
         logger.error(f'触发Airflow DAG任务失败: {e}')
         raise
 
+# =====================
+# Routing Table
+# =====================
+
+SINK_DROP = "drop"
+SINK_PERSIST = "persist"
+SINK_STREAM = "stream"
+
+# 配置了聊天记录MySQL时启用persist sink
+PERSIST_ENABLED = bool(WX_DB_HOST) and aiomysql is not None
+# 配置了Redis时启用stream sink, 消息由常驻的消费者处理
+STREAM_ENABLED = bool(WEBHOOK_REDIS_URL) and aioredis is not None
+
+# 未配置路由表时的默认规则, 与原有的两个回调地址保持一致
+# - wx_msg_watcher 只对文字、图片、视频消息有额外处理, 启用persist sink时其他类型直接入库, 由webhook计入消息统计
+# - ai_tennis 的DAG只处理文字、图片、视频消息, 其他类型在边缘直接过滤
+DEFAULT_ROUTES = {
+    "wcf": {
+        "rules": [
+            {"match": {"types": [1, 3, 43]}, "target": {"dag_id": "wx_msg_watcher"}},
+        ],
+        "default": {"sink": SINK_PERSIST} if PERSIST_ENABLED else {"dag_id": "wx_msg_watcher"},
+    },
+    "wcf_ai_tennis": {
+        "rules": [
+            {"match": {"types": [1, 3, 43]}, "target": {"dag_id": "wx_msg_watcher_for_ai_tennis"}},
+        ],
+        "default": {"sink": SINK_DROP},
+    },
+}
+
+
+class RouteTarget:
+    """
+    消息的投递目标: 触发某个DAG, 或交给某个sink处理
+    """
+
+    __slots__ = ("dag_id", "sink", "name")
+
+    def __init__(self, config):
+        self.dag_id = config.get("dag_id")
+        self.sink = config.get("sink")
+        if bool(self.dag_id) == bool(self.sink):
+            raise ValueError(f"路由目标必须且只能配置 dag_id 或 sink 之一: {config}")
+        if self.sink and self.sink not in ROUTE_SINKS:
+            raise ValueError(f"未知的sink: {self.sink}, 可选: {sorted(ROUTE_SINKS)}")
+        # 作为队列中的投递目标名称
+        self.name = self.dag_id or f"sink:{self.sink}"
+
+
+class RouteRule:
+    """
+    预编译的路由规则, 未配置的条件视为不限制
+
+    match 支持: types(消息类型列表), is_group, is_self, rooms(roomid列表)
+    """
+
+    __slots__ = ("types", "is_group", "is_self", "rooms", "target")
+
+    def __init__(self, config):
+        match = config.get("match", {})
+        unknown_keys = set(match) - {"types", "is_group", "is_self", "rooms"}
+        if unknown_keys:
+            raise ValueError(f"未知的匹配条件: {sorted(unknown_keys)}")
+        self.types = frozenset(int(msg_type) for msg_type in match["types"]) if "types" in match else None
+        self.is_group = match.get("is_group")
+        self.is_self = match.get("is_self")
+        self.rooms = frozenset(match["rooms"]) if "rooms" in match else None
+        self.target = RouteTarget(config["target"])
+
+    def matches(self, message):
+        if self.types is not None and message.get("type") not in self.types:
+            return False
+        if self.is_group is not None and bool(message.get("is_group")) != self.is_group:
+            return False
+        if self.is_self is not None and bool(message.get("is_self")) != self.is_self:
+            return False
+        if self.rooms is not None and message.get("roomid") not in self.rooms:
+            return False
+        return True
+
+
+class RoutingTable:
+    """
+    回调路由表: 路由名 -> 有序规则列表 + 默认目标, 按顺序匹配第一条命中的规则
+    """
+
+    def __init__(self, routes_config, source="default"):
+        self.source = source
+        self.fingerprint = json.dumps(routes_config, sort_keys=True)
+        self._routes = {}
+        for route, route_config in routes_config.items():
+            rules = [RouteRule(rule) for rule in route_config.get("rules", [])]
+            default = RouteTarget(route_config["default"])
+            self._routes[route] = (rules, default)
+
+    def has_route(self, route):
+        return route in self._routes
+
+    def resolve(self, route, message):
+        rules, default = self._routes[route]
+        for rule in rules:
+            if rule.matches(message):
+                return rule.target
+        return default
+
+
+# 可用的sink
+ROUTE_SINKS = {SINK_DROP}
+if PERSIST_ENABLED:
+    ROUTE_SINKS.add(SINK_PERSIST)
+if STREAM_ENABLED:
+    ROUTE_SINKS.add(SINK_STREAM)
+
+routing_table = RoutingTable(DEFAULT_ROUTES)
+
+
+async def load_routing_table():
+    """
+    加载路由表: 优先从Redis读取, 其次读取本地JSON文件, 都未配置时使用默认规则
+
+    配置格式见 webhook_routes.example.json, 加载失败时保留当前路由表
+    """
+    global routing_table
+    try:
+        config, source = None, "default"
+        if ROUTES_REDIS_KEY and webhook_redis is not None:
+            raw_config = await webhook_redis.get(ROUTES_REDIS_KEY)
+            if raw_config:
+                config, source = json.loads(raw_config), f"redis:{ROUTES_REDIS_KEY}"
+        if config is None and ROUTES_FILE and os.path.exists(ROUTES_FILE):
+            with open(ROUTES_FILE, encoding="utf-8") as routes_file:
+                config, source = json.load(routes_file), f"file:{ROUTES_FILE}"
+
+        routes_config = dict(DEFAULT_ROUTES)
+        if config is not None:
+            routes_config.update(config["routes"])
+        fingerprint = json.dumps(routes_config, sort_keys=True)
+        if fingerprint == routing_table.fingerprint:
+            return
+        routing_table = RoutingTable(routes_config, source=source)
+        logger.info(f'加载回调路由表成功, 来源: {source}, 路由: {sorted(routes_config)}')
+    except Exception as e:
+        logger.error(f'加载回调路由表失败, 继续使用当前路由表({routing_table.source}): {e}')
+
+
+async def reload_routing_table_forever():
+    """
+    定期重新加载路由表, 使Redis或文件中的修改无需重启即可生效
+    """
+    while True:
+        await asyncio.sleep(ROUTES_RELOAD_SECONDS)
+        await load_routing_table()
+
+# =====================
+# Rate Limiting
+# =====================
+
+def parse_rate_limit(value):
+    """
+    解析限流配置, 如 "100/minute"、"10/second"、"500/5minutes"
+
+    返回 (令牌数, 周期秒数), 配置为空时返回None表示不限流
+    """
+    if not value:
+        return None
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*$', value.lower())
+    if not match:
+        raise ValueError(f"无效的限流配置: {value}")
+    unit_seconds = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}[match.group(3)]
+    return int(match.group(1)), int(match.group(2) or 1) * unit_seconds
+
+
+class TokenBucket:
+    """
+    令牌桶: 容量为周期内的请求数, 按固定速率补充令牌
+    """
+
+    def __init__(self, capacity, period_seconds):
+        self.capacity = capacity
+        self.rate = capacity / period_seconds
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+
+class RateLimiter:
+    """
+    按 (scope, key) 限流的令牌桶, scope 可单独配置限额, 如按投递目标区分
+
+    - 配置了Redis(WEBHOOK_REDIS_URL)时令牌桶保存在Redis中, 多个worker进程共享同一限额
+    - 未配置Redis或Redis异常时使用进程内的令牌桶, 此时实际限额为 worker数 x 配置值
+    """
+
+    # 补充令牌并尝试取出一个, 返回 {是否成功, 令牌数(字符串)}
+    _ACQUIRE_SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+    return {allowed, tostring(tokens)}
+    """
+
+    # 退还一个令牌, 不超过容量
+    _REFUND_SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+    if tokens then
+        redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + 1)))
+    end
+    return 1
+    """
+
+    # 清理进程内空闲令牌桶的间隔(秒)
+    EVICT_INTERVAL_SECONDS = 60
+
+    def __init__(self, limit, name, scope_limits=""):
+        self.limit = parse_rate_limit(limit)
+        self.scope_limits = parse_route_settings(scope_limits, parse_rate_limit)
+        self.name = name
+        self._buckets = {}
+        self._acquire_script = None
+        self._refund_script = None
+        self._last_evict_time = time.monotonic()
+
+    def limit_for(self, scope=None):
+        """
+        scope 的限额 (令牌数, 周期秒数), 不限流时返回None
+        """
+        return self.scope_limits.get(scope, self.limit)
+
+    def _bucket_key(self, key, scope):
+        return f"{scope}|{key}" if scope else key
+
+    def _bucket(self, bucket_key, limit):
+        self._evict_idle()
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = TokenBucket(*limit)
+            self._buckets[bucket_key] = bucket
+        return bucket
+
+    def _evict_idle(self):
+        # 空闲超过一个周期的令牌桶已补满, 与新建的令牌桶等价, 可以删除
+        now = time.monotonic()
+        if now - self._last_evict_time < self.EVICT_INTERVAL_SECONDS:
+            return
+        self._last_evict_time = now
+        idle_keys = [bucket_key for bucket_key, bucket in self._buckets.items()
+                     if (now - bucket.updated_at) * bucket.rate >= bucket.capacity]
+        for bucket_key in idle_keys:
+            del self._buckets[bucket_key]
+
+    async def try_acquire(self, key, scope=None):
+        """
+        尝试取出一个令牌
+
+        返回 (是否允许, 建议重试的秒数)
+        """
+        limit = self.limit_for(scope)
+        if limit is None:
+            return True, 0
+        capacity, period_seconds = limit
+        rate = capacity / period_seconds
+        bucket_key = self._bucket_key(key, scope)
+
+        allowed, tokens = None, 0.0
+        if webhook_redis is not None:
+            try:
+                if self._acquire_script is None:
+                    self._acquire_script = webhook_redis.register_script(self._ACQUIRE_SCRIPT)
+                allowed, tokens = await self._acquire_script(
+                    keys=[f"webhook:rate_limit:{self.name}:{bucket_key}"], args=[capacity, rate, time.time()])
+                allowed, tokens = bool(int(allowed)), float(tokens)
+            except Exception as e:
+                logger.warning(f'Redis限流失败, 使用进程内限流: {e}')
+                allowed = None
+        if allowed is None:
+            bucket = self._bucket(bucket_key, limit)
+            allowed = bucket.try_acquire()
+            tokens = bucket.tokens
+
+        RATE_LIMIT_ADMISSIONS.labels(route=scope or self.name, result="accepted" if allowed else "throttled").inc()
+        return allowed, max(1, math.ceil((1 - tokens) / rate)) if not allowed else 0
+
+    async def refund(self, key, scope=None):
+        """
+        退还 try_acquire 取出的令牌, 用于取得令牌后请求并未实际执行的情况
+        """
+        limit = self.limit_for(scope)
+        if limit is None:
+            return
+        bucket_key = self._bucket_key(key, scope)
+        if webhook_redis is not None:
+            try:
+                if self._refund_script is None:
+                    self._refund_script = webhook_redis.register_script(self._REFUND_SCRIPT)
+                await self._refund_script(keys=[f"webhook:rate_limit:{self.name}:{bucket_key}"], args=[limit[0]])
+                return
+            except Exception as e:
+                logger.warning(f'Redis退还令牌失败: {e}')
+        bucket = self._buckets.get(bucket_key)
+        if bucket is not None:
+            bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+
+    def backlog_retry_after(self, backlog, scope=None):
+        """
+        按限流速率估算积压消息投递完的秒数
+        """
+        limit = self.limit_for(scope)
+        if limit is None:
+            return 1
+        capacity, period_seconds = limit
+        return max(1, math.ceil(backlog * period_seconds / capacity))
+
+
+# 按 (投递目标, 微信账号source_ip) 限制投递到Airflow的速率, 在后台投递器取出批次时判定
+wcf_rate_limiter = RateLimiter(RATE_LIMIT_WCF, name="wcf", scope_limits=RATE_LIMIT_TARGETS)
+update_rate_limiter = RateLimiter(RATE_LIMIT_UPDATE, name="update")
+
+
+def rate_limited_response(retry_after):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(retry_after)},
+        content={"message": "请求过于频繁, 请稍后重试"}
+    )
+
+# =====================
+# Duplicate Suppression
+# =====================
+
+class SeenMessageCache:
+    """
+    已接收消息ID的集合, 用于过滤WCF或网络重试导致的重复回调
+
+    - 本地记录按过期时间排序, 清理时从队首移除已过期的记录, 超过容量时淘汰最早过期的记录
+    - 配置Redis后使用 SET NX PX 在多个worker之间共享, Redis异常时退化为本地过滤
+    """
+
+    def __init__(self, ttl_seconds, max_entries, redis_url=""):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._redis = None
+        if redis_url:
+            if aioredis is None:
+                logger.warning('未安装redis库, 重复消息过滤仅在本进程内生效')
+            else:
+                self._redis = aioredis.from_url(redis_url)
+
+    def _local_seen(self, key, now):
+        # 所有记录的TTL相同且只在写入时追加到队尾, 队首即最早过期的记录
+        while self._entries:
+            oldest_key, expire_time = next(iter(self._entries.items()))
+            if expire_time > now:
+                break
+            self._entries.popitem(last=False)
+
+        expire_time = self._entries.get(key)
+        if expire_time and expire_time > now:
+            return True
+        return False
+
+    def _remember(self, key, now):
+        self._entries[key] = now + self.ttl_seconds
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def check_and_add(self, key):
+        """
+        检查消息是否已接收过, 未接收过则记录下来; 返回True表示重复消息
+        """
+        now = time.monotonic()
+        if self._local_seen(key, now):
+            self.hits += 1
+            DEDUPE_RESULTS.labels(result="hit").inc()
+            return True
+
+        if self._redis is not None:
+            try:
+                added = await self._redis.set(f"webhook:seen:{key}", 1, nx=True,
+                                             px=max(1, int(self.ttl_seconds * 1000)))
+                if not added:
+                    self._remember(key, now)
+                    self.hits += 1
+                    DEDUPE_RESULTS.labels(result="hit").inc()
+                    return True
+            except Exception as e:
+                logger.warning(f'Redis重复消息过滤失败, 退化为本地过滤: {e}')
+
+        self._remember(key, now)
+        self.misses += 1
+        DEDUPE_RESULTS.labels(result="miss").inc()
+        return False
+
+    async def discard(self, key):
+        """
+        消息处理失败时移除记录, 允许上游重试
+        """
+        self._entries.pop(key, None)
+        if self._redis is not None:
+            try:
+                await self._redis.delete(f"webhook:seen:{key}")
+            except Exception as e:
+                logger.warning(f'Redis重复消息记录删除失败: {e}')
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+
+
+# webhook共享的Redis客户端, 未配置时为None
+webhook_redis = aioredis.from_url(WEBHOOK_REDIS_URL) if (WEBHOOK_REDIS_URL and aioredis is not None) else None
+
+seen_messages = SeenMessageCache(
+    ttl_seconds=DEDUP_TTL_SECONDS,
+    max_entries=DEDUP_MAX_ENTRIES,
+    redis_url=DEDUP_REDIS_URL,
+)
+
+
+def callback_dedup_key(callback_data):
+    """
+    重复消息的判断依据: 同一WCF主机上的消息ID; 没有消息ID时不做过滤
+    """
+    msg_id = callback_data.get("id")
+    if msg_id in (None, ""):
+        return None
+    return f"{callback_data.get('source_ip', '')}|{msg_id}"
+
+# =====================
+# Persist Sink
+# =====================
+
+# 微信消息类型定义, 与 dags/wx_dags/common/wx_tools.py 保持一致
+WX_MSG_TYPES = {
+    0: "朋友圈消息",
+    1: "文字",
+    3: "图片", 
+    34: "语音",
+    37: "好友确认",
+    40: "POSSIBLEFRIEND_MSG",
+    42: "名片",
+    43: "视频",
+    47: "石头剪刀布 | 表情图片",
+    48: "位置",
+    49: "共享实时位置、文件、转账、链接",
+    50: "VOIPMSG",
+    51: "微信初始化",
+    52: "VOIPNOTIFY", 
+    53: "VOIPINVITE",
+    62: "小视频",
+    66: "微信红包",
+    9999: "SYSNOTICE",
+    10000: "红包、系统消息",
+    10002: "撤回消息",
+    1048625: "搜狗表情",
+    16777265: "链接",
+    436207665: "微信红包",
+    536936497: "红包封面",
+    754974769: "视频号视频",
+    771751985: "视频号名片",
+    822083633: "引用消息",
+    922746929: "拍一拍",
+    973078577: "视频号直播",
+    974127153: "商品链接",
+    975175729: "视频号直播",
+    1040187441: "音乐链接",
+    1090519089: "文件"
+}
+
+
+class WcfDirectory:
+    """
+    WCF主机上的账号信息与联系人名称缓存, 同一主机的刷新请求合并为一次
+    """
+
+    def __init__(self, port, contacts_ttl_seconds, miss_refresh_seconds):
+        self.port = port
+        self.contacts_ttl_seconds = contacts_ttl_seconds
+        self.miss_refresh_seconds = miss_refresh_seconds
+        self._client = None
+        self._accounts = {}
+        self._contacts = {}
+        self._locks = {}
+
+    def open(self):
+        self._client = httpx.AsyncClient(timeout=10)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def _get(self, source_ip, path):
+        response = await self._client.get(f"http://{source_ip}:{self.port}{path}")
+        response.raise_for_status()
+        result = response.json()
+        if result.get('status') != 0:
+            raise Exception(f"WCF API {path} 调用失败: {result.get('message', '未知错误')}")
+        return result.get('data', {})
+
+    def _lock(self, source_ip):
+        lock = self._locks.get(source_ip)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[source_ip] = lock
+        return lock
+
+    async def get_account(self, source_ip):
+        """
+        获取WCF主机上登录的微信账号信息
+        """
+        account = self._accounts.get(source_ip)
+        if account is None:
+            async with self._lock(source_ip):
+                account = self._accounts.get(source_ip)
+                if account is None:
+                    account = await self._get(source_ip, "/userinfo")
+                    self._accounts[source_ip] = account
+        return account
+
+    async def get_contact_names(self, source_ip, wxids):
+        """
+        批量获取联系人/群名称, 缓存过期或遇到未知wxid时刷新联系人列表, 仍未找到时返回wxid本身
+        """
+        cached = self._contacts.get(source_ip)
+        now = time.monotonic()
+        expired = cached is None or now - cached["loaded_at"] > self.contacts_ttl_seconds
+        missing = cached is not None and any(wxid and wxid not in cached["names"] for wxid in wxids)
+        if expired or (missing and now - cached["loaded_at"] > self.miss_refresh_seconds):
+            async with self._lock(source_ip):
+                # 等锁期间其他请求可能已刷新
+                cached = self._contacts.get(source_ip)
+                if cached is None or cached["loaded_at"] < now:
+                    data = await self._get(source_ip, "/contacts")
+                    names = {contact.get('wxid', ''): contact.get('name', '') for contact in data.get('contacts', [])}
+                    cached = {"loaded_at": time.monotonic(), "names": names}
+                    self._contacts[source_ip] = cached
+                    logger.info(f'刷新 {source_ip} 的联系人列表缓存, 数量: {len(names)}')
+        return {wxid: cached["names"].get(wxid) or wxid for wxid in wxids}
+
+
+async def build_chat_records(messages):
+    """
+    将回调消息转换为 wx_chat_records 表的行, 字段与 save_msg_to_db 一致
+    """
+    records = []
+    for message in messages:
+        source_ip = message.get('source_ip', '')
+        account = await wcf_directory.get_account(source_ip)
+        room_id = message.get('roomid', '')
+        sender_id = message.get('sender', '')
+        is_self = bool(message.get('is_self', False))
+        names = await wcf_directory.get_contact_names(source_ip, [room_id, sender_id])
+        msg_type = message.get('type', 0)
+        msg_timestamp = message.get('ts', 0)
+        records.append((
+            str(message.get('id', '')),
+            account.get('wxid', ''),
+            account.get('name', ''),
+            room_id,
+            names.get(room_id, room_id),
+            sender_id,
+            account.get('name', '') if is_self else names.get(sender_id, sender_id),
+            msg_type,
+            WX_MSG_TYPES.get(msg_type, f"未知类型({msg_type})"),
+            message.get('content', ''),
+            1 if is_self else 0,
+            1 if message.get('is_group', False) else 0,
+            source_ip,
+            msg_timestamp,
+            datetime.fromtimestamp(msg_timestamp) if msg_timestamp else datetime.now(),
+        ))
+    return records
+
+
+class MysqlBulkWriter:
+    """
+    聊天记录批量写入器: 缓冲待写入的行, 每隔固定时间或攒够一定行数后, 用一条多行
+    INSERT ... ON DUPLICATE KEY UPDATE 写入, 写入完成后调用方才确认队列中的消息
+    """
+
+    COLUMNS = ("msg_id", "wx_user_id", "wx_user_name", "room_id", "room_name", "sender_id", "sender_name",
+               "msg_type", "msg_type_name", "content", "is_self", "is_group", "source_ip", "msg_timestamp",
+               "msg_datetime")
+
+    def __init__(self, flush_interval_ms, max_rows, pool_size):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_rows = max_rows
+        self.pool_size = pool_size
+        self._pool = None
+        self._pending = []
+        self._pending_rows = 0
+        self._flush_now = asyncio.Event()
+        self._loop_task = None
+
+    async def open(self):
+        self._pool = await aiomysql.create_pool(
+            host=WX_DB_HOST, port=WX_DB_PORT, user=WX_DB_USER, password=WX_DB_PASSWORD, db=WX_DB_NAME,
+            charset="utf8mb4", minsize=1, maxsize=self.pool_size, autocommit=False
+        )
+        self._loop_task = asyncio.create_task(self._flush_forever())
+        logger.info(f'persist sink已启用, 批量写入间隔: {self.flush_interval}s, 最大行数: {self.max_rows}')
+
+    async def close(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+        await self._flush()
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+
+    async def write(self, rows):
+        """
+        提交待写入的行, 等待所在批次写入完成, 写入失败时抛出异常
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((rows, future))
+        self._pending_rows += len(rows)
+        if self._pending_rows >= self.max_rows:
+            self._flush_now.set()
+        await future
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self._flush()
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        pending, self._pending, self._pending_rows = self._pending, [], 0
+        rows = [row for batch_rows, _ in pending for row in batch_rows]
+
+        placeholders = "(" + ", ".join(["%s"] * len(self.COLUMNS)) + ")"
+        insert_sql = f"""INSERT INTO `wx_chat_records` ({", ".join(self.COLUMNS)})
+        VALUES {", ".join([placeholders] * len(rows))}
+        ON DUPLICATE KEY UPDATE
+        content = VALUES(content),
+        room_name = VALUES(room_name),
+        sender_name = VALUES(sender_name),
+        updated_at = CURRENT_TIMESTAMP
+        """
+        params = [value for row in rows for value in row]
+
+        start_time = time.perf_counter()
+        try:
+            async with self._pool.acquire() as conn:
+                try:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(insert_sql, params)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+            PERSIST_ROWS.labels(result="success").inc(len(rows))
+            logger.info(f'persist sink批量写入成功, 行数: {len(rows)}')
+            for _, future in pending:
+                if not future.done():
+                    future.set_result(None)
+        except Exception as e:
+            PERSIST_ROWS.labels(result="error").inc(len(rows))
+            logger.error(f'persist sink批量写入失败, 行数: {len(rows)}, error: {e}')
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            PERSIST_FLUSH_LATENCY.observe(time.perf_counter() - start_time)
+
+
+wcf_directory = WcfDirectory(
+    port=WCF_API_PORT,
+    contacts_ttl_seconds=WCF_CONTACTS_TTL_SECONDS,
+    miss_refresh_seconds=WCF_CONTACTS_MISS_REFRESH_SECONDS,
+)
+persist_writer = MysqlBulkWriter(
+    flush_interval_ms=PERSIST_FLUSH_INTERVAL_MS,
+    max_rows=PERSIST_FLUSH_MAX_ROWS,
+    pool_size=WX_DB_POOL_SIZE,
+)
+
+
+# 消息统计, 与 dags/wx_dags/common/msg_stats.py 使用相同的key和时间桶, 需连接Airflow使用的Redis
+STATS_KEY_PREFIX = "wx_stats"
+STATS_TZ = timezone(timedelta(hours=8))
+STATS_GRANULARITIES = {
+    "minute": ("%Y%m%d%H%M", 2 * 24 * 3600),
+    "hour": ("%Y%m%d%H", 14 * 24 * 3600),
+    "day": ("%Y%m%d", 90 * 24 * 3600),
+}
+STATS_COUNTED_MARKER_TTL = 24 * 3600
+
+
+async def record_message_stats(records):
+    """
+    persist sink的消息不经过DAG, 在这里计入与DAG相同的 wx_stats:* 统计; 按消息ID去重, 重试时不会重复计数
+    """
+    if webhook_redis is None:
+        return
+    records = [record for record in records if record[0]]
+    if not records:
+        return
+    pipe = webhook_redis.pipeline(transaction=False)
+    for record in records:
+        pipe.set(f"{STATS_KEY_PREFIX}:counted:{record[2]}:{record[0]}", 1, nx=True, ex=STATS_COUNTED_MARKER_TTL)
+    first_seen = await pipe.execute()
+
+    counts = {}
+    for record, added in zip(records, first_seen):
+        if added:
+            # 自己在其他设备上发送的消息记为发出
+            key = (record[2], record[3], "out" if record[10] else "in")
+            counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return
+
+    now = datetime.now(STATS_TZ)
+    pipe = webhook_redis.pipeline(transaction=False)
+    for granularity, (bucket_format, retention) in STATS_GRANULARITIES.items():
+        bucket = now.strftime(bucket_format)
+        bucket_start = datetime.strptime(bucket, bucket_format).replace(tzinfo=STATS_TZ).timestamp()
+        bucket_key = f"{STATS_KEY_PREFIX}:{granularity}:{bucket}"
+        for (wx_user_name, room_id, direction), count in counts.items():
+            pipe.hincrby(bucket_key, f"{wx_user_name}|{room_id}|{direction}", count)
+        pipe.expire(bucket_key, retention)
+        pipe.zadd(f"{STATS_KEY_PREFIX}:buckets:{granularity}", {bucket: bucket_start})
+    for (wx_user_name, _, direction), count in counts.items():
+        pipe.hincrby(f"{STATS_KEY_PREFIX}:total", f"{wx_user_name}|{direction}", count)
+    await pipe.execute()
+
+
+async def persist_messages(messages):
+    """
+    persist sink: 消息直接写入聊天记录表, 并计入消息统计
+    """
+    records = await build_chat_records(messages)
+    await persist_writer.write(records)
+    try:
+        await record_message_stats(records)
+    except Exception as e:
+        # 统计失败不影响消息入库
+        logger.warning(f'persist sink消息统计失败: {e}')
+
+# =====================
+# Ingest Queue & Dispatcher
+# =====================
+
+def build_batch_conf(messages):
+    """
+    将同一房间的多条消息合并为一次DAG触发的conf
+
+    conf的顶层字段保持为最后一条消息, 兼容单条消息的处理逻辑;
+    多条消息时通过 batch_messages 按接收顺序携带完整批次
+    """
+    if len(messages) == 1:
+        return messages[0]
+    conf = dict(messages[-1])
+    conf['batch_messages'] = messages
+    return conf
+
+
+async def publish_to_stream(messages):
+    """
+    stream sink: 同一房间的批次作为一条记录写入Redis Stream, 格式与DAG的conf相同
+    """
+    return await webhook_redis.xadd(
+        WX_MSG_STREAM_KEY,
+        {"conf": json.dumps(build_batch_conf(messages), ensure_ascii=False)},
+        maxlen=WX_MSG_STREAM_MAXLEN,
+        approximate=True,
+    )
+
+
+class IngestQueue:
+    """
+    基于SQLite(WAL模式)的本地持久化消息队列
+
+    - 回调消息先落盘再应答, 不依赖Airflow API的可用性
+    - 同一 batch_key (目标DAG + source_ip + roomid) 的消息在静默窗口后合并出队
+    - 出队的消息带租约, 进程崩溃后租约过期的消息会被重新投递
+    - 批次的成员在首次出队时固定(batch_id), 重新投递时只取原批次的消息, DAG run id 保持不变
+    - 所有SQLite操作在单独的线程中串行执行, 不阻塞事件循环
+    """
+
+    def __init__(self, db_path, window_seconds, max_wait_seconds, max_batch_size,
+                 max_retries, retry_base_seconds, lease_seconds):
+        self.db_path = db_path
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.lease_seconds = lease_seconds
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest_queue")
+        self._conn = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS ingest_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                target TEXT NOT NULL,
+                batch_key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                claimed_at REAL,
+                claim_token TEXT,
+                last_error TEXT,
+                account TEXT,
+                batch_id INTEGER
+            )""")
+            # 旧版本创建的队列表缺少的字段
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(ingest_queue)")}
+            for column, column_type in (("account", "TEXT"), ("batch_id", "INTEGER")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE ingest_queue ADD COLUMN {column} {column_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_queue_status_key ON ingest_queue (status, batch_key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_queue_account ON ingest_queue (account, status)")
+            self._conn = conn
+        return self._conn
+
+    async def open(self):
+        """
+        初始化队列, 并回收上次崩溃时未完成的消息
+        """
+        recovered = await self.recover()
+        logger.info(f'本地消息队列已就绪: {self.db_path}, 回收未完成消息数: {recovered}')
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def put(self, target, batch_key, message, account="", max_backlog=0):
+        """
+        消息落盘
+
+        max_backlog 大于0时, 账号的待投递消息数达到该值则不写入
+        返回 (队列中的消息ID, 写入前账号的待投递消息数), 未写入时消息ID为None
+        """
+        return await self._run(self._put, target, batch_key, json.dumps(message, ensure_ascii=False),
+                               account, max_backlog)
+
+    def _put(self, target, batch_key, payload, account, max_backlog):
+        conn = self._connect()
+        backlog = 0
+        if max_backlog > 0:
+            backlog = conn.execute(
+                "SELECT COUNT(*) FROM ingest_queue WHERE account = ? AND status IN ('pending', 'inflight')",
+                (account,)
+            ).fetchone()[0]
+            if backlog >= max_backlog:
+                return None, backlog
+        now = time.time()
+        cursor = conn.execute(
+            """INSERT INTO ingest_queue (target, batch_key, payload, created_at, available_at, account)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (target, batch_key, payload, now, now, account)
+        )
+        return cursor.lastrowid, backlog
+
+    async def recover(self):
+        """
+        将租约过期的出队消息重新置为待处理
+        """
+        return await self._run(self._recover)
+
+    def _recover(self):
+        cursor = self._connect().execute(
+            "UPDATE ingest_queue SET status = 'pending', claim_token = NULL WHERE status = 'inflight' AND claimed_at < ?",
+            (time.time() - self.lease_seconds,)
+        )
+        return cursor.rowcount
+
+    async def claim_ready_batches(self, limit, admit=None, release=None):
+        """
+        取出已过静默窗口的批次, 同一batch_key同时只会有一个批次在处理中, 保证房间内消息有序
+
+        admit 为可选的协程函数, 参数为batch_key, 返回False时该批次留在队列中(如账号超出限流)
+        release 为可选的协程函数, admit 通过但批次已被其他worker取走时调用, 如退还限流令牌
+        """
+        if limit <= 0:
+            return []
+        # 多取一些候选, 被限流的账号不会占满本轮的名额
+        batch_keys = await self._run(self._ready_batch_keys, max(limit * 5, 50))
+        batches = []
+        for batch_key in batch_keys:
+            if len(batches) >= limit:
+                break
+            if admit is not None and not await admit(batch_key):
+                continue
+            batch = await self._run(self._claim_batch, batch_key)
+            if batch is not None:
+                batches.append(batch)
+            elif admit is not None and release is not None:
+                await release(batch_key)
+        return batches
+
+    def _ready_batch_keys(self, limit):
+        now = time.time()
+        rows = self._connect().execute(
+            """SELECT batch_key FROM ingest_queue
+            WHERE status = 'pending'
+              AND batch_key NOT IN (SELECT batch_key FROM ingest_queue WHERE status = 'inflight')
+            GROUP BY batch_key
+            HAVING MAX(available_at) <= :now
+               AND (MAX(created_at) <= :now - :window
+                    OR MIN(created_at) <= :now - :max_wait
+                    OR COUNT(*) >= :max_size)
+            ORDER BY MIN(id)
+            LIMIT :limit""",
+            {"now": now, "window": self.window_seconds, "max_wait": self.max_wait_seconds,
+             "max_size": self.max_batch_size, "limit": limit}
+        ).fetchall()
+        return [batch_key for (batch_key,) in rows]
+
+    def _claim_batch(self, batch_key):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 其他worker可能已在选出候选之后取走了该批次
+            inflight = conn.execute(
+                "SELECT 1 FROM ingest_queue WHERE status = 'inflight' AND batch_key = ? LIMIT 1", (batch_key,)
+            ).fetchone()
+            if inflight is not None:
+                conn.execute("COMMIT")
+                return None
+            claim_token = uuid.uuid4().hex
+            # 投递失败或租约过期的批次只重新取出原批次的消息, 之后到达的消息留给下一个批次
+            batch_id = conn.execute(
+                "SELECT MIN(batch_id) FROM ingest_queue WHERE status = 'pending' AND batch_key = ?", (batch_key,)
+            ).fetchone()[0]
+            if batch_id is not None:
+                conn.execute(
+                    """UPDATE ingest_queue SET status = 'inflight', claimed_at = ?, claim_token = ?
+                    WHERE status = 'pending' AND batch_key = ? AND batch_id = ?""",
+                    (now, claim_token, batch_key, batch_id)
+                )
+            else:
+                conn.execute(
+                    """UPDATE ingest_queue SET status = 'inflight', claimed_at = ?, claim_token = ?
+                    WHERE id IN (SELECT id FROM ingest_queue WHERE status = 'pending' AND batch_key = ?
+                                 ORDER BY id LIMIT ?)""",
+                    (now, claim_token, batch_key, self.max_batch_size)
+                )
+                conn.execute(
+                    """UPDATE ingest_queue SET batch_id = (SELECT MIN(id) FROM ingest_queue WHERE claim_token = :token)
+                    WHERE claim_token = :token""",
+                    {"token": claim_token}
+                )
+            rows = conn.execute(
+                "SELECT id, target, payload, attempts FROM ingest_queue WHERE claim_token = ? ORDER BY id",
+                (claim_token,)
+            ).fetchall()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if not rows:
+            return None
+        return {
+            "batch_key": batch_key,
+            "target": rows[0][1],
+            "ids": [row[0] for row in rows],
+            "messages": [json.loads(row[2]) for row in rows],
+            "attempts": max(row[3] for row in rows),
+        }
+
+    async def ack(self, ids):
+        """
+        投递成功, 删除消息
+        """
+        await self._run(self._ack, ids)
+
+    def _ack(self, ids):
+        self._connect().executemany("DELETE FROM ingest_queue WHERE id = ?", [(msg_id,) for msg_id in ids])
+
+    async def fail(self, ids, attempts, error):
+        """
+        投递失败, 按指数退避重新排队; 超过最大重试次数后标记为dead, 保留待人工排查
+        """
+        return await self._run(self._fail, ids, attempts, error)
+
+    def _fail(self, ids, attempts, error):
+        attempts += 1
+        if attempts >= self.max_retries:
+            status_value, available_at = 'dead', time.time()
+        else:
+            status_value = 'pending'
+            available_at = time.time() + min(self.retry_base_seconds * (2 ** (attempts - 1)), 300)
+        self._connect().executemany(
+            """UPDATE ingest_queue SET status = ?, attempts = ?, available_at = ?, last_error = ?, claim_token = NULL
+            WHERE id = ?""",
+            [(status_value, attempts, available_at, str(error)[:1000], msg_id) for msg_id in ids]
+        )
+        return status_value
+
+    async def depth(self):
+        """
+        各状态的消息数量
+        """
+        return await self._run(self._depth)
+
+    def _depth(self):
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM ingest_queue GROUP BY status").fetchall()
+        return {status_value: count for status_value, count in rows}
+
+
+class AirflowDispatcher:
+    """
+    后台异步投递器: 从本地队列中取出就绪批次, 限制并发地触发Airflow DAG或写入sink
+    """
+
+    def __init__(self, queue, concurrency, poll_interval):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._inflight = set()
+        self._loop_task = None
+        self._wakeup = asyncio.Event()
+        self._last_recover_time = 0
+
+    def start(self):
+        self._loop_task = asyncio.create_task(self._run_forever())
+
+    def notify(self):
+        """
+        有新消息入队时唤醒投递循环
+        """
+        self._wakeup.set()
+
+    async def stop(self, timeout=10):
+        if self._loop_task:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+        if self._inflight:
+            # 等待进行中的投递完成, 未完成的消息会在下次启动时因租约过期而重新投递
+            await asyncio.wait(self._inflight, timeout=timeout)
+
+    async def _run_forever(self):
+        while True:
+            try:
+                # 定期回收其他worker进程崩溃遗留的消息
+                if time.monotonic() - self._last_recover_time > self.queue.lease_seconds:
+                    self._last_recover_time = time.monotonic()
+                    await self.queue.recover()
+
+                batches = await self.queue.claim_ready_batches(self.concurrency - len(self._inflight),
+                                                               admit=self._admit, release=self._release)
+                for batch in batches:
+                    task = asyncio.create_task(self._dispatch(batch))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._inflight.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'投递循环异常: {e}')
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    async def _admit(batch_key):
+        """
+        按 (投递目标, 账号source_ip) 限制投递Airflow的速率; sink不调用Airflow, 不限流
+        """
+        target, source_ip = batch_key.split("|", 2)[:2]
+        if target.startswith("sink:"):
+            return True
+        allowed, _ = await wcf_rate_limiter.try_acquire(source_ip, scope=target)
+        return allowed
+
+    @staticmethod
+    async def _release(batch_key):
+        """
+        批次已被其他worker取走, 退还 _admit 取出的令牌
+        """
+        target, source_ip = batch_key.split("|", 2)[:2]
+        if not target.startswith("sink:"):
+            await wcf_rate_limiter.refund(source_ip, scope=target)
+
+    async def _dispatch(self, batch):
+        DISPATCH_BATCH_SIZE.observe(len(batch["ids"]))
+        try:
+            if batch["target"] == f"sink:{SINK_PERSIST}":
+                await persist_messages(batch["messages"])
+                logger.info(f'批次写入聊天记录成功, batch_key: {batch["batch_key"]}, 消息数: {len(batch["ids"])}')
+            elif batch["target"] == f"sink:{SINK_STREAM}":
+                stream_id = await publish_to_stream(batch["messages"])
+                logger.info(f'批次写入消息流成功, batch_key: {batch["batch_key"]}, 消息数: {len(batch["ids"])}, stream_id: {stream_id}')
+            else:
+                dag_run_id = await trigger_airflow_dag(build_batch_conf(batch["messages"]), dag_id=batch["target"])
+                logger.info(f'批次投递成功, batch_key: {batch["batch_key"]}, 消息数: {len(batch["ids"])}, dag_run_id: {dag_run_id}')
+            await self.queue.ack(batch["ids"])
+            DISPATCH_BATCHES.labels(target=batch["target"], result="success").inc()
+        except Exception as e:
+            status_value = await self.queue.fail(batch["ids"], batch["attempts"], e)
+            DISPATCH_BATCHES.labels(target=batch["target"], result="retry" if status_value == "pending" else status_value).inc()
+            logger.error(f'批次投递失败({status_value}), batch_key: {batch["batch_key"]}, 消息数: {len(batch["ids"])}, error: {e}')
+        finally:
+            self._wakeup.set()
+
+
+ingest_queue = IngestQueue(
+    db_path=INGEST_QUEUE_PATH,
+    window_seconds=WCF_AGGREGATE_WINDOW_SECONDS,
+    max_wait_seconds=WCF_AGGREGATE_MAX_WAIT_SECONDS,
+    max_batch_size=WCF_AGGREGATE_MAX_BATCH_SIZE,
+    max_retries=DISPATCH_MAX_RETRIES,
+    retry_base_seconds=DISPATCH_RETRY_BASE_SECONDS,
+    lease_seconds=DISPATCH_LEASE_SECONDS,
+)
+airflow_dispatcher = AirflowDispatcher(
+    queue=ingest_queue,
+    concurrency=DISPATCH_CONCURRENCY,
+    poll_interval=DISPATCH_POLL_INTERVAL,
+)
+
+# =====================
+# Lifecycle
+# =====================
+
+@app.on_event("startup")
+async def on_startup():
+    """
+    启动时创建共享的Airflow客户端, 打开本地队列并启动后台投递
+    """
+    global airflow_client, routes_reload_task
+    airflow_client = create_airflow_client()
+    await load_routing_table()
+    if ROUTES_RELOAD_SECONDS > 0:
+        routes_reload_task = asyncio.create_task(reload_routing_table_forever())
+    if PERSIST_ENABLED:
+        wcf_directory.open()
+        await persist_writer.open()
+    elif WX_DB_HOST:
+        logger.warning('已配置WX_DB_HOST但未安装aiomysql库, persist sink未启用, 消息将按路由表改为触发DAG')
+    await ingest_queue.open()
+    airflow_dispatcher.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """
+    服务关闭时停止投递(队列中的消息保留到下次启动), 再关闭共享客户端
+    """
+    if routes_reload_task is not None:
+        routes_reload_task.cancel()
+    await airflow_dispatcher.stop()
+    await ingest_queue.close()
+    if PERSIST_ENABLED:
+        await persist_writer.close()
+        await wcf_directory.close()
+    if airflow_client is not None:
+        await airflow_client.aclose()
+    await seen_messages.close()
+    if webhook_redis is not None:
+        await webhook_redis.close()
+    stop_log_listener(log_listener)
+
 # =====================
 # Global Exception Handlers
 # =====================